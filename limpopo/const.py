@@ -11,6 +11,12 @@ SESSION_DOESNT_EXIST = "У вас в данный момент нет ни од
 DIALOG_ON_PAUSE = "Опрос поставлен на паузу"
 PAUSE_CANCELLED = "Диалог снят с паузы"
 
+# Outbound limits: (messages per sec., burst) for all chats and for one chat
+TELEGRAM_SEND_LIMITS = (30, 30, 1, 3)
+VIBER_SEND_LIMITS = (100, 100, 1, 5)
+# Practically unlimited, set limits in settings to model a messenger
+LOOPBACK_SEND_LIMITS = (10 ** 6, 10 ** 6, 10 ** 6, 10 ** 6)
+
 LIMPOPO_AVATAR = "https://www.svgrepo.com/show/165367/ghost.svg"
 
 
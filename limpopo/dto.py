@@ -1,7 +1,7 @@
 import enum
 import typing
 from asyncio import Event
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 class Messengers(enum.Enum):
@@ -29,6 +29,29 @@ class Respondent:
             raise ValueError("Field `id` must have type str")
 
 
+@dataclass
+class RestoreBundle:
+    dialog_id: int
+    messages: typing.List[typing.Tuple[int, str]]  # (question id, answer)
+    called_functions: typing.List[int]
+
+
+@dataclass
+class BroadcastProgress:
+    cursor: typing.Optional[str] = None  # id of the last processed respondent
+    invited: int = 0
+    finished: bool = False
+    # ids of respondents whose invitations failed, they are invited again
+    failed: typing.List[str] = field(default_factory=list)
+
+
+@dataclass
+class QuizCounts:
+    started: int = 0
+    completed: int = 0
+    cancelled: int = 0
+
+
 class Answer(Event):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
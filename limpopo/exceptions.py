@@ -32,3 +32,7 @@ class SettingsError(BaseLimpopoException):
 
 class DialogStopped(BaseLimpopoException):
     pass
+
+
+class ViberApiError(BaseLimpopoException):
+    pass
@@ -1,7 +1,11 @@
+import re
 import typing
+from collections import OrderedDict
+from functools import lru_cache
 from io import StringIO
+from time import monotonic
 
-from hashlib import blake2b
+from hashlib import blake2b, md5
 
 from markdown import Markdown
 from tenacity import (
@@ -27,11 +31,76 @@ def unmark_element(element, stream=None):
 
 Markdown.output_formats["plain"] = unmark_element
 
+_converter = Markdown(output_format="plain")
+_converter.stripTopLevelTags = False
 
+
+def full_markdown_to_plain_text(markdown_text):
+    """
+    Converts markdown to plain text with the complete Python-Markdown parser.
+    """
+    return _converter.reset().convert(markdown_text)
+
+
+# The subset of markdown, which is rendered without Python-Markdown:
+# paragraphs, **strong**, *emphasis*, `code` and [links](url).
+# Everything else is rendered by `full_markdown_to_plain_text`.
+_BLOCK_SPLIT_RE = re.compile(r"\n(?: *\n)+")
+_BLOCK_MARKUP_RE = re.compile(
+    r"^(?: {4}| *(?:[#>+=\-|]|\*(?:\s|\*\*|\*?$)|\d+[.)]))", re.MULTILINE
+)
+_UNSUPPORTED_WHITESPACE_RE = re.compile(r"[^\S \n]| {2}\n")
+# Text of links and code spans can't contain markup or be padded with spaces
+_SPAN_TEXT = r"[^\\_<>&\[\]()`*\s](?:[^\\_<>&\[\]()`*\n]*[^\\_<>&\[\]()`*\s])?"
+_LINK_RE = re.compile(r"(?<!!)\[(" + _SPAN_TEXT + r")\]\([^()\s]+\)")
+_CODE_RE = re.compile(r"(?<!`)`(" + _SPAN_TEXT + r")`(?!`)")
+_STRONG_RE = re.compile(r"(?<!\*)\*\*([^*\s](?:[^*]*?[^*\s])?)\*\*(?!\*)")
+_EMPHASIS_RE = re.compile(r"(?<!\*)\*([^*\s](?:[^*]*?[^*\s])?)\*(?!\*)")
+_UNSUPPORTED_RE = re.compile(r"[\\_<>&\[\]`*\x00-\x1f\x7f]")
+
+
+def _fast_markdown_to_plain_text(markdown_text) -> typing.Optional[str]:
+    """
+    Converts markdown to plain text if it uses only the supported subset
+    of markdown, otherwise returns None.
+    """
+    if _BLOCK_MARKUP_RE.search(markdown_text) or _UNSUPPORTED_WHITESPACE_RE.search(
+        markdown_text
+    ):
+        return None
+
+    paragraphs = []
+
+    for block in _BLOCK_SPLIT_RE.split(markdown_text):
+        text = block.lstrip()
+        if not text:
+            continue
+
+        text = _CODE_RE.sub(r"\1", text)
+        text = _LINK_RE.sub(r"\1", text)
+        text = _STRONG_RE.sub(r"\1", text)
+        if "**" in text:
+            return None
+        text = _EMPHASIS_RE.sub(r"\1", text)
+
+        paragraphs.append(text)
+
+    plain_text = "\n".join(paragraphs).strip()
+
+    if _UNSUPPORTED_RE.search(plain_text.replace("\n", "")):
+        return None
+
+    return plain_text
+
+
+@lru_cache(maxsize=4096)
 def markdown_to_plain_text(markdown_text):
-    converter = Markdown(output_format="plain")
-    converter.stripTopLevelTags = False
-    return converter.convert(markdown_text)
+    plain_text = _fast_markdown_to_plain_text(markdown_text)
+
+    if plain_text is None:
+        plain_text = full_markdown_to_plain_text(markdown_text)
+
+    return plain_text
 
 
 async def with_retry(
@@ -54,3 +123,104 @@ async def with_retry(
 def calculate_functions_hash(func: typing.Callable) -> int:
     code = func.__code__
     return int(blake2b(f"{code.co_name}{code.co_argcount}".encode(), digest_size=6).hexdigest(), 16)
+
+
+def calculate_question_id(plain_text: str) -> int:
+    """
+    Stable id of a question: the first 8 bytes of md5 of its text as a signed
+    bigint, the same value as Postgres
+    ('x' || substr(md5(text), 1, 16))::bit(64)::bigint
+    """
+    return int.from_bytes(
+        md5(plain_text.encode()).digest()[:8], byteorder="big", signed=True
+    )
+
+
+def json_contains(document: typing.Optional[dict], segment: dict) -> bool:
+    """Top-level `@>` of Postgres jsonb: the document has all pairs of segment."""
+    if not document:
+        return False
+
+    return all(
+        key in document and document[key] == value for key, value in segment.items()
+    )
+
+
+def percentile(values: typing.List[float], percent: float) -> typing.Optional[float]:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+def calculate_file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    file_hash = blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded mapping which forgets an entry `ttl` seconds after it was set.
+    When `maxsize` is reached the oldest entries are evicted first.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+
+        if item is None:
+            return default
+
+        expires_at, value = item
+        if expires_at <= monotonic():
+            del self._data[key]
+            return default
+
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        now = monotonic()
+
+        self._data.pop(key, None)
+        self._data[key] = (now + self.ttl, value)
+
+        # Entries are ordered by expiration time, because all of them have the same ttl
+        while self._data:
+            oldest_key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now and len(self._data) <= self.maxsize:
+                break
+            del self._data[oldest_key]
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+
+        if item is None or item[0] <= monotonic():
+            return default
+
+        return item[1]
+
+    def clear(self):
+        self._data.clear()
@@ -6,7 +6,7 @@ from .exceptions import (
     QuestionParameterWrongType,
     QuestionWrongAnswer,
 )
-from .helpers import markdown_to_plain_text
+from .helpers import calculate_question_id, markdown_to_plain_text
 
 ANY = typing.TypeVar('ANY')
 
@@ -54,6 +54,7 @@ class Question:
 
         self.topic = topic
         self.plain_text = markdown_to_plain_text(topic)
+        self.id = calculate_question_id(self.plain_text)
         self.choices = choices
         self.strict_choose = strict_choose
         self.column_count = column_count
@@ -67,6 +68,22 @@ class Question:
         elif isinstance(self.choices, list):
             return self.choices
 
+    @property
+    def layout(self) -> tuple:
+        """
+        Everything that affects the way the question is rendered by services,
+        used to invalidate compiled payloads if the question was changed.
+        """
+        options = self.options
+        return (
+            self.topic,
+            tuple(options) if options else None,
+            self.strict_choose,
+            self.column_count,
+            self.inline,
+            self.single_use,
+        )
+
     def _validate_choices(self, choices) -> bool:
         if choices == ANY:
             return True
@@ -1,4 +1,17 @@
+from .broadcast import Broadcaster
+from .loopback import LoopbackService, LoopbackSettings
+from .sharding import ShardedRunner
 from .telegram import TelegramService, TelegramSettings
-from .viber import ViberService, ViberSettings
+from .viber import ViberService, ViberSettings, ViberShardRouter
 
-__all__ = ["TelegramService", "TelegramSettings", "ViberService", "ViberSettings"]
+__all__ = [
+    "Broadcaster",
+    "LoopbackService",
+    "LoopbackSettings",
+    "ShardedRunner",
+    "TelegramService",
+    "TelegramSettings",
+    "ViberService",
+    "ViberSettings",
+    "ViberShardRouter",
+]
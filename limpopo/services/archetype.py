@@ -1,18 +1,22 @@
 import asyncio
 import logging
 import typing
+import weakref
 from abc import ABCMeta, abstractmethod
-from asyncio import CancelledError, Queue, TimeoutError, create_task, wait_for
+from asyncio import CancelledError, Queue, TimeoutError, create_task
 from copy import copy
 from dataclasses import dataclass
+from time import monotonic
 
 from tenacity import RetryError
 
 from .. import const
 from ..dto import Answer, Message, Respondent
 from ..exceptions import DialogStopped, QuestionWrongAnswer, SettingsError
-from ..helpers import calculate_functions_hash, with_retry
+from ..helpers import TTLCache, calculate_functions_hash, with_retry
 from ..question import Question
+from .scheduler import OutboundScheduler, Priority
+from .timer_wheel import TimerWheel
 
 
 class EmptySettings:
@@ -27,6 +31,17 @@ class DefaultSettings(EmptySettings):
     start_command: str = "/start"
     cancel_command: str = "/cancel"
     pause_command: str = "/pause"
+    respondent_cache_size: int = 100000
+    respondent_cache_ttl: int = 60
+    # Outbound limits, which aren't set are taken from the messenger defaults
+    send_rate: typing.Optional[float] = None
+    send_burst: typing.Optional[int] = None
+    chat_send_rate: typing.Optional[float] = None
+    chat_send_burst: typing.Optional[int] = None
+    # Dialogs waiting for an answer longer are dropped from memory, not closed
+    idle_timeout: typing.Optional[int] = None
+    # Name of the quiz in storage counters, the quiz function name by default
+    quiz_name: typing.Optional[str] = None
 
     def __post_init__(self):
         super().__post_init__()
@@ -56,8 +71,52 @@ class DefaultSettings(EmptySettings):
                 "Settings field `pause_command` must be of the str type"
             )
 
+        if not isinstance(self.respondent_cache_size, int):
+            raise SettingsError(
+                "Settings field `respondent_cache_size` must be of the int type"
+            )
+
+        if not isinstance(self.respondent_cache_ttl, int):
+            raise SettingsError(
+                "Settings field `respondent_cache_ttl` must be of the int type"
+            )
+
+        for field in ("send_rate", "send_burst", "chat_send_rate", "chat_send_burst"):
+            value = getattr(self, field)
+            if value is not None and not (
+                isinstance(value, (int, float)) and value > 0
+            ):
+                raise SettingsError(
+                    "Settings field `{}` must be a positive number".format(field)
+                )
+
+        if not (self.idle_timeout is None or isinstance(self.idle_timeout, int)):
+            raise SettingsError(
+                "Settings field `idle_timeout` must be of the int type or None"
+            )
+
+        if not (self.quiz_name is None or isinstance(self.quiz_name, str)):
+            raise SettingsError(
+                "Settings field `quiz_name` must be of the str type or None"
+            )
+
+    @property
+    def send_limits(self) -> tuple:
+        return (
+            self.send_rate,
+            self.send_burst,
+            self.chat_send_rate,
+            self.chat_send_burst,
+        )
+
+
+UNKNOWN = object()
+ANSWER_TIMEOUT = object()
+
 
 class ArchetypeService(metaclass=ABCMeta):
+    default_send_limits = const.TELEGRAM_SEND_LIMITS
+
     def __init__(self, quiz, storage, settings, cls_dialog, *args, **kwargs):
         if not isinstance(settings, DefaultSettings):
             raise SettingsError(
@@ -66,11 +125,151 @@ class ArchetypeService(metaclass=ABCMeta):
 
         self.dialogs = {}
         self.quiz = quiz
+        self.quiz_name = settings.quiz_name or quiz.__name__
         self.storage = storage
         self.settings = settings
         self.cls_dialog = cls_dialog
 
+        # (respondent_id, messenger, on_pause) -> id of the last open dialog or None
+        self.respondent_states = TTLCache(
+            settings.respondent_cache_size, settings.respondent_cache_ttl
+        )
+
+        self.send_limits = tuple(
+            default if value is None else value
+            for value, default in zip(settings.send_limits, self.default_send_limits)
+        )
+        self.scheduler = OutboundScheduler(*self.send_limits)
+
+        # Answer timeouts of all dialogs share one timer
+        self.answer_deadlines = TimerWheel()
+
+        # question -> (question.layout, compiled payload)
+        self._question_payloads = weakref.WeakKeyDictionary()
+
+        self._idle_sweeper = None
+
+    async def wait_send_slot(
+        self, respondent_id, priority: Priority = Priority.interactive
+    ) -> float:
+        """
+        Waits until a message to the respondent can be sent without exceeding
+        messenger limits. The queueing delay is returned and saved to
+        `last_send_delay` of the respondent's dialog.
+        """
+        dialog = self.dialogs.get(str(respondent_id))
+
+        if dialog is not None and dialog.reserved_send_slots:
+            dialog.reserved_send_slots -= 1
+            return 0
+
+        delay = await self.scheduler.acquire(respondent_id, priority)
+
+        if delay:
+            if dialog is not None:
+                dialog.last_send_delay = delay
+
+            logging.debug(
+                "Message to respondent #{} was queued for {:.3f} sec.".format(
+                    respondent_id, delay
+                )
+            )
+
+        return delay
+
+    def share_send_limits(self, shares: int):
+        """
+        Splits the global send rate between `shares` processes sending
+        messages on behalf of the same bot. Per-chat limits stay intact,
+        since a chat is served by one process only.
+        """
+        rate, burst, chat_rate, chat_burst = self.send_limits
+        self.scheduler = OutboundScheduler(
+            rate / shares, max(1, burst // shares), chat_rate, chat_burst
+        )
+
+    def get_question_payload(self, question: Question, compile_question):
+        """
+        Returns the wire payload of the question, compiled by `compile_question`
+        once and shared by all dialogs. The payload mustn't be mutated.
+        """
+        layout = question.layout
+        cached = self._question_payloads.get(question)
+
+        if cached is None or cached[0] != layout:
+            cached = (layout, compile_question(question))
+            self._question_payloads[question] = cached
+
+        return cached[1]
+
+    def get_cached_dialog_id(self, respondent_id: str, on_pause=None):
+        """
+        Returns the id of the last open dialog of the respondent, None if the
+        respondent doesn't have such dialog or UNKNOWN if it isn't cached.
+        """
+        return self.respondent_states.get((respondent_id, self.type, on_pause), UNKNOWN)
+
+    def cache_dialog_id(
+        self, respondent_id: str, dialog_id: typing.Optional[int], on_pause=None
+    ):
+        self.respondent_states.set((respondent_id, self.type, on_pause), dialog_id)
+
+    def forget_respondent_state(self, respondent_id: str):
+        self.respondent_states.pop((respondent_id, self.type, None))
+        self.respondent_states.pop((respondent_id, self.type, True))
+
+    def dehydrate_dialog(self, respondent_id: str):
+        """
+        Drops the dialog from memory, but keeps it open in the storage,
+        so it's restored on the next message of the respondent.
+        """
+        dialog = self.dialogs.pop(respondent_id, None)
+
+        if dialog and dialog.task:
+            logging.info("Dialog #{} dehydrated".format(dialog.id))
+            dialog.task.cancel()
+
+    def dehydrate_idle_dialogs(self) -> int:
+        deadline = monotonic() - self.settings.idle_timeout
+        idle = [
+            respondent_id
+            for respondent_id, dialog in self.dialogs.items()
+            if dialog.is_idle(deadline)
+        ]
+
+        for respondent_id in idle:
+            self.dehydrate_dialog(respondent_id)
+
+        return len(idle)
+
+    async def _sweep_idle_dialogs(self):
+        while 1:
+            await asyncio.sleep(max(self.settings.idle_timeout / 2, 1))
+
+            try:
+                dehydrated = self.dehydrate_idle_dialogs()
+            except Exception:
+                logging.exception("Catch exception in _sweep_idle_dialogs:")
+            else:
+                if dehydrated:
+                    logging.info("{} idle dialogs dehydrated".format(dehydrated))
+
+    def start_idle_sweeper(self):
+        if self.settings.idle_timeout is not None and self._idle_sweeper is None:
+            self._idle_sweeper = asyncio.ensure_future(self._sweep_idle_dialogs())
+
+    def stop_idle_sweeper(self):
+        if self._idle_sweeper is not None:
+            self._idle_sweeper.cancel()
+            self._idle_sweeper = None
+
     async def run_quiz(self, dialog):
+        # The dialog may be dehydrated or closed before the task is started,
+        # then it's restored from the storage on the next message
+        if self.dialogs.get(dialog.respondent.id) is not dialog:
+            logging.info("Dialog #{} dropped before start".format(dialog.id))
+            return
+
         logging.info("Task for dialog #{} started".format(dialog.id))
 
         try:
@@ -91,6 +290,8 @@ class ArchetypeService(metaclass=ABCMeta):
         self, respondent_id: str, is_complete: typing.Optional[bool]
     ):
         dialog = self.dialogs.pop(respondent_id, None)
+        self.forget_respondent_state(respondent_id)
+
         if dialog:
             if dialog.task:
                 logging.info("Dialog #{} task cancelling".format(dialog.id))
@@ -130,6 +331,9 @@ class ArchetypeService(metaclass=ABCMeta):
 
         self.dialogs[respondent.id] = dialog
 
+        self.forget_respondent_state(respondent.id)
+        self.cache_dialog_id(respondent.id, identifier)
+
         logging.info(
             "New dialog #{} was created for respondent #{}".format(
                 identifier, respondent.id
@@ -178,10 +382,31 @@ class ArchetypeDialog(metaclass=ABCMeta):
         self.prepared_questions = prepared_questions or {}
         self.called_functions = called_functions or set()
         self.answer_timeout = answer_timeout
+        self.last_send_delay = 0
+        # Send slots acquired in advance, e.g. by a broadcast for the first question
+        self.reserved_send_slots = 0
+        self.last_activity = monotonic()
 
         self._queue_answers = Queue(10)
         self._restore_mode = False
         self._repeat_last_question = False
+        self._waiting_answer = False
+
+    def is_idle(self, deadline: float) -> bool:
+        """
+        Whether the dialog waits for an answer since before the deadline,
+        such a dialog can be dropped from memory and restored later.
+        """
+        return (
+            self._waiting_answer
+            and self._queue_answers.empty()
+            and self.last_activity < deadline
+        )
+
+    def _expire_answer(self):
+        # A message already in the queue answers the question in time
+        if self._waiting_answer and self._queue_answers.empty():
+            self._queue_answers.put_nowait(ANSWER_TIMEOUT)
 
     def set_restore_mode(self):
         self._restore_mode = True
@@ -206,8 +431,8 @@ class ArchetypeDialog(metaclass=ABCMeta):
     async def ask(self, question: Question) -> Answer:
         self.answer.clear()
 
-        if question.plain_text in self.prepared_questions:
-            answer_text = self.prepared_questions[question.plain_text]
+        if question.id in self.prepared_questions:
+            answer_text = self.prepared_questions[question.id]
             self.answer.set(answer_text)
             return copy(self.answer)
 
@@ -221,7 +446,19 @@ class ArchetypeDialog(metaclass=ABCMeta):
 
         while 1:
             try:
-                message = await wait_for(self._queue_answers.get(), self.answer_timeout)
+                self.last_activity = monotonic()
+                self._waiting_answer = True
+                self.service.answer_deadlines.add(
+                    self, self.answer_timeout, self._expire_answer
+                )
+                try:
+                    message = await self._queue_answers.get()
+                finally:
+                    self._waiting_answer = False
+                    self.service.answer_deadlines.discard(self)
+
+                if message is ANSWER_TIMEOUT:
+                    raise TimeoutError()
 
                 if message.id < self.last_question_id:
                     continue
@@ -277,10 +514,12 @@ class ArchetypeDialog(metaclass=ABCMeta):
                 return func(*args, **kwargs)
 
     async def handle_message(self, message: Message):
+        self.last_activity = monotonic()
         await self._queue_answers.put(message)
 
     async def pause(self):
         done = await self.service.storage.pause(self)
+        self.service.forget_respondent_state(self.respondent.id)
 
         if done:
             logging.info("Dialog #{} on pause".format(self.id))
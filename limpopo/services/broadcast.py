@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import typing
+from collections import deque
+
+from ..dto import BroadcastProgress, Respondent
+from .archetype import UNKNOWN, ArchetypeService
+from .scheduler import Priority
+
+
+class Broadcaster:
+    """
+    Starts the quiz for respondents stored by the service storage, e.g. to
+    invite them to a new survey.
+
+    Respondents are streamed from the storage and invited as fast as the
+    messenger limits of the service allow, with bulk priority. The progress
+    is saved under `name`, so an interrupted broadcast continues from the
+    last invited respondent when it is run again. Failed invitations are
+    saved too and retried first by the next run.
+    """
+
+    def __init__(
+        self,
+        service: ArchetypeService,
+        name: str,
+        segment: typing.Optional[dict] = None,
+        concurrency: int = 100,
+        save_progress_every: int = 100,
+    ):
+        self.service = service
+        self.storage = service.storage
+        self.name = name
+        self.segment = segment
+        self.concurrency = concurrency
+        self.save_progress_every = save_progress_every
+
+        self.progress = BroadcastProgress()
+        self.failed = 0
+
+    async def has_open_dialog(self, respondent: Respondent) -> bool:
+        """
+        Checks the dialog of the respondent in memory and the open or paused
+        dialog in the storage, e.g. dehydrated or left before a restart.
+        """
+        if respondent.id in self.service.dialogs:
+            return True
+
+        for on_pause in (None, True):
+            dialog_id = self.service.get_cached_dialog_id(
+                respondent.id, on_pause=on_pause
+            )
+
+            if dialog_id is UNKNOWN:
+                dialog_id = await self.storage.get_last_dialog_id(
+                    respondent_id=respondent.id,
+                    respondent_messenger=self.service.type,
+                    on_pause=on_pause,
+                )
+                self.service.cache_dialog_id(
+                    respondent.id, dialog_id, on_pause=on_pause
+                )
+
+            if dialog_id is not None:
+                return True
+
+        return False
+
+    async def invite(self, respondent: Respondent) -> bool:
+        if await self.has_open_dialog(respondent):
+            logging.info(
+                "Respondent #{} already has a dialog, skip invitation".format(
+                    respondent.id
+                )
+            )
+            return False
+
+        await self.service.wait_send_slot(respondent.id, Priority.bulk)
+
+        dialog = await self.service.create_dialog(respondent)
+        dialog.reserved_send_slots += 1
+        asyncio.ensure_future(self.service.run_quiz(dialog))
+
+        return True
+
+    async def _invite(self, respondent: Respondent, semaphore: asyncio.Semaphore):
+        try:
+            if await self.invite(respondent):
+                self.progress.invited += 1
+        except Exception:
+            self.failed += 1
+            self.progress.failed.append(respondent.id)
+            logging.exception(
+                "Catch exception in invite of respondent #{}:".format(respondent.id)
+            )
+        finally:
+            semaphore.release()
+
+    async def save_progress(self):
+        await self.storage.save_broadcast_progress(
+            self.name, self.service.type, self.progress
+        )
+
+    async def retry_failed(self, semaphore: asyncio.Semaphore):
+        failed, self.progress.failed = self.progress.failed, []
+
+        logging.info(
+            "Broadcast {} retries {} failed invitations".format(self.name, len(failed))
+        )
+
+        tasks = []
+        for respondent_id in failed:
+            await semaphore.acquire()
+            respondent = Respondent(id=respondent_id, messenger=self.service.type)
+            tasks.append(asyncio.ensure_future(self._invite(respondent, semaphore)))
+
+        await asyncio.gather(*tasks)
+        await self.save_progress()
+
+    async def run(self) -> BroadcastProgress:
+        progress = await self.storage.get_broadcast_progress(
+            self.name, self.service.type
+        )
+
+        if progress is not None:
+            self.progress = progress
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        if self.progress.failed:
+            await self.retry_failed(semaphore)
+
+        if self.progress.finished:
+            logging.info(
+                "Broadcast {} is finished, {} invitations failed".format(
+                    self.name, len(self.progress.failed)
+                )
+            )
+            return self.progress
+
+        logging.info(
+            "Broadcast {} started after respondent #{}".format(
+                self.name, self.progress.cursor
+            )
+        )
+
+        # Invitations in the order of respondents, the cursor is moved only
+        # over the invitations, which are done with all preceding ones
+        pending = deque()
+        processed = 0
+
+        async for respondent in self.storage.iter_respondents(
+            self.service.type, after_id=self.progress.cursor, segment=self.segment
+        ):
+            await semaphore.acquire()
+            task = asyncio.ensure_future(self._invite(respondent, semaphore))
+            pending.append((respondent.id, task))
+
+            while pending and pending[0][1].done():
+                self.progress.cursor = pending.popleft()[0]
+                processed += 1
+
+                if processed % self.save_progress_every == 0:
+                    await self.save_progress()
+
+        for respondent_id, task in pending:
+            await task
+            self.progress.cursor = respondent_id
+
+        self.progress.finished = True
+        await self.save_progress()
+
+        logging.info(
+            "Broadcast {} finished: {} respondents invited, {} failed".format(
+                self.name, self.progress.invited, self.failed
+            )
+        )
+
+        return self.progress
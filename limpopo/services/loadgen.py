@@ -0,0 +1,428 @@
+"""
+Load generator running virtual respondents through a quiz in-process with
+`LoopbackService`:
+
+    python -m limpopo.services.loadgen examples.yesno.poll:quiz \
+        --respondents 1000 --think-time 0.5 --wrong-rate 0.1 \
+        --pause-rate 0.05 --cancel-rate 0.02 --restart-every 10
+
+Reports throughput, latency from an answer to the next question, storage
+calls and memory per dialog. The storage is in memory by default, pass
+`--storage sqlite:PATH` or a `postgresql+asyncpg://` URI to include it.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import typing
+from collections import Counter
+from dataclasses import dataclass
+from time import monotonic
+
+from .. import const
+from ..helpers import percentile
+from .loopback import Closed, LoopbackService, LoopbackSettings
+
+FREE_TEXT_ANSWER = "Load test answer"
+WRONG_ANSWER = "Load test wrong answer"
+
+
+class CountingStorage:
+    """Proxies a storage and counts calls and time of its methods."""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.calls = Counter()
+        self.seconds = Counter()
+
+    def __getattr__(self, name):
+        value = getattr(self._storage, name)
+
+        if not callable(value):
+            return value
+
+        if not asyncio.iscoroutinefunction(value):
+
+            def counted(*args, **kwargs):
+                self.calls[name] += 1
+                return value(*args, **kwargs)
+
+            return counted
+
+        async def timed(*args, **kwargs):
+            self.calls[name] += 1
+            started_at = monotonic()
+
+            try:
+                return await value(*args, **kwargs)
+            finally:
+                self.seconds[name] += monotonic() - started_at
+
+        return timed
+
+
+def get_rss() -> int:
+    """Returns resident memory of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # Peak instead of current RSS, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@dataclass
+class LoadProfile:
+    respondents: int = 100
+    # Respondents are started evenly during `ramp_up` seconds
+    ramp_up: float = 0
+    # Mean of exponentially distributed pauses before every answer, seconds
+    think_time: float = 0
+    # Probabilities of an action instead of the answer to a question
+    wrong_rate: float = 0
+    pause_rate: float = 0
+    cancel_rate: float = 0
+    # Seconds between restarts of the service, None disables restarts
+    restart_every: typing.Optional[float] = None
+    # A respondent resends the start or the answer once if the reply doesn't
+    # come in time
+    reply_timeout: float = 30
+    sample_interval: float = 0.5
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        service: LoopbackService,
+        profile: LoadProfile,
+        storage: typing.Optional[CountingStorage] = None,
+        seed: typing.Optional[int] = None,
+    ):
+        self.service = service
+        self.profile = profile
+        self.storage = storage
+        self.random = random.Random(seed)
+
+        self.latencies = []
+        self.events = Counter()
+        self.peak_dialogs = 0
+        self.peak_rss = 0
+
+    async def _think(self):
+        if self.profile.think_time > 0:
+            await asyncio.sleep(self.random.expovariate(1 / self.profile.think_time))
+
+    async def _receive(self, inbox: asyncio.Queue):
+        try:
+            return await asyncio.wait_for(inbox.get(), self.profile.reply_timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _answer(self, respondent_id: str, question) -> str:
+        if question.options:
+            answer = self.random.choice(question.options)
+        else:
+            answer = FREE_TEXT_ANSWER
+
+        self.events["answers"] += 1
+        await self.service.handle_message(respondent_id, answer)
+
+        return answer
+
+    async def _respondent(self, index: int):
+        profile = self.profile
+        respondent_id = "loadgen-{}".format(index)
+        inbox = self.service.connect(respondent_id)
+
+        await asyncio.sleep(profile.ramp_up * index / profile.respondents)
+        await self.service.handle_start(respondent_id)
+
+        question = None
+        last_answer = None
+        answered_at = None
+        paused = False
+        retried = False
+        # No question is received since the last start
+        starting = True
+
+        while 1:
+            delivery = await self._receive(inbox)
+
+            if delivery is None:
+                self.events["timeouts"] += 1
+
+                # The start or the answer may be lost by a restart, it's sent
+                # once more
+                if retried or (not starting and last_answer is None):
+                    self.events["stalled"] += 1
+                    break
+
+                retried = True
+                answered_at = None
+
+                # Respondents who lost replies to a restart don't resend at once
+                await asyncio.sleep(self.random.uniform(0, profile.reply_timeout / 2))
+
+                if starting:
+                    await self.service.handle_start(respondent_id)
+                else:
+                    await self.service.handle_message(respondent_id, last_answer)
+
+                continue
+
+            retried = False
+
+            if isinstance(delivery, Closed):
+                if paused:
+                    paused = False
+                    starting = True
+                    await self._think()
+                    await self.service.handle_start(respondent_id)
+                    continue
+
+                if delivery.is_complete:
+                    self.events["completed"] += 1
+                elif delivery.is_complete is None:
+                    self.events["expired"] += 1
+
+                break
+
+            if delivery.text == const.WRONG_ANSWER_FORMAT and question is not None:
+                answered_at = monotonic()
+                last_answer = await self._answer(respondent_id, question)
+                continue
+
+            if not delivery.is_question:
+                continue
+
+            if answered_at is not None:
+                self.latencies.append(monotonic() - answered_at)
+                answered_at = None
+
+            starting = False
+            question = delivery
+            await self._think()
+
+            roll = self.random.random()
+
+            if roll < profile.cancel_rate:
+                self.events["cancelled"] += 1
+                await self.service.handle_cancel(respondent_id)
+            elif roll < profile.cancel_rate + profile.pause_rate:
+                self.events["paused"] += 1
+                paused = True
+                await self.service.handle_pause(respondent_id)
+            elif question.options and self.random.random() < profile.wrong_rate:
+                self.events["wrong_answers"] += 1
+                await self.service.handle_message(respondent_id, WRONG_ANSWER)
+            else:
+                answered_at = monotonic()
+                last_answer = await self._answer(respondent_id, question)
+
+        self.service.disconnect(respondent_id)
+
+    async def _restart_periodically(self):
+        while 1:
+            await asyncio.sleep(self.profile.restart_every)
+            self.events["restarts"] += 1
+            self.service.restart()
+
+    async def _sample(self):
+        while 1:
+            self.peak_dialogs = max(self.peak_dialogs, len(self.service.dialogs))
+            self.peak_rss = max(self.peak_rss, get_rss())
+            await asyncio.sleep(self.profile.sample_interval)
+
+    async def run(self) -> dict:
+        baseline_rss = get_rss()
+        background = [asyncio.ensure_future(self._sample())]
+
+        if self.profile.restart_every:
+            background.append(asyncio.ensure_future(self._restart_periodically()))
+
+        started_at = monotonic()
+
+        try:
+            await asyncio.gather(
+                *(self._respondent(index) for index in range(self.profile.respondents))
+            )
+        finally:
+            for task in background:
+                task.cancel()
+
+        duration = monotonic() - started_at
+
+        return self.report(duration, baseline_rss)
+
+    def report(self, duration: float, baseline_rss: int) -> dict:
+        latencies = sorted(self.latencies)
+        growth = max(0, self.peak_rss - baseline_rss)
+
+        report = {
+            "respondents": self.profile.respondents,
+            "duration": duration,
+            "answers_per_sec": self.events["answers"] / duration,
+            "dialogs_per_sec": self.events["completed"] / duration,
+            "latency": {
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+            },
+            "events": dict(self.events),
+            "peak_dialogs": self.peak_dialogs,
+            "rss": {
+                "baseline": baseline_rss,
+                "peak": self.peak_rss,
+                "per_dialog": growth / self.peak_dialogs if self.peak_dialogs else None,
+            },
+        }
+
+        if self.storage is not None:
+            report["storage"] = {
+                name: {"calls": calls, "seconds": self.storage.seconds[name]}
+                for name, calls in sorted(self.storage.calls.items())
+            }
+
+        return report
+
+
+def load_quiz(spec: str) -> typing.Callable:
+    """Imports the quiz by `module:function`."""
+    module_name, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), name or "quiz")
+
+
+def create_storage(spec: str):
+    from ..storages import InMemoryStorage, PostgreStorage, SQLiteStorage
+
+    if spec == "memory":
+        return InMemoryStorage()
+    elif spec.startswith("sqlite:"):
+        return SQLiteStorage(spec[len("sqlite:") :])
+
+    return PostgreStorage(spec)
+
+
+def format_report(report: dict) -> str:
+    def ms(value):
+        return "-" if value is None else "{:.1f} ms".format(value * 1000)
+
+    lines = [
+        "Respondents: {respondents}, duration: {duration:.1f} sec.".format(**report),
+        "Throughput: {:.1f} answers/sec., {:.1f} dialogs/sec.".format(
+            report["answers_per_sec"], report["dialogs_per_sec"]
+        ),
+        "Answer -> next question: p50 {}, p99 {}, max {}".format(
+            ms(report["latency"]["p50"]),
+            ms(report["latency"]["p99"]),
+            ms(report["latency"]["max"]),
+        ),
+        "Events: {}".format(
+            ", ".join(
+                "{} {}".format(name, count)
+                for name, count in sorted(report["events"].items())
+            )
+        ),
+        "Peak dialogs in memory: {}".format(report["peak_dialogs"]),
+        "RSS: baseline {:.1f} MiB, peak {:.1f} MiB, {} per dialog".format(
+            report["rss"]["baseline"] / 2 ** 20,
+            report["rss"]["peak"] / 2 ** 20,
+            "-"
+            if report["rss"]["per_dialog"] is None
+            else "{:.1f} KiB".format(report["rss"]["per_dialog"] / 1024),
+        ),
+    ]
+
+    for name, stats in report.get("storage", {}).items():
+        lines.append(
+            "Storage {}: {} calls, {} avg".format(
+                name,
+                stats["calls"],
+                ms(stats["seconds"] / stats["calls"]) if stats["seconds"] else "-",
+            )
+        )
+
+    return "\n".join(lines)
+
+
+async def run(args) -> dict:
+    storage = CountingStorage(create_storage(args.storage))
+    settings = LoopbackSettings(
+        answer_timeout=args.answer_timeout, idle_timeout=args.idle_timeout
+    )
+    service = LoopbackService(load_quiz(args.quiz), storage, settings)
+    service_task = asyncio.ensure_future(service.run_forever())
+
+    profile = LoadProfile(
+        respondents=args.respondents,
+        ramp_up=args.ramp_up,
+        think_time=args.think_time,
+        wrong_rate=args.wrong_rate,
+        pause_rate=args.pause_rate,
+        cancel_rate=args.cancel_rate,
+        restart_every=args.restart_every,
+        reply_timeout=args.reply_timeout,
+    )
+
+    try:
+        return await LoadGenerator(service, profile, storage, seed=args.seed).run()
+    finally:
+        await service.stop()
+        await service_task
+
+        await storage.flush()
+
+        if hasattr(storage, "close"):
+            storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m limpopo.services.loadgen",
+        description="Runs virtual respondents through a quiz in-process",
+    )
+    parser.add_argument("quiz", help="quiz function as module:function")
+    parser.add_argument("--respondents", type=int, default=100)
+    parser.add_argument("--ramp-up", type=float, default=0, help="seconds")
+    parser.add_argument(
+        "--think-time", type=float, default=0, help="mean seconds before an answer"
+    )
+    parser.add_argument("--wrong-rate", type=float, default=0)
+    parser.add_argument("--pause-rate", type=float, default=0)
+    parser.add_argument("--cancel-rate", type=float, default=0)
+    parser.add_argument(
+        "--restart-every", type=float, default=None, help="seconds between restarts"
+    )
+    parser.add_argument("--reply-timeout", type=float, default=30, help="seconds")
+    parser.add_argument("--answer-timeout", type=int, default=const.ANSWER_TIMEOUT)
+    parser.add_argument("--idle-timeout", type=int, default=None)
+    parser.add_argument(
+        "--storage",
+        default="memory",
+        help="memory, sqlite:PATH or a postgresql+asyncpg:// URI",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", help="path to write the report as JSON")
+    parser.add_argument("--log-level", default="WARNING")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(run(args))
+
+    print(format_report(report))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+import asyncio
+import itertools
+import logging
+import typing
+from dataclasses import dataclass
+
+from tenacity import RetryError
+
+from .. import const
+from ..dto import Message, Messengers, Respondent
+from ..exceptions import SettingsError
+from ..helpers import with_retry
+from ..markdown_message import MarkdownMessage
+from ..storages.archetype import ArchetypeStorage
+from ..video import Video
+from .archetype import UNKNOWN, ArchetypeDialog, ArchetypeService, DefaultSettings
+from .scheduler import Priority
+
+
+@dataclass
+class LoopbackSettings(DefaultSettings):
+    # Messenger of respondents in the storage
+    messenger: Messengers = Messengers.telegram
+
+    def __post_init__(self):
+        super().__post_init__()
+
+        if not isinstance(self.messenger, Messengers):
+            raise SettingsError(
+                "LoopbackSettings field `messenger` must be a Messengers member"
+            )
+
+
+@dataclass
+class Delivery:
+    """A message sent by the service to a respondent."""
+
+    id: int
+    text: str
+    options: typing.Optional[typing.List[str]] = None
+    is_question: bool = False
+
+
+@dataclass
+class Closed:
+    """Put to the inbox when the dialog of the respondent is closed."""
+
+    # None if the dialog timed out or was paused
+    is_complete: typing.Optional[bool]
+
+
+class LoopbackDialog(ArchetypeDialog):
+    def prepare_question(self, question) -> dict:
+        return self.service.get_question_payload(question, self.compile_question)
+
+    @staticmethod
+    def compile_question(question) -> dict:
+        return {"text": question.topic, "options": question.options}
+
+    def prepare_answer(self, question, answer):
+        return answer
+
+
+class LoopbackService(ArchetypeService):
+    """
+    Delivers messages in-process instead of a messenger: respondents are
+    connected by `connect`, which returns the inbox with `Delivery` of every
+    message sent to them, and talk to the service with `handle_start`,
+    `handle_message`, `handle_pause` and `handle_cancel`.
+
+    Used to run quizzes in tests and load tests, see `loadgen`.
+    """
+
+    type = Messengers.telegram
+    default_send_limits = const.LOOPBACK_SEND_LIMITS
+
+    def __init__(
+        self,
+        quiz: typing.Callable[[LoopbackDialog], None],
+        storage: ArchetypeStorage,
+        settings: typing.Optional[LoopbackSettings] = None,
+        cls_dialog: LoopbackDialog = LoopbackDialog,
+        *args,
+        **kwargs
+    ):
+        super().__init__(quiz, storage, settings or LoopbackSettings(), cls_dialog)
+        self.type = self.settings.messenger
+
+        # respondent id -> Queue of deliveries
+        self.inboxes = {}
+
+        # Ids of incoming and outgoing messages grow together, like in chats
+        self._message_ids = itertools.count(1)
+        self._stopped = None
+
+    def connect(self, respondent_id: str) -> asyncio.Queue:
+        inbox = self.inboxes.get(respondent_id)
+
+        if inbox is None:
+            inbox = self.inboxes[respondent_id] = asyncio.Queue()
+
+        return inbox
+
+    def disconnect(self, respondent_id: str):
+        self.inboxes.pop(respondent_id, None)
+
+    def _deliver(self, respondent_id: str, item):
+        inbox = self.inboxes.get(respondent_id)
+
+        if inbox is not None:
+            inbox.put_nowait(item)
+
+    async def restore_dialog(
+        self, respondent_id: str, repeat_last_question=False
+    ) -> typing.Optional[LoopbackDialog]:
+        if self.get_cached_dialog_id(respondent_id) is None:
+            logging.info(
+                "Respondent #{} doesn't have any dialogs".format(respondent_id)
+            )
+            return
+
+        try:
+            bundle = await with_retry(
+                lambda: self.storage.restore_bundle(
+                    respondent_id=respondent_id, respondent_messenger=self.type
+                ),
+                exceptions=self.storage.io_exceptions,
+                stop_callback_coro=self.stop,
+            )
+        except RetryError:
+            logging.error("Can't restore dialog due to Storage IO error")
+            return
+
+        if bundle is None:
+            self.cache_dialog_id(respondent_id, None)
+            logging.info(
+                "Respondent #{} doesn't have any dialogs".format(respondent_id)
+            )
+            return
+
+        dialog = await self.create_dialog(
+            Respondent(id=respondent_id, messenger=self.type),
+            identifier=bundle.dialog_id,
+            prepared_questions={q: a for q, a in bundle.messages},
+            called_functions=set(bundle.called_functions),
+            repeat_last_question=repeat_last_question,
+        )
+
+        asyncio.ensure_future(self.run_quiz(dialog))
+
+        return dialog
+
+    async def get_or_restore_dialog(
+        self, respondent_id: str
+    ) -> typing.Optional[LoopbackDialog]:
+        if respondent_id in self.dialogs:
+            return self.dialogs[respondent_id]
+
+        dialog = await self.restore_dialog(respondent_id)
+
+        if dialog is None and self.settings.reply_without_dialogue:
+            foreword_message = const.FOREWORD.format(
+                start_command=self.settings.start_command
+            )
+            await self.send_message(respondent_id, foreword_message)
+        else:
+            return dialog
+
+    async def cancel_pause(self, respondent_id: str) -> typing.Optional[bool]:
+        try:
+            last_dialog_id = self.get_cached_dialog_id(respondent_id, on_pause=True)
+
+            if last_dialog_id is UNKNOWN:
+                last_dialog_id = await with_retry(
+                    lambda: self.storage.get_last_dialog_id(
+                        respondent_id=respondent_id,
+                        respondent_messenger=self.type,
+                        on_pause=True,
+                    ),
+                    exceptions=self.storage.io_exceptions,
+                    stop_callback_coro=self.stop,
+                )
+                self.cache_dialog_id(respondent_id, last_dialog_id, on_pause=True)
+
+            if last_dialog_id is None:
+                return
+
+            cancelled = await with_retry(
+                lambda: self.storage.cancel_pause(last_dialog_id),
+                exceptions=self.storage.io_exceptions,
+                stop_callback_coro=self.stop,
+            )
+            self.forget_respondent_state(respondent_id)
+
+            return cancelled
+        except RetryError:
+            logging.error("Can't restore dialog on pause due to Storage IO error")
+            return
+
+    async def handle_start(self, respondent_id: str):
+        """Starts a dialog or resumes the paused one, doesn't wait for the quiz."""
+        dialog = self.dialogs.get(respondent_id)
+
+        # The question of a dialog dropped by a restart may be lost, it's
+        # repeated as the respondent starts again
+        if dialog is None:
+            dialog = await self.restore_dialog(respondent_id, repeat_last_question=True)
+
+        if dialog:
+            logging.info(
+                "Respondent #{} try to start already started dialog".format(
+                    respondent_id
+                )
+            )
+            return
+
+        if await self.cancel_pause(respondent_id):
+            await self.send_message(respondent_id, const.PAUSE_CANCELLED)
+            await self.restore_dialog(respondent_id, repeat_last_question=True)
+        else:
+            dialog = await self.create_dialog(
+                Respondent(id=respondent_id, messenger=self.type)
+            )
+            asyncio.ensure_future(self.run_quiz(dialog))
+
+    async def handle_message(self, respondent_id: str, text: str):
+        dialog = await self.get_or_restore_dialog(respondent_id)
+
+        if dialog is not None:
+            await dialog.handle_message(Message(next(self._message_ids), text))
+
+    async def handle_pause(self, respondent_id: str):
+        dialog = await self.get_or_restore_dialog(respondent_id)
+
+        if dialog is None:
+            return
+
+        await self.close_dialog(respondent_id, is_complete=None)
+        await dialog.pause()
+        await self.send_message(respondent_id, const.DIALOG_ON_PAUSE)
+
+    async def handle_cancel(self, respondent_id: str):
+        dialog = await self.get_or_restore_dialog(respondent_id)
+
+        if dialog is None:
+            await self.send_message(respondent_id, const.SESSION_DOESNT_EXIST)
+            return
+
+        await self.close_dialog(respondent_id, is_complete=False)
+
+        cancel_message = const.CANCEL.format(start_command=self.settings.start_command)
+        await self.send_message(respondent_id, cancel_message)
+
+    async def close_dialog(
+        self, respondent_id: str, is_complete: typing.Optional[bool]
+    ):
+        found = respondent_id in self.dialogs
+        await super().close_dialog(respondent_id, is_complete)
+
+        if found:
+            self._deliver(respondent_id, Closed(is_complete))
+
+    def restart(self):
+        """
+        Drops all dialogs and cached respondent states as a restart of the
+        process does, dialogs are restored on the next message.
+        """
+        for respondent_id in list(self.dialogs):
+            self.dehydrate_dialog(respondent_id)
+
+        self.respondent_states.clear()
+
+    async def send_message(
+        self,
+        user_id,
+        message,
+        keep_keyboard=False,
+        priority=Priority.interactive,
+        *args,
+        **kwargs
+    ) -> int:
+        await self.wait_send_slot(user_id, priority)
+
+        message_id = next(self._message_ids)
+
+        if isinstance(message, dict):
+            delivery = Delivery(
+                message_id, message["text"], message["options"], is_question=True
+            )
+        elif isinstance(message, MarkdownMessage):
+            delivery = Delivery(message_id, message.text)
+        elif isinstance(message, Video):
+            delivery = Delivery(message_id, message.path_to_file)
+        else:
+            delivery = Delivery(message_id, message)
+
+        self._deliver(str(user_id), delivery)
+
+        return message_id
+
+    async def stop(self):
+        self.stop_idle_sweeper()
+
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def run_forever(self):
+        self._stopped = asyncio.Event()
+
+        await self.storage.warm_up()
+        self.start_idle_sweeper()
+        await self._stopped.wait()
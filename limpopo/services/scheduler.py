@@ -0,0 +1,177 @@
+import asyncio
+import enum
+import heapq
+import itertools
+
+from ..helpers import TTLCache
+
+
+class Priority(enum.IntEnum):
+    interactive = 0  # replies to respondents, e.g. the next question
+    bulk = 1  # messages nobody is waiting for, e.g. broadcasts
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = None
+
+    def _refill(self, now: float):
+        if self.updated_at is not None:
+            elapsed = now - self.updated_at
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Returns seconds until a token is available."""
+        self._refill(now)
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutboundScheduler:
+    """
+    Orders outbound messages of a service, so a message is sent only when
+    both the bucket of its chat and the global bucket have a token.
+
+    Waiting interactive messages are released before bulk ones, a message
+    waiting for its chat bucket doesn't hold up messages to other chats.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        chat_rate: float,
+        chat_burst: int,
+        max_chats: int = 100000,
+    ):
+        self._global_bucket = TokenBucket(rate, burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+
+        # An idle bucket is full again after `chat_burst / chat_rate` seconds
+        self._chat_buckets = TTLCache(max_chats, ttl=chat_burst / chat_rate + 1)
+
+        self._waiters = []
+        # chat id -> waiters until the chat bucket has a token, and a heap of
+        # (time of the token, chat id)
+        self._parked = {}
+        self._chat_timers = []
+        self._counter = itertools.count()
+        self._timer = None
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+
+        self._chat_buckets.set(chat_id, bucket)
+
+        return bucket
+
+    def _try_take(self, chat_id, now: float) -> float:
+        """Takes tokens and returns 0 or returns seconds to wait."""
+        global_delay = self._global_bucket.delay(now)
+        chat_bucket = self._chat_bucket(chat_id)
+        delay = max(global_delay, chat_bucket.delay(now))
+
+        if delay == 0:
+            self._global_bucket.take(now)
+            chat_bucket.take(now)
+
+        return delay
+
+    async def acquire(
+        self, chat_id, priority: Priority = Priority.interactive
+    ) -> float:
+        """
+        Waits for a permission to send a message to the chat and returns
+        the queueing delay.
+        """
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        chat_id = str(chat_id)
+
+        if (
+            not self._waiters
+            and chat_id not in self._parked
+            and self._try_take(chat_id, started_at) == 0
+        ):
+            return 0
+
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), chat_id, future))
+        self._dispatch()
+
+        await future
+
+        return loop.time() - started_at
+
+    def _release_chats(self, now: float):
+        while self._chat_timers and self._chat_timers[0][0] <= now:
+            _, chat_id = heapq.heappop(self._chat_timers)
+
+            for waiter in self._parked.pop(chat_id, ()):
+                heapq.heappush(self._waiters, waiter)
+
+    def _dispatch(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        self._release_chats(now)
+
+        next_delay = float("inf")
+
+        # Waiters are served in order until the global bucket is empty, a waiter
+        # whose chat bucket is empty is parked with its chat until it is refilled
+        while self._waiters:
+            _, _, chat_id, future = waiter = self._waiters[0]
+
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            global_delay = self._global_bucket.delay(now)
+            if global_delay > 0:
+                next_delay = global_delay
+                break
+
+            heapq.heappop(self._waiters)
+
+            # Messages to a chat are sent in order
+            if chat_id in self._parked:
+                self._parked[chat_id].append(waiter)
+                continue
+
+            delay = self._try_take(chat_id, now)
+            if delay > 0:
+                self._parked[chat_id] = [waiter]
+                heapq.heappush(self._chat_timers, (now + delay, chat_id))
+                continue
+
+            future.set_result(None)
+
+        if self._chat_timers:
+            next_delay = min(next_delay, self._chat_timers[0][0] - now)
+
+        if next_delay != float("inf"):
+            self._timer = loop.call_later(next_delay, self._dispatch)
+
+    @property
+    def queue_size(self) -> int:
+        return len(self._waiters) + sum(map(len, self._parked.values()))
@@ -0,0 +1,348 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import typing
+import zlib
+from asyncio import Lock, Queue, QueueFull, Semaphore
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ..exceptions import ParameterError
+
+
+def shard_of(respondent_id, shards: int) -> int:
+    """Returns the index of the shard owning the respondent."""
+    return zlib.crc32(str(respondent_id).encode()) % shards
+
+
+class ShardChannel:
+    """
+    Worker end of a shard: updates come in as (seq, respondent id, update),
+    acknowledgements go out as seq of handled updates.
+    """
+
+    def __init__(self, updates, acks):
+        self.updates = updates
+        self.acks = acks
+
+    def recv(self) -> typing.Tuple[int, typing.Any, bytes]:
+        return self.updates.recv()
+
+    def ack(self, seq: int):
+        self.acks.send(seq)
+
+    def close(self):
+        self.updates.close()
+        self.acks.close()
+
+
+async def receive_updates(channel: ShardChannel, handle_update):
+    """
+    Reads updates routed to a worker by `ShardedRunner` and passes them to
+    `handle_update`. Updates of different respondents are handled
+    concurrently, updates of a respondent one by one, in order. An update is
+    acknowledged once it's handled. Returns when the supervisor closes the
+    channel and received updates are handled.
+    """
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-inbox")
+    # respondent id -> deque of (seq, update) waiting for the handled one
+    pending = {}
+    tasks = set()
+
+    async def handle_respondent_updates(respondent_id, queue: deque):
+        while queue:
+            seq, update = queue.popleft()
+
+            try:
+                await handle_update(update)
+            except Exception:
+                logging.exception("Catch exception in receive_updates:")
+
+            try:
+                channel.ack(seq)
+            except OSError:
+                # The supervisor is gone, it resends the update to a new worker
+                pass
+
+        del pending[respondent_id]
+
+    try:
+        while 1:
+            try:
+                seq, respondent_id, update = await loop.run_in_executor(
+                    executor, channel.recv
+                )
+            except (EOFError, OSError):
+                logging.info("Shard channel is closed by the supervisor")
+                break
+
+            queue = pending.get(respondent_id)
+
+            if queue is not None:
+                queue.append((seq, update))
+                continue
+
+            queue = pending[respondent_id] = deque([(seq, update)])
+            task = asyncio.ensure_future(
+                handle_respondent_updates(respondent_id, queue)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _run_worker(service_factory, workers: int, channel: ShardChannel):
+    service = service_factory()
+    # All workers send messages on behalf of the same bot
+    service.share_send_limits(workers)
+
+    loop = asyncio.get_event_loop()
+
+    try:
+        loop.run_until_complete(service.run_shard(channel))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(service.stop())
+
+
+class ShardedRunner:
+    """
+    Runs a service in `workers` processes and routes every update by a hash
+    of its respondent id, so a dialog always lives in the `dialogs` of
+    exactly one worker.
+
+    `service_factory` is called in every worker process to create its
+    `service_cls` service, it must be a module level callable to be
+    picklable. Only services with `run_shard`, e.g. `ViberService`, can be
+    run by workers. The number of workers is fixed, so the owner of a
+    respondent never changes: a dead worker is restarted on the same shard,
+    updates it didn't acknowledge are sent to the new worker and open dialogs
+    are restored from the storage on demand.
+
+    A worker handles at most `inbox_size` updates at once and `inbox_size`
+    more wait in the inbox of its shard, further updates are rejected.
+    """
+
+    def __init__(
+        self,
+        service_cls: type,
+        service_factory: typing.Callable[[], typing.Any],
+        workers: int,
+        inbox_size: int = 1000,
+        restart_delay: float = 1,
+    ):
+        if not callable(getattr(service_cls, "run_shard", None)):
+            raise ParameterError(
+                "{} can't run as a shard worker".format(service_cls.__name__)
+            )
+
+        self.service_cls = service_cls
+        self.service_factory = service_factory
+        self.workers = workers
+        self.inbox_size = inbox_size
+        self.restart_delay = restart_delay
+
+        self._context = multiprocessing.get_context("spawn")
+        self._shards = []
+        self._tasks = []
+        self._executor = None
+
+    def route(self, respondent_id, update: bytes) -> bool:
+        """Queues the update for the worker owning the respondent."""
+        index = shard_of(respondent_id, self.workers)
+
+        try:
+            self._shards[index].inbox.put_nowait((respondent_id, update))
+        except QueueFull:
+            logging.warning(
+                "Inbox of shard #{} is full, update is rejected".format(index)
+            )
+            return False
+
+        return True
+
+    def start(self):
+        # Every shard needs a thread to send updates and one to read acks
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers * 2, thread_name_prefix="shard-feeder"
+        )
+
+        for index in range(self.workers):
+            shard = _Shard(self, index)
+            shard.spawn()
+            self._shards.append(shard)
+            self._tasks.append(asyncio.ensure_future(shard.feed()))
+
+        self._tasks.append(asyncio.ensure_future(self._watch()))
+
+    async def _watch(self):
+        while 1:
+            await asyncio.sleep(self.restart_delay)
+
+            for shard in self._shards:
+                async with shard.lock:
+                    if not shard.process.is_alive():
+                        await shard.restart()
+
+    def stop(self, timeout: float = 10):
+        for task in self._tasks:
+            task.cancel()
+
+        # Workers stop when their channel is closed
+        for shard in self._shards:
+            shard.close()
+
+        for shard in self._shards:
+            shard.process.join(timeout)
+
+            if shard.process.is_alive():
+                logging.warning(
+                    "Shard worker #{} didn't stop in time, terminate it".format(
+                        shard.index
+                    )
+                )
+                shard.process.terminate()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+        self._shards = []
+        self._tasks = []
+
+
+class _Shard:
+    def __init__(self, runner: ShardedRunner, index: int):
+        self.runner = runner
+        self.index = index
+
+        self.inbox = Queue(runner.inbox_size)
+        # seq -> (respondent id, update) sent to the worker and not handled yet
+        self.unacked = OrderedDict()
+        self.in_flight = Semaphore(runner.inbox_size)
+        self.lock = Lock()
+        self._seqs = itertools.count()
+
+        self.process = None
+        self._updates = None
+        self._acks = None
+        self._acks_task = None
+        self._crashed_on = None
+
+    def spawn(self):
+        context = self.runner._context
+        updates_receiver, self._updates = context.Pipe(duplex=False)
+        self._acks, acks_sender = context.Pipe(duplex=False)
+
+        channel = ShardChannel(updates_receiver, acks_sender)
+        self.process = context.Process(
+            target=_run_worker,
+            args=(self.runner.service_factory, self.runner.workers, channel),
+            name="limpopo-shard-{}".format(self.index),
+            daemon=True,
+        )
+        self.process.start()
+        channel.close()
+
+        self._acks_task = asyncio.ensure_future(self._read_acks(self._acks))
+
+        logging.info(
+            "Shard worker #{} started with pid {}".format(self.index, self.process.pid)
+        )
+
+    def _forget(self, seq: int):
+        if self.unacked.pop(seq, None) is not None:
+            self.in_flight.release()
+
+    async def _read_acks(self, acks):
+        loop = asyncio.get_event_loop()
+
+        while 1:
+            try:
+                seq = await loop.run_in_executor(self.runner._executor, acks.recv)
+            except (EOFError, OSError):
+                return
+
+            # Updates of different respondents are acknowledged out of order
+            self._forget(seq)
+
+    async def _send(self, seq: int, respondent_id, update: bytes) -> bool:
+        loop = asyncio.get_event_loop()
+
+        try:
+            await loop.run_in_executor(
+                self.runner._executor,
+                self._updates.send,
+                (seq, respondent_id, update),
+            )
+        except OSError:
+            return False
+
+        return True
+
+    async def feed(self):
+        while 1:
+            respondent_id, update = await self.inbox.get()
+            await self.in_flight.acquire()
+
+            async with self.lock:
+                seq = next(self._seqs)
+                self.unacked[seq] = (respondent_id, update)
+
+                # Updates are sent one by one to keep their order
+                while not await self._send(seq, respondent_id, update):
+                    await asyncio.sleep(self.runner.restart_delay)
+
+                    if not self.process.is_alive():
+                        # The restart sends all unacked updates
+                        await self.restart()
+                        break
+
+    async def restart(self):
+        logging.error(
+            "Shard worker #{} exited with code {}, restart it".format(
+                self.index, self.process.exitcode
+            )
+        )
+        # Acks the worker sent before its death are still in the pipe, they are
+        # read up to the end, so handled updates aren't sent again
+        if self._acks_task is not None:
+            await self._acks_task
+            self._acks_task = None
+
+        self.close()
+
+        # The oldest unacked update is the likeliest one to crash the worker
+        oldest = next(iter(self.unacked), None)
+
+        if oldest is not None and oldest == self._crashed_on:
+            logging.error(
+                "Shard worker #{} died twice on the same update, drop it".format(
+                    self.index
+                )
+            )
+            self._forget(oldest)
+            oldest = next(iter(self.unacked), None)
+
+        self._crashed_on = oldest
+
+        self.spawn()
+
+        for seq, (respondent_id, update) in list(self.unacked.items()):
+            if not await self._send(seq, respondent_id, update):
+                break
+
+    def close(self):
+        if self._acks_task is not None:
+            self._acks_task.cancel()
+            self._acks_task = None
+
+        if self._updates is not None:
+            self._updates.close()
+            self._acks.close()
@@ -1,21 +1,30 @@
 import asyncio
 import logging
+import os
 import typing
 from dataclasses import dataclass
 
-from telethon import Button, TelegramClient, events
+from telethon import Button, TelegramClient, events, utils
+from telethon.errors import RPCError
 from telethon.sessions.abstract import Session
-from telethon.tl.types import DocumentAttributeVideo
+from telethon.tl.types import DocumentAttributeVideo, InputFile, InputFileBig
 from tenacity import RetryError
 
 from .. import const
 from ..dto import Message, Messengers, Respondent
 from ..exceptions import SettingsError
-from ..helpers import with_retry
+from ..helpers import calculate_file_hash, with_retry
 from ..markdown_message import MarkdownMessage
 from ..storages.archetype import ArchetypeStorage
 from ..video import Video
-from .archetype import ArchetypeDialog, ArchetypeService, DefaultSettings, EmptySettings
+from .archetype import (
+    UNKNOWN,
+    ArchetypeDialog,
+    ArchetypeService,
+    DefaultSettings,
+    EmptySettings,
+)
+from .scheduler import Priority
 
 
 @dataclass
@@ -54,6 +63,10 @@ class TelegramSettings(DefaultSettings, _local_settings):
 
 class TelegramDialog(ArchetypeDialog):
     def prepare_question(self, question) -> dict:
+        return self.service.get_question_payload(question, self.compile_question)
+
+    @staticmethod
+    def compile_question(question) -> dict:
         message = question.topic
 
         buttons = []
@@ -73,7 +86,9 @@ class TelegramDialog(ArchetypeDialog):
                     )
                 buttons = rows_buttons
 
-            return {"message": message, "buttons": buttons}
+            markup = TelegramClient.build_reply_markup(buttons)
+
+            return {"message": message, "buttons": markup}
 
         return {"message": message}
 
@@ -90,6 +105,7 @@ class TelegramDialog(ArchetypeDialog):
 
 class TelegramService(ArchetypeService):
     type = Messengers.telegram
+    default_send_limits = const.TELEGRAM_SEND_LIMITS
 
     def __init__(
         self,
@@ -97,6 +113,7 @@ class TelegramService(ArchetypeService):
         storage: ArchetypeStorage,
         settings: TelegramSettings,
         cls_dialog: TelegramDialog = TelegramDialog,
+        videos: typing.Iterable[Video] = (),
         *args,
         **kwargs
     ):
@@ -104,50 +121,153 @@ class TelegramService(ArchetypeService):
         self._client = TelegramClient(
             settings.session, settings.api_id, settings.api_hash, proxy=None
         )
-        self._uploaded_file = None
+
+        # Videos of the quiz, which are uploaded on start
+        self._videos = list(videos)
+        # (path, size, mtime) -> key of file content
+        self._file_keys = {}
+        # key of file content -> document of sent file, file id saved by another
+        # process or just uploaded file
+        self._uploaded_files = {}
+        self._uploading_files = {}
+        # key of file content -> file id in the storage
+        self._saved_file_ids = {}
+        # File ids rejected by Telegram, they are never sent or saved again
+        self._rejected_file_ids = set()
+
+    async def get_file_key(self, path: str) -> str:
+        stat = os.stat(path)
+        local_key = (path, stat.st_size, stat.st_mtime_ns)
+
+        key = self._file_keys.get(local_key)
+        if key is None:
+            loop = asyncio.get_event_loop()
+            file_hash = await loop.run_in_executor(None, calculate_file_hash, path)
+            key = "{}:{}".format(file_hash, stat.st_size)
+            self._file_keys[local_key] = key
+
+        return key
 
     async def upload_file(self, video_file):
-        if self._uploaded_file is None:
-            self._uploaded_file = await self._client.upload_file(video_file)
+        """
+        Returns the file id of the file with the same content, which was sent
+        earlier by any process, otherwise uploads the file. Concurrent calls
+        for the same content share one upload.
+        """
+        key = await self.get_file_key(video_file)
 
-        return self._uploaded_file
+        if key in self._uploaded_files:
+            return self._uploaded_files[key]
 
-    async def restore_dialog(
-        self, respondent_id, event, repeat_last_question=False
-    ) -> typing.Optional[TelegramDialog]:
+        task = self._uploading_files.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._upload_file(key, video_file))
+            task.add_done_callback(lambda _: self._uploading_files.pop(key, None))
+            self._uploading_files[key] = task
+
+        return await asyncio.shield(task)
 
+    async def _upload_file(self, key, video_file):
         try:
-            last_dialog_id = await with_retry(
-                lambda: self.storage.get_last_dialog_id(
-                    respondent_id=respondent_id, respondent_messenger=self.type
-                ),
+            uploaded_file = await with_retry(
+                lambda: self.storage.get_uploaded_file(key, self.type),
                 exceptions=self.storage.io_exceptions,
-                stop_callback_coro=self.stop,
             )
+        except RetryError:
+            logging.error("Can't get uploaded file due to Storage IO error")
+            uploaded_file = None
 
-            if last_dialog_id is None:
-                logging.info(
-                    "Respondent #{} doesn't have any dialogs".format(respondent_id)
-                )
-                return
+        if uploaded_file in self._rejected_file_ids:
+            uploaded_file = None
+        elif uploaded_file is not None:
+            self._saved_file_ids[key] = uploaded_file
+
+        if uploaded_file is None:
+            logging.info("Uploading file {}".format(video_file))
+            uploaded_file = await self._client.upload_file(video_file)
+
+        self._uploaded_files[key] = uploaded_file
 
-            messages = await with_retry(
-                lambda: self.storage.get_messages_from_dialog(last_dialog_id),
+        return uploaded_file
+
+    async def save_uploaded_file(self, video_file, message):
+        key = await self.get_file_key(video_file)
+
+        # The document of the sent message has a fresh file reference, so it's
+        # reused by this process, other ones get the file id from the storage
+        try:
+            self._uploaded_files[key] = utils.get_input_document(message.media)
+        except TypeError:
+            pass
+
+        file_id = utils.pack_bot_file_id(message.media)
+
+        if (
+            file_id is None
+            or file_id in self._rejected_file_ids
+            or self._saved_file_ids.get(key) == file_id
+        ):
+            return
+
+        self._saved_file_ids[key] = file_id
+
+        try:
+            await with_retry(
+                lambda: self.storage.save_uploaded_file(key, self.type, file_id),
                 exceptions=self.storage.io_exceptions,
-                stop_callback_coro=self.stop,
             )
+        except RetryError:
+            logging.error("Can't save uploaded file due to Storage IO error")
+
+    async def forget_uploaded_file(self, video_file):
+        key = await self.get_file_key(video_file)
+        uploaded_file = self._uploaded_files.pop(key, None)
 
-            called_functions = await with_retry(
-                lambda: self.storage.get_called_functions_from_dialog(last_dialog_id),
+        if isinstance(uploaded_file, str):
+            self._rejected_file_ids.add(uploaded_file)
+
+    async def upload_videos(self):
+        results = await asyncio.gather(
+            *(self.upload_file(video.path_to_file) for video in self._videos),
+            return_exceptions=True,
+        )
+
+        for video, result in zip(self._videos, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    "Can't upload video {}: {!r}".format(video.path_to_file, result)
+                )
+
+    async def restore_dialog(
+        self, respondent_id, event, repeat_last_question=False
+    ) -> typing.Optional[TelegramDialog]:
+
+        if self.get_cached_dialog_id(respondent_id) is None:
+            logging.info(
+                "Respondent #{} doesn't have any dialogs".format(respondent_id)
+            )
+            return
+
+        try:
+            bundle = await with_retry(
+                lambda: self.storage.restore_bundle(
+                    respondent_id=respondent_id, respondent_messenger=self.type
+                ),
                 exceptions=self.storage.io_exceptions,
                 stop_callback_coro=self.stop,
             )
-
         except RetryError:
             logging.error("Can't restore dialog due to Storage IO error")
             return
 
-        prepared_questions = {q: a for q, a in messages}
+        if bundle is None:
+            self.cache_dialog_id(respondent_id, None)
+            logging.info(
+                "Respondent #{} doesn't have any dialogs".format(respondent_id)
+            )
+            return
+
+        prepared_questions = {q: a for q, a in bundle.messages}
 
         respondent = Respondent(
             id=respondent_id,
@@ -159,9 +279,9 @@ class TelegramService(ArchetypeService):
 
         dialog = await self.create_dialog(
             respondent,
-            identifier=last_dialog_id,
+            identifier=bundle.dialog_id,
             prepared_questions=prepared_questions,
-            called_functions=set(called_functions),
+            called_functions=set(bundle.called_functions),
             repeat_last_question=repeat_last_question,
         )
 
@@ -210,15 +330,19 @@ class TelegramService(ArchetypeService):
 
     async def cancel_pause(self, respondent_id):
         try:
-            last_dialog_id = await with_retry(
-                lambda: self.storage.get_last_dialog_id(
-                    respondent_id=respondent_id,
-                    respondent_messenger=self.type,
-                    on_pause=True,
-                ),
-                exceptions=self.storage.io_exceptions,
-                stop_callback_coro=self.stop,
-            )
+            last_dialog_id = self.get_cached_dialog_id(respondent_id, on_pause=True)
+
+            if last_dialog_id is UNKNOWN:
+                last_dialog_id = await with_retry(
+                    lambda: self.storage.get_last_dialog_id(
+                        respondent_id=respondent_id,
+                        respondent_messenger=self.type,
+                        on_pause=True,
+                    ),
+                    exceptions=self.storage.io_exceptions,
+                    stop_callback_coro=self.stop,
+                )
+                self.cache_dialog_id(respondent_id, last_dialog_id, on_pause=True)
 
             if last_dialog_id is None:
                 logging.info(
@@ -226,11 +350,14 @@ class TelegramService(ArchetypeService):
                 )
                 return
 
-            return await with_retry(
+            cancelled = await with_retry(
                 lambda: self.storage.cancel_pause(last_dialog_id),
                 exceptions=self.storage.io_exceptions,
                 stop_callback_coro=self.stop,
             )
+            self.forget_respondent_state(respondent_id)
+
+            return cancelled
 
         except RetryError:
             logging.error("Can't restore dialog on pause due to Storage IO error")
@@ -322,7 +449,13 @@ class TelegramService(ArchetypeService):
             raise events.StopPropagation
 
     async def send_message(
-        self, user_id, message, keep_keyboard=False, *args, **kwargs
+        self,
+        user_id,
+        message,
+        keep_keyboard=False,
+        priority=Priority.interactive,
+        *args,
+        **kwargs
     ):
         tg_message = {}
 
@@ -331,6 +464,7 @@ class TelegramService(ArchetypeService):
 
         if isinstance(message, MarkdownMessage):
             tg_message["message"] = message.text
+            await self.wait_send_slot(user_id, priority)
             message = await self._client.send_message(int(user_id), **tg_message)
 
         elif isinstance(message, Video):
@@ -341,18 +475,39 @@ class TelegramService(ArchetypeService):
             else:
                 attrs = DocumentAttributeVideo(0, 0, 0, supports_streaming=True)
 
-            uploaded_file = await self.upload_file(message.path_to_file)
+            video = message
+            uploaded_file = await self.upload_file(video.path_to_file)
+            await self.wait_send_slot(user_id, priority)
 
-            message = await self._client.send_file(
-                int(user_id), uploaded_file, attributes=(attrs,)
-            )
+            try:
+                message = await self._client.send_file(
+                    int(user_id), uploaded_file, attributes=(attrs,)
+                )
+            except RPCError:
+                if isinstance(uploaded_file, (InputFile, InputFileBig)):
+                    raise
+
+                # The file id or the file reference of the document is no longer
+                # valid, so the file is uploaded again
+                logging.warning(
+                    "Can't send file {} by file id".format(video.path_to_file)
+                )
+                await self.forget_uploaded_file(video.path_to_file)
+                uploaded_file = await self._client.upload_file(video.path_to_file)
+                message = await self._client.send_file(
+                    int(user_id), uploaded_file, attributes=(attrs,)
+                )
+
+            await self.save_uploaded_file(video.path_to_file, message)
 
         elif isinstance(message, dict):
             tg_message.update(message)
+            await self.wait_send_slot(user_id, priority)
             message = await self._client.send_message(int(user_id), **tg_message)
 
         elif isinstance(message, str):
             tg_message["message"] = message
+            await self.wait_send_slot(user_id, priority)
             message = await self._client.send_message(int(user_id), **tg_message)
 
         return message.id
@@ -371,9 +526,13 @@ class TelegramService(ArchetypeService):
         self._client.add_event_handler(self.handle_click_button, events.CallbackQuery)
 
     async def stop(self):
+        self.stop_idle_sweeper()
         await self._client.disconnect()
 
     async def run_forever(self):
+        await self.storage.warm_up()
         self.set_handlers()
         await self._client.start(bot_token=self.settings.token)
+        await self.upload_videos()
+        self.start_idle_sweeper()
         await self._client.run_until_disconnected()
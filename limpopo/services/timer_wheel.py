@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import math
+import typing
+
+
+class TimerWheel:
+    """
+    Tracks deadlines of many items with a single event loop timer.
+
+    Deadlines are rounded up to `resolution` seconds, so items expiring in
+    the same tick share a slot and are expired in one batch. Adding,
+    moving and discarding a deadline are dict operations, nothing is
+    scheduled on the event loop per item.
+    """
+
+    def __init__(self, resolution: float = 1):
+        self.resolution = resolution
+
+        self._slots = {}  # tick -> {item: callback}
+        self._item_ticks = {}  # item -> tick
+        self._timer = None
+        self._timer_tick = None
+
+    def __len__(self):
+        return len(self._item_ticks)
+
+    def __contains__(self, item):
+        return item in self._item_ticks
+
+    def add(self, item, timeout: float, callback: typing.Callable[[], None]):
+        """Calls `callback` in `timeout` seconds, unless the item is discarded."""
+        self.discard(item)
+
+        loop = asyncio.get_event_loop()
+        tick = math.ceil((loop.time() + timeout) / self.resolution)
+
+        self._slots.setdefault(tick, {})[item] = callback
+        self._item_ticks[item] = tick
+
+        if self._timer_tick is None or tick < self._timer_tick:
+            self._schedule(tick)
+
+    def discard(self, item):
+        tick = self._item_ticks.pop(item, None)
+
+        if tick is None:
+            return
+
+        slot = self._slots[tick]
+        del slot[item]
+
+        if not slot:
+            del self._slots[tick]
+
+    def _schedule(self, tick):
+        if self._timer is not None:
+            self._timer.cancel()
+
+        loop = asyncio.get_event_loop()
+        self._timer = loop.call_at(tick * self.resolution, self._expire)
+        self._timer_tick = tick
+
+    def _expire(self):
+        # The loop may call the timer slightly before its time, the scheduled
+        # tick is expired anyway instead of rescheduling it again and again
+        loop = asyncio.get_event_loop()
+        now_tick = max(self._timer_tick, math.floor(loop.time() / self.resolution))
+
+        self._timer = None
+        self._timer_tick = None
+
+        for tick in sorted(tick for tick in self._slots if tick <= now_tick):
+            slot = self._slots.pop(tick)
+
+            for item, callback in slot.items():
+                del self._item_ticks[item]
+
+                try:
+                    callback()
+                except Exception:
+                    logging.exception("Catch exception in timer callback:")
+
+        if self._slots:
+            self._schedule(min(self._slots))
+
+    def clear(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+        self._slots.clear()
+        self._item_ticks.clear()
+        self._timer = None
+        self._timer_tick = None
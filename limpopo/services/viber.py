@@ -1,9 +1,15 @@
 import asyncio
+import json
 import logging
 import typing
+from asyncio import Queue, QueueFull
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from dataclasses import dataclass
 from time import time
 
+import requests
+from requests.adapters import HTTPAdapter
 from starlette.applications import Starlette
 from starlette.responses import Response
 from starlette.routing import Route
@@ -11,16 +17,23 @@ from tenacity import RetryError
 from uvicorn import Config, Server
 from viberbot import Api
 from viberbot.api.bot_configuration import BotConfiguration
+from viberbot.api.consts import (
+    BOT_API_ENDPOINT,
+    VIBER_BOT_API_URL,
+    VIBER_BOT_USER_AGENT,
+)
 from viberbot.api.event_type import EventType
 from viberbot.api.messages import TextMessage, URLMessage
 
 from .. import const
 from ..dto import Message, Messengers, Respondent
-from ..exceptions import SettingsError
+from ..exceptions import SettingsError, ViberApiError
 from ..helpers import with_retry
 from ..markdown_message import MarkdownMessage
 from ..video import Video
 from .archetype import ArchetypeDialog, ArchetypeService, DefaultSettings, EmptySettings
+from .scheduler import Priority
+from .sharding import ShardedRunner, receive_updates, shard_of
 
 
 @dataclass
@@ -31,6 +44,11 @@ class _local_settings(EmptySettings):
     http_port: int
     http_webhook_path: str = "/"
     avatar: str = const.LIMPOPO_AVATAR
+    send_concurrency: int = 32
+    send_timeout: float = 10
+    # Workers handling acknowledged webhook requests, not used by shard workers
+    webhook_workers: int = 0
+    webhook_queue_size: int = 1000
 
     def __post_init__(self):
         if not isinstance(self.http_host, str):
@@ -58,14 +76,110 @@ class _local_settings(EmptySettings):
         if not isinstance(self.token, str):
             raise SettingsError("ViberSettings field `token` must be of the str type")
 
+        if not isinstance(self.send_concurrency, int):
+            raise SettingsError(
+                "ViberSettings field `send_concurrency` must be of the int type"
+            )
+
+        if not isinstance(self.send_timeout, (int, float)):
+            raise SettingsError(
+                "ViberSettings field `send_timeout` must be of the int or float type"
+            )
+
+        if not isinstance(self.webhook_workers, int):
+            raise SettingsError(
+                "ViberSettings field `webhook_workers` must be of the int type"
+            )
+
+        if not isinstance(self.webhook_queue_size, int):
+            raise SettingsError(
+                "ViberSettings field `webhook_queue_size` must be of the int type"
+            )
+
 
 @dataclass
 class ViberSettings(DefaultSettings, _local_settings):
     pass
 
 
+class ViberSender:
+    """
+    Sends messages to Viber REST API without blocking the event loop.
+
+    Requests are posted through one keep-alive `requests.Session` by a pool
+    of `concurrency` threads, so at most `concurrency` requests are in flight
+    and the rest wait for a free connection.
+    """
+
+    def __init__(self, bot_configuration, concurrency: int, timeout: float):
+        self._bot_configuration = bot_configuration
+        self._timeout = timeout
+
+        self._session = requests.Session()
+        self._session.headers.update({"User-Agent": VIBER_BOT_USER_AGENT})
+        self._session.mount(
+            VIBER_BOT_API_URL,
+            HTTPAdapter(pool_connections=1, pool_maxsize=concurrency),
+        )
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="viber-sender"
+        )
+
+    def _post_request(self, endpoint, payload) -> dict:
+        response = self._session.post(
+            "{}/{}".format(VIBER_BOT_API_URL, endpoint),
+            data=payload,
+            timeout=self._timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def send_message(self, to, message) -> str:
+        if not message.validate():
+            raise ViberApiError("Failed validating message: {}".format(message))
+
+        payload = message.to_dict()
+        payload.update(
+            {
+                "auth_token": self._bot_configuration.auth_token,
+                "receiver": to,
+                "sender": {
+                    "name": self._bot_configuration.name,
+                    "avatar": self._bot_configuration.avatar,
+                },
+            }
+        )
+        payload = {k: v for k, v in payload.items() if v is not None}
+
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(
+            self._executor,
+            self._post_request,
+            BOT_API_ENDPOINT.SEND_MESSAGE,
+            json.dumps(payload),
+        )
+
+        if result["status"] != 0:
+            raise ViberApiError(
+                "Failed with status: {}, message: {}".format(
+                    result["status"], result["status_message"]
+                )
+            )
+
+        return result["message_token"]
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+
 class ViberDialog(ArchetypeDialog):
     def prepare_question(self, question):
+        return self.service.get_question_payload(question, self.compile_question)
+
+    @staticmethod
+    def compile_question(question):
         message = question.plain_text
 
         if question.options:
@@ -104,6 +218,7 @@ class ViberDialog(ArchetypeDialog):
 
 class ViberService(ArchetypeService):
     type = Messengers.viber
+    default_send_limits = const.VIBER_SEND_LIMITS
 
     def __init__(
         self,
@@ -116,10 +231,12 @@ class ViberService(ArchetypeService):
     ):
         super().__init__(quiz, storage, settings, cls_dialog=cls_dialog)
 
-        self._viber = Api(
-            BotConfiguration(
-                name=settings.name, avatar=settings.avatar, auth_token=settings.token
-            )
+        bot_configuration = BotConfiguration(
+            name=settings.name, avatar=settings.avatar, auth_token=settings.token
+        )
+        self._viber = Api(bot_configuration)
+        self._sender = ViberSender(
+            bot_configuration, settings.send_concurrency, settings.send_timeout
         )
 
         self.app = Starlette(
@@ -136,6 +253,11 @@ class ViberService(ArchetypeService):
 
         self._keyboard_data = None
 
+        # With `webhook_workers` > 0 webhook requests are acknowledged at once
+        # and handled in background, every worker drains its own queue
+        self._webhook_queues = []
+        self._webhook_tasks = []
+
     @staticmethod
     def gen_tracking_data():
         return int(time() * 10 ** 5)
@@ -176,10 +298,82 @@ class ViberService(ArchetypeService):
 
         viber_request = self._viber.parse_request(body)
 
+        if self._webhook_queues:
+            return self.enqueue_viber_request(viber_request)
+
         await self.handle_viber_request(viber_request)
 
         return Response(status_code=200)
 
+    @staticmethod
+    def get_request_user_id(viber_request) -> typing.Optional[str]:
+        for attr in ("sender", "user"):
+            user = getattr(viber_request, attr, None)
+            if user is not None:
+                return user.id
+
+        return getattr(viber_request, "user_id", None)
+
+    def enqueue_viber_request(self, viber_request) -> Response:
+        # Requests of a respondent always go to the same worker to keep their order
+        user_id = self.get_request_user_id(viber_request) or ""
+        index = shard_of(user_id, len(self._webhook_queues))
+
+        try:
+            self._webhook_queues[index].put_nowait(viber_request)
+        except QueueFull:
+            logging.warning(
+                "Webhook queue #{} is full, viber_request is rejected".format(index)
+            )
+            return Response(status_code=503)
+
+        return Response(status_code=200)
+
+    async def _webhook_worker(self, queue: Queue):
+        while 1:
+            viber_request = await queue.get()
+
+            try:
+                await self.handle_viber_request(viber_request)
+            except Exception:
+                logging.exception("Catch exception in webhook worker:")
+            finally:
+                queue.task_done()
+
+    def start_webhook_workers(self):
+        workers = self.settings.webhook_workers
+        queue_size = max(1, self.settings.webhook_queue_size // max(workers, 1))
+
+        for _ in range(workers):
+            queue = Queue(queue_size)
+            self._webhook_queues.append(queue)
+            self._webhook_tasks.append(
+                asyncio.ensure_future(self._webhook_worker(queue))
+            )
+
+    def stop_webhook_workers(self):
+        for task in self._webhook_tasks:
+            task.cancel()
+
+        self._webhook_queues = []
+        self._webhook_tasks = []
+
+    async def handle_shard_update(self, body: bytes):
+        await self.handle_viber_request(self._viber.parse_request(body))
+
+    async def run_shard(self, channel):
+        """Runs the service as a worker process of `ShardedRunner`."""
+        # Webhook requests are received by `ViberShardRouter` of the supervisor.
+        # An update is acknowledged after it is handled, so webhook workers
+        # aren't used: the supervisor resends unhandled updates of a dead worker
+        await self.storage.warm_up()
+        self.start_idle_sweeper()
+
+        try:
+            await receive_updates(channel, self.handle_shard_update)
+        finally:
+            self.stop_idle_sweeper()
+
     async def handle_viber_request(self, viber_request):
         logging.info(
             "Received viber_request with event_type {}".format(viber_request.event_type)
@@ -198,7 +392,8 @@ class ViberService(ArchetypeService):
 
     async def handle_conversation_started(self, user):
         message = TextMessage(**const.VIBER_INTO_MESSAGE)
-        self._viber.send_messages(user.id, message)
+        await self.wait_send_slot(user.id)
+        await self._sender.send_message(user.id, message)
 
     async def handle_subscribed(self, user):
         full_userdata = self.user_to_dict(user)
@@ -239,17 +434,27 @@ class ViberService(ArchetypeService):
         await self.close_dialog(user_id, is_complete=False)
 
     async def send_message(
-        self, user_id, message, keep_keyboard=False, *args, **kwargs
+        self,
+        user_id,
+        message,
+        keep_keyboard=False,
+        priority=Priority.interactive,
+        *args,
+        **kwargs
     ):
         if isinstance(message, MarkdownMessage):
             message = TextMessage(text=message.plain_text)
         elif isinstance(message, Video):
             if message.url is not None:
+                await message.validate_url()
                 message = URLMessage(media=message.url)
             else:
                 return self.gen_tracking_data()
         elif isinstance(message, str):
             message = TextMessage(text=message)
+        else:
+            # Prepared messages are shared, so per-send fields are stamped on a copy
+            message = copy(message)
 
         if message._keyboard:
             self._keyboard_data = message._keyboard
@@ -259,7 +464,8 @@ class ViberService(ArchetypeService):
         if keep_keyboard:
             self.expand_keyboard(message)
 
-        self._viber.send_messages(user_id, message)
+        await self.wait_send_slot(user_id, priority)
+        await self._sender.send_message(user_id, message)
 
         return message.tracking_data
 
@@ -280,29 +486,28 @@ class ViberService(ArchetypeService):
     async def restore_dialog(self, user) -> typing.Optional[ViberDialog]:
         logging.debug("Try to restore dialog for user with id #{}".format(user.id))
 
+        if self.get_cached_dialog_id(user.id) is None:
+            logging.info("Respondent #{} doesn't have any dialogs".format(user.id))
+            return
+
         try:
-            last_dialog_id = await with_retry(
-                lambda: self.storage.get_last_dialog_id(
+            bundle = await with_retry(
+                lambda: self.storage.restore_bundle(
                     respondent_id=user.id, respondent_messenger=self.type
                 ),
                 exceptions=self.storage.io_exceptions,
                 stop_callback_coro=self.stop,
             )
-
-            if last_dialog_id is None:
-                logging.info("Respondent #{} doesn't have any dialogs".format(user.id))
-                return
-
-            messages = await with_retry(
-                lambda: self.storage.get_messages_from_dialog(last_dialog_id),
-                exceptions=self.storage.io_exceptions,
-                stop_callback_coro=self.stop,
-            )
         except RetryError:
             logging.error("Can't restore dialog due to Storage IO error")
             return
 
-        prepared_questions = {q: a for q, a in messages}
+        if bundle is None:
+            self.cache_dialog_id(user.id, None)
+            logging.info("Respondent #{} doesn't have any dialogs".format(user.id))
+            return
+
+        prepared_questions = {q: a for q, a in bundle.messages}
 
         full_userdata = self.user_to_dict(user)
 
@@ -314,7 +519,10 @@ class ViberService(ArchetypeService):
         )
 
         dialog = await self.create_dialog(
-            respondent, identifier=last_dialog_id, prepared_questions=prepared_questions
+            respondent,
+            identifier=bundle.dialog_id,
+            prepared_questions=prepared_questions,
+            called_functions=set(bundle.called_functions),
         )
 
         self._create_task(dialog)
@@ -340,7 +548,82 @@ class ViberService(ArchetypeService):
         self._viber.unset_webhook()
 
     async def run_forever(self):
-        await self._server.serve()
+        await self.storage.warm_up()
+        self.start_webhook_workers()
+        self.start_idle_sweeper()
+
+        try:
+            await self._server.serve()
+        finally:
+            self.stop_webhook_workers()
+            self.stop_idle_sweeper()
+
+    async def stop(self):
+        self._server.should_exit = True
+        self._server.force_exit = True
+        self.stop_webhook_workers()
+        self.stop_idle_sweeper()
+        self._sender.close()
+
+
+class ViberShardRouter:
+    """
+    Receives webhook requests of a Viber bot served by `ShardedRunner`
+    workers, verifies them and routes them by the respondent id.
+    """
+
+    def __init__(self, settings: ViberSettings, runner: ShardedRunner):
+        self.settings = settings
+        self.runner = runner
+
+        bot_configuration = BotConfiguration(
+            name=settings.name, avatar=settings.avatar, auth_token=settings.token
+        )
+        self._viber = Api(bot_configuration)
+
+        self.app = Starlette(
+            routes=[
+                Route(
+                    settings.http_webhook_path,
+                    endpoint=self.handle_http_request,
+                    methods=["POST", "GET"],
+                )
+            ]
+        )
+        config = Config(self.app, port=settings.http_port, host=settings.http_host)
+        self._server = Server(config=config)
+
+    @staticmethod
+    def get_payload_user_id(payload: dict) -> typing.Optional[str]:
+        for key in ("sender", "user"):
+            user = payload.get(key)
+            if user is not None:
+                return user.get("id")
+
+        return payload.get("user_id")
+
+    async def handle_http_request(self, request):
+        body = await request.body()
+        signature = request.headers.get("X-Viber-Content-Signature")
+
+        if not self._viber.verify_signature(body, signature):
+            return Response(status_code=403)
+
+        # Only the respondent id is needed here, workers parse the request
+        user_id = self.get_payload_user_id(json.loads(body)) or ""
+
+        if not self.runner.route(user_id, body):
+            return Response(status_code=503)
+
+        return Response(status_code=200)
+
+    async def run_forever(self):
+        self.runner.start()
+
+        try:
+            await self._server.serve()
+        finally:
+            self.runner.stop()
 
     async def stop(self):
         self._server.should_exit = True
@@ -1,7 +1,13 @@
 from .fake import FakeStorage
-from .postgres.storage import PostgreStorage
+from .memory import InMemoryStorage
+from .postgres.storage import PostgreSettings, PostgreStorage
+from .sqlite.storage import SQLiteSettings, SQLiteStorage
 
 __all__ = [
     "FakeStorage",
+    "InMemoryStorage",
+    "PostgreSettings",
     "PostgreStorage",
+    "SQLiteSettings",
+    "SQLiteStorage",
 ]
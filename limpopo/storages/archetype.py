@@ -14,7 +14,35 @@ class ArchetypeStorage(metaclass=ABCMeta):
     async def create_dialog(self, dialog):
         pass
 
+    @abstractmethod
+    async def restore_bundle(self, respondent_id, respondent_messenger, on_pause=None):
+        pass
+
+    @abstractmethod
+    async def get_uploaded_file(self, key: str, messenger):
+        pass
+
+    @abstractmethod
+    async def save_uploaded_file(self, key: str, messenger, file_id: str):
+        pass
+
+    @abstractmethod
+    def iter_respondents(self, messenger, after_id=None, segment=None):
+        pass
+
+    @abstractmethod
+    async def get_broadcast_progress(self, name: str, messenger):
+        pass
+
+    @abstractmethod
+    async def save_broadcast_progress(self, name: str, messenger, progress):
+        pass
+
     @property
     @abstractmethod
     async def io_exceptions(self):
         pass
+
+    async def warm_up(self):
+        """Prepares the storage before the service accepts traffic."""
+        pass
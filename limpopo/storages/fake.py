@@ -2,11 +2,34 @@ from .archetype import ArchetypeStorage
 
 
 class FakeStorage(ArchetypeStorage):
-    async def save_question_and_answer(self, question, answer):
-        pass
+    """Stores nothing, use `InMemoryStorage` to run real dialogs."""
+
+    io_exceptions = ()
 
-    async def save_dialog(self, dialog):
+    async def save_question_and_answer(self, dialog, question):
         pass
 
     async def save_function_call(self, dialog, funcs_hash: int):
         pass
+
+    async def create_dialog(self, dialog):
+        return 0
+
+    async def restore_bundle(self, respondent_id, respondent_messenger, on_pause=None):
+        pass
+
+    async def get_uploaded_file(self, key: str, messenger):
+        pass
+
+    async def save_uploaded_file(self, key: str, messenger, file_id: str):
+        pass
+
+    async def iter_respondents(self, messenger, after_id=None, segment=None):
+        return
+        yield
+
+    async def get_broadcast_progress(self, name: str, messenger):
+        pass
+
+    async def save_broadcast_progress(self, name: str, messenger, progress):
+        pass
@@ -0,0 +1,382 @@
+import typing
+from collections import namedtuple
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+
+from ..dto import BroadcastProgress, QuizCounts, Respondent, RestoreBundle
+from ..helpers import json_contains
+from .archetype import ArchetypeStorage
+from .postgres.storage import RESULT_STATUSES
+
+ResultRow = namedtuple(
+    "ResultRow",
+    [
+        "dialog_id",
+        "created_at",
+        "finished_at",
+        "completed",
+        "cancelled",
+        "respondent_id",
+        "messenger",
+        "username",
+        "first_name",
+        "last_name",
+        "extra_data",
+        "question_id",
+        "answer",
+    ],
+)
+StepRow = namedtuple(
+    "StepRow", ["id", "dialog_id", "question_id", "answer", "created_at"]
+)
+DialogRow = namedtuple(
+    "DialogRow", ["id", "created_at", "finished_at", "completed", "cancelled"]
+)
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+@dataclass
+class _Dialog:
+    id: int
+    respondent: typing.Tuple[str, typing.Any]  # (id, messenger)
+    created_at: datetime
+    finished_at: typing.Optional[datetime] = None
+    completed: typing.Optional[bool] = None
+    cancelled: typing.Optional[bool] = None
+    # (step id, question id, answer, created_at)
+    steps: list = field(default_factory=list)
+    # hash -> created_at, a function is saved once per dialog
+    called_functions: dict = field(default_factory=dict)
+
+
+def _messages(dialog: _Dialog) -> typing.List[typing.Tuple[int, str]]:
+    return [(question_id, answer) for _, question_id, answer, _ in dialog.steps]
+
+
+class InMemoryStorage(ArchetypeStorage):
+    """
+    Keeps everything `PostgreStorage` stores in dicts of the process, so
+    services run against it without a database, e.g. in tests, load tests
+    and benchmarks of the service layer. Lookups of dialogs, open dialogs of
+    a respondent, pauses and uploaded files are O(1).
+
+    Nothing is persisted, the data is lost with the process.
+    """
+
+    # Nothing fails on I/O, an empty tuple catches no exceptions
+    io_exceptions = ()
+
+    def __init__(self):
+        self._respondents = {}  # (id, messenger) -> Respondent
+        self._dialogs = {}  # id -> _Dialog
+        self._open_dialogs = {}  # (id, messenger) -> {dialog id: None}
+        self._active_pauses = set()  # dialog ids
+        self._questions = {}  # id -> text, in order of appearance
+        self._answer_counters = {}  # question id -> {answer: count}
+        self._quiz_counters = {}  # (quiz, messenger) -> QuizCounts
+        self._uploaded_files = {}  # (key, messenger) -> file id
+        self._broadcasts = {}  # (name, messenger) -> BroadcastProgress
+
+        self._last_dialog_id = 0
+        self._last_step_id = 0
+
+    async def flush(self):
+        pass
+
+    def _count_quiz(self, dialog, field_name: str):
+        key = (dialog.service.quiz_name, dialog.respondent.messenger)
+        counts = self._quiz_counters.setdefault(key, QuizCounts())
+        setattr(counts, field_name, getattr(counts, field_name) + 1)
+
+    async def save_question(self, question):
+        self._questions.setdefault(question.id, question.plain_text)
+
+    async def save_question_and_answer(self, dialog, question):
+        await self.save_question(question)
+
+        answer = dialog.answer.text
+        self._last_step_id += 1
+        self._dialogs[dialog.id].steps.append(
+            (self._last_step_id, question.id, answer, _now())
+        )
+
+        counters = self._answer_counters.setdefault(question.id, {})
+        counters[answer] = counters.get(answer, 0) + 1
+
+    async def save_function_call(self, dialog, funcs_hash: int):
+        self._dialogs[dialog.id].called_functions.setdefault(funcs_hash, _now())
+
+    async def create_respondent_if_not_exists(self, respondent):
+        key = (respondent.id, respondent.messenger)
+        stored = self._respondents.get(key)
+
+        if stored is None:
+            self._respondents[key] = replace(respondent)
+            return
+
+        # Missing fields don't overwrite the stored ones
+        for name in ("username", "first_name", "last_name", "extra_data"):
+            value = getattr(respondent, name)
+            if value is not None:
+                setattr(stored, name, value)
+
+    async def create_dialog(self, dialog) -> int:
+        await self.create_respondent_if_not_exists(dialog.respondent)
+
+        self._last_dialog_id += 1
+        key = (dialog.respondent.id, dialog.respondent.messenger)
+        self._dialogs[self._last_dialog_id] = _Dialog(
+            id=self._last_dialog_id, respondent=key, created_at=_now()
+        )
+        self._open_dialogs.setdefault(key, {})[self._last_dialog_id] = None
+
+        self._count_quiz(dialog, "started")
+
+        return self._last_dialog_id
+
+    def _last_open_dialog(
+        self, respondent_id, respondent_messenger, on_pause
+    ) -> typing.Optional[_Dialog]:
+        open_dialogs = self._open_dialogs.get((respondent_id, respondent_messenger))
+
+        if not open_dialogs:
+            return
+
+        # Ids grow, so the last inserted dialog is the newest one
+        for dialog_id in reversed(list(open_dialogs)):
+            paused = dialog_id in self._active_pauses
+
+            if (on_pause is None and not paused) or (on_pause is True and paused):
+                return self._dialogs[dialog_id]
+
+    async def get_last_dialog_id(
+        self, respondent_id, respondent_messenger, on_pause=None
+    ):
+        dialog = self._last_open_dialog(respondent_id, respondent_messenger, on_pause)
+
+        if dialog:
+            return dialog.id
+
+    async def restore_bundle(
+        self, respondent_id, respondent_messenger, on_pause=None
+    ) -> typing.Optional[RestoreBundle]:
+        dialog = self._last_open_dialog(respondent_id, respondent_messenger, on_pause)
+
+        if dialog is None:
+            return
+
+        return RestoreBundle(
+            dialog_id=dialog.id,
+            messages=_messages(dialog),
+            called_functions=list(dialog.called_functions),
+        )
+
+    async def get_messages_from_dialog(self, dialog_id: int):
+        dialog = self._dialogs.get(dialog_id)
+
+        if dialog is None:
+            return []
+
+        return [
+            (self._questions[question_id], answer)
+            for question_id, answer in _messages(dialog)
+        ]
+
+    async def get_called_functions_from_dialog(self, dialog_id: int):
+        dialog = self._dialogs.get(dialog_id)
+
+        if dialog is None:
+            return []
+
+        return list(dialog.called_functions)
+
+    async def close_dialog(self, dialog, is_complete):
+        stored = self._dialogs[dialog.id]
+
+        # A dialog is closed and counted once
+        if stored.finished_at is not None:
+            return
+
+        stored.finished_at = _now()
+
+        if is_complete:
+            stored.completed = True
+        else:
+            stored.cancelled = True
+
+        open_dialogs = self._open_dialogs[stored.respondent]
+        open_dialogs.pop(stored.id, None)
+
+        if not open_dialogs:
+            del self._open_dialogs[stored.respondent]
+
+        self._count_quiz(dialog, "completed" if is_complete else "cancelled")
+
+    async def get_answer_counts(self, question_id: int) -> typing.Dict[str, int]:
+        return dict(self._answer_counters.get(question_id, {}))
+
+    async def get_quiz_counts(self, quiz: str, messenger=None) -> QuizCounts:
+        total = QuizCounts()
+
+        for (counted_quiz, counted_messenger), counts in self._quiz_counters.items():
+            if counted_quiz != quiz:
+                continue
+
+            if messenger is not None and counted_messenger != messenger:
+                continue
+
+            total.started += counts.started
+            total.completed += counts.completed
+            total.cancelled += counts.cancelled
+
+        return total
+
+    async def pause(self, dialog) -> bool:
+        # A dialog has one active pause at most
+        if dialog.id in self._active_pauses:
+            return False
+
+        self._active_pauses.add(dialog.id)
+        return True
+
+    async def cancel_pause(self, dialog_id) -> bool:
+        if dialog_id not in self._active_pauses:
+            return False
+
+        self._active_pauses.discard(dialog_id)
+        return True
+
+    async def get_uploaded_file(self, key: str, messenger) -> typing.Optional[str]:
+        return self._uploaded_files.get((key, messenger))
+
+    async def save_uploaded_file(self, key: str, messenger, file_id: str):
+        self._uploaded_files[(key, messenger)] = file_id
+
+    async def iter_respondents(
+        self, messenger, after_id=None, segment=None
+    ) -> typing.AsyncIterator[Respondent]:
+        respondents = sorted(
+            (
+                respondent
+                for (_, respondent_messenger), respondent in self._respondents.items()
+                if respondent_messenger == messenger
+            ),
+            key=lambda respondent: respondent.id,
+        )
+
+        for respondent in respondents:
+            if after_id is not None and respondent.id <= after_id:
+                continue
+
+            if segment and not json_contains(respondent.extra_data, segment):
+                continue
+
+            yield replace(respondent)
+
+    async def get_questions(self) -> typing.List[typing.Tuple[int, str]]:
+        return list(self._questions.items())
+
+    async def iter_results(
+        self,
+        since: typing.Optional[datetime] = None,
+        until: typing.Optional[datetime] = None,
+        status: typing.Optional[str] = None,
+    ):
+        if status is not None and status not in RESULT_STATUSES:
+            raise ValueError(
+                "Status must be one of {}, received: {}".format(RESULT_STATUSES, status)
+            )
+
+        for dialog in list(self._dialogs.values()):
+            if since is not None and dialog.created_at < since:
+                continue
+
+            if until is not None and dialog.created_at >= until:
+                continue
+
+            if status == "completed" and not dialog.completed:
+                continue
+            elif status == "cancelled" and not dialog.cancelled:
+                continue
+            elif status == "unfinished" and dialog.finished_at is not None:
+                continue
+
+            respondent = self._respondents[dialog.respondent]
+            for question_id, answer in _messages(dialog) or [(None, None)]:
+                yield ResultRow(
+                    dialog_id=dialog.id,
+                    created_at=dialog.created_at,
+                    finished_at=dialog.finished_at,
+                    completed=dialog.completed,
+                    cancelled=dialog.cancelled,
+                    respondent_id=respondent.id,
+                    messenger=respondent.messenger,
+                    username=respondent.username,
+                    first_name=respondent.first_name,
+                    last_name=respondent.last_name,
+                    extra_data=respondent.extra_data,
+                    question_id=question_id,
+                    answer=answer,
+                )
+
+    async def iter_step_batches(
+        self,
+        after_id: typing.Optional[int] = None,
+        created_before: typing.Optional[datetime] = None,
+        batch_size: int = 10000,
+    ):
+        steps = sorted(
+            StepRow(step_id, dialog.id, question_id, answer, created_at)
+            for dialog in self._dialogs.values()
+            for step_id, question_id, answer, created_at in dialog.steps
+            if (after_id is None or step_id > after_id)
+            and (created_before is None or created_at < created_before)
+        )
+
+        for start in range(0, len(steps), batch_size):
+            yield steps[start : start + batch_size]
+
+    async def iter_dialog_batches(
+        self,
+        from_id: typing.Optional[int] = None,
+        finished_since: typing.Optional[datetime] = None,
+        batch_size: int = 10000,
+    ):
+        dialogs = [
+            DialogRow(
+                dialog.id,
+                dialog.created_at,
+                dialog.finished_at,
+                dialog.completed,
+                dialog.cancelled,
+            )
+            for dialog in self._dialogs.values()
+            if from_id is None
+            or dialog.id >= from_id
+            or (
+                finished_since is not None
+                and dialog.finished_at is not None
+                and dialog.finished_at >= finished_since
+            )
+        ]
+
+        for start in range(0, len(dialogs), batch_size):
+            yield dialogs[start : start + batch_size]
+
+    async def get_broadcast_progress(
+        self, name: str, messenger
+    ) -> typing.Optional[BroadcastProgress]:
+        progress = self._broadcasts.get((name, messenger))
+
+        if progress is not None:
+            return replace(progress, failed=list(progress.failed))
+
+    async def save_broadcast_progress(
+        self, name: str, messenger, progress: BroadcastProgress
+    ):
+        self._broadcasts[(name, messenger)] = replace(
+            progress, failed=list(progress.failed)
+        )
@@ -0,0 +1,336 @@
+"""
+Survey analytics over compact columnar copies of `dialogue_steps` and
+`dialogs`.
+
+Steps are kept as NumPy arrays, questions and answers are dictionary
+encoded into integer codes. The arrays are cached on disk, so `refresh`
+only reads steps and dialogs added since the previous refresh and dialogs
+finished since then. Requires `numpy`, which is installed by the
+`analytics` extra.
+"""
+import json
+import os
+import typing
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+CACHE_VERSION = 2
+
+STEP_COLUMNS = {
+    "id": np.int64,
+    "dialog": np.int64,
+    "question": np.int32,
+    "answer": np.int32,
+    "created_at": np.float64,
+}
+
+# `finished_at` of an unfinished dialog is NaN
+DIALOG_COLUMNS = {
+    "id": np.int64,
+    "created_at": np.float64,
+    "finished_at": np.float64,
+    "completed": np.bool_,
+    "cancelled": np.bool_,
+}
+
+
+@dataclass
+class CrossTab:
+    rows: typing.List[str]  # answers to the first question
+    columns: typing.List[str]  # answers to the second question
+    counts: np.ndarray  # dialogs by answers, shape (len(rows), len(columns))
+
+
+def _empty(columns: dict) -> dict:
+    return {name: np.empty(0, dtype=dtype) for name, dtype in columns.items()}
+
+
+def _concat(arrays: dict, chunks: list) -> dict:
+    if not chunks:
+        return arrays
+
+    return {
+        name: np.concatenate([array] + [chunk[name] for chunk in chunks])
+        for name, array in arrays.items()
+    }
+
+
+def _timestamp(value: typing.Optional[datetime]) -> float:
+    return np.nan if value is None else value.timestamp()
+
+
+def _encode(codes: dict, values: list, value) -> int:
+    code = codes.get(value)
+
+    if code is None:
+        code = codes[value] = len(values)
+        values.append(value)
+
+    return code
+
+
+class SurveyAnalytics:
+    """
+    Drop-off funnels, answer cross-tabs and completion time percentiles of
+    dialogs stored by `PostgreStorage`.
+
+    Steps created less than `settle_interval` seconds ago aren't loaded, a
+    transaction still inserting steps with lower ids would be missed
+    otherwise.
+    """
+
+    def __init__(self, storage, cache_dir: str, settle_interval: float = 60):
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.settle_interval = settle_interval
+
+        self.steps = _empty(STEP_COLUMNS)
+        self.dialogs = _empty(DIALOG_COLUMNS)
+        self.question_ids = []  # code -> question id
+        self.answers = []  # code -> answer text
+
+        self._question_codes = {}
+        self._answer_codes = {}
+        self._generation = 0
+        # Dialogs finished since then are reloaded by the next refresh
+        self._finished_since = None
+
+        self._load()
+
+    def _path(self, name: str, generation: int) -> str:
+        return os.path.join(self.cache_dir, "{}.{}.npy".format(name, generation))
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.cache_dir, "meta.json")
+
+    def _load(self):
+        try:
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+
+        if meta["version"] != CACHE_VERSION:
+            return
+
+        generation = meta["generation"]
+        self.steps = {
+            name: np.load(self._path("steps." + name, generation))
+            for name in STEP_COLUMNS
+        }
+        self.dialogs = {
+            name: np.load(self._path("dialogs." + name, generation))
+            for name in DIALOG_COLUMNS
+        }
+        self.question_ids = meta["question_ids"]
+        self.answers = meta["answers"]
+        self._question_codes = {id_: code for code, id_ in enumerate(self.question_ids)}
+        self._answer_codes = {text: code for code, text in enumerate(self.answers)}
+        self._generation = generation
+
+        if meta["finished_since"] is not None:
+            self._finished_since = datetime.fromtimestamp(
+                meta["finished_since"], timezone.utc
+            )
+
+    def _save(self):
+        # Arrays of a new generation are written first and the meta file is
+        # replaced atomically, so an interrupted save keeps the previous cache
+        os.makedirs(self.cache_dir, exist_ok=True)
+        generation = self._generation + 1
+
+        for prefix, arrays in (("steps.", self.steps), ("dialogs.", self.dialogs)):
+            for name, array in arrays.items():
+                np.save(self._path(prefix + name, generation), array)
+
+        meta = {
+            "version": CACHE_VERSION,
+            "generation": generation,
+            "question_ids": self.question_ids,
+            "answers": self.answers,
+            "finished_since": (
+                self._finished_since.timestamp() if self._finished_since else None
+            ),
+        }
+        with open(self._meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(self._meta_path + ".tmp", self._meta_path)
+
+        for name in list(STEP_COLUMNS) + list(DIALOG_COLUMNS):
+            for prefix in ("steps.", "dialogs."):
+                path = self._path(prefix + name, self._generation)
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self._generation = generation
+
+    def _encode_steps(self, batch: list) -> dict:
+        count = len(batch)
+        question_codes = (
+            _encode(self._question_codes, self.question_ids, row.question_id)
+            for row in batch
+        )
+        answer_codes = (
+            _encode(self._answer_codes, self.answers, row.answer) for row in batch
+        )
+
+        return {
+            "id": np.fromiter((row.id for row in batch), np.int64, count),
+            "dialog": np.fromiter((row.dialog_id for row in batch), np.int64, count),
+            "question": np.fromiter(question_codes, np.int32, count),
+            "answer": np.fromiter(answer_codes, np.int32, count),
+            "created_at": np.fromiter(
+                (row.created_at.timestamp() for row in batch), np.float64, count
+            ),
+        }
+
+    @staticmethod
+    def _encode_dialogs(batch: list) -> dict:
+        count = len(batch)
+
+        return {
+            "id": np.fromiter((row.id for row in batch), np.int64, count),
+            "created_at": np.fromiter(
+                (_timestamp(row.created_at) for row in batch), np.float64, count
+            ),
+            "finished_at": np.fromiter(
+                (_timestamp(row.finished_at) for row in batch), np.float64, count
+            ),
+            "completed": np.fromiter(
+                (bool(row.completed) for row in batch), np.bool_, count
+            ),
+            "cancelled": np.fromiter(
+                (bool(row.cancelled) for row in batch), np.bool_, count
+            ),
+        }
+
+    async def refresh(self) -> int:
+        """Loads new steps and changed dialogs, returns the number of new steps."""
+        settled_at = datetime.now(timezone.utc) - timedelta(
+            seconds=self.settle_interval
+        )
+        step_ids = self.steps["id"]
+        after_id = int(step_ids[-1]) if len(step_ids) else None
+
+        chunks = []
+        async for batch in self.storage.iter_step_batches(
+            after_id=after_id, created_before=settled_at
+        ):
+            chunks.append(self._encode_steps(batch))
+
+        self.steps = _concat(self.steps, chunks)
+        new_steps = sum(len(chunk["id"]) for chunk in chunks)
+
+        # Dialogs change only when they are finished, so new dialogs and the
+        # ones finished since the previous refresh are loaded. Paused and
+        # abandoned dialogs may stay unfinished forever
+        dialog_ids = self.dialogs["id"]
+        last_id = int(dialog_ids[-1]) if len(dialog_ids) else None
+
+        chunks = []
+        async for batch in self.storage.iter_dialog_batches(
+            from_id=None if last_id is None else last_id + 1,
+            finished_since=self._finished_since,
+        ):
+            chunks.append(self._encode_dialogs(batch))
+
+        changed = _concat(_empty(DIALOG_COLUMNS), chunks)
+        known = changed["id"] <= (last_id if last_id is not None else -1)
+        positions = np.searchsorted(dialog_ids, changed["id"][known])
+
+        for name, array in self.dialogs.items():
+            array[positions] = changed[name][known]
+
+        self.dialogs = _concat(
+            self.dialogs, [{name: array[~known] for name, array in changed.items()}]
+        )
+        self._finished_since = settled_at
+
+        self._save()
+
+        return new_steps
+
+    def _question_code(self, question) -> typing.Optional[int]:
+        # A question or its id
+        return self._question_codes.get(getattr(question, "id", question))
+
+    def _last_answers(self, question) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Returns dialogs, which answered the question, and their last answers."""
+        code = self._question_code(question)
+
+        if code is None:
+            return np.empty(0, np.int64), np.empty(0, np.int32)
+
+        mask = self.steps["question"] == code
+        # Steps are ordered by id, the first occurrence in the reversed
+        # arrays is the last answer of a dialog
+        dialogs = self.steps["dialog"][mask][::-1]
+        answers = self.steps["answer"][mask][::-1]
+        dialogs, index = np.unique(dialogs, return_index=True)
+
+        return dialogs, answers[index]
+
+    def funnel(self, questions: list) -> typing.List[int]:
+        """
+        Returns the number of dialogs, which answered each of the questions,
+        e.g. the questions of a quiz in the order they are asked.
+        """
+        if not questions:
+            return []
+
+        positions = np.full(len(self.question_ids) + 1, -1, dtype=np.int64)
+
+        for position, question in enumerate(questions):
+            code = self._question_code(question)
+            if code is not None:
+                positions[code] = position
+
+        step_positions = positions[self.steps["question"]]
+        mask = step_positions >= 0
+        # Every dialog is counted once per question
+        keys = np.unique(
+            self.steps["dialog"][mask] * len(questions) + step_positions[mask]
+        )
+
+        return np.bincount(keys % len(questions), minlength=len(questions)).tolist()
+
+    def crosstab(self, first_question, second_question) -> CrossTab:
+        """Counts dialogs by their last answers to both questions."""
+        first_dialogs, first_answers = self._last_answers(first_question)
+        second_dialogs, second_answers = self._last_answers(second_question)
+
+        _, first_index, second_index = np.intersect1d(
+            first_dialogs, second_dialogs, assume_unique=True, return_indices=True
+        )
+        rows, row_index = np.unique(first_answers[first_index], return_inverse=True)
+        columns, column_index = np.unique(
+            second_answers[second_index], return_inverse=True
+        )
+
+        counts = np.bincount(
+            row_index * len(columns) + column_index,
+            minlength=len(rows) * len(columns),
+        ).reshape(len(rows), len(columns))
+
+        return CrossTab(
+            rows=[self.answers[code] for code in rows],
+            columns=[self.answers[code] for code in columns],
+            counts=counts,
+        )
+
+    def completion_time_percentiles(
+        self, percentiles: typing.Sequence[float] = (50, 90, 99)
+    ) -> typing.Dict[float, typing.Optional[float]]:
+        """Returns percentiles of completed dialogs duration in seconds."""
+        mask = self.dialogs["completed"] & ~np.isnan(self.dialogs["finished_at"])
+        durations = self.dialogs["finished_at"][mask] - self.dialogs["created_at"][mask]
+
+        if not len(durations):
+            return {percentile: None for percentile in percentiles}
+
+        values = np.percentile(durations, percentiles)
+
+        return dict(zip(percentiles, values.tolist()))
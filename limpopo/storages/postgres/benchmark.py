@@ -0,0 +1,473 @@
+"""
+Micro-benchmarks of `PostgreStorage` methods against a scratch database
+migrated to the head revision. Every method is run by `concurrency`
+workers for `duration` seconds, for every combination of the swept
+concurrency levels, pool sizes and table sizes:
+
+    python -m limpopo.storages.postgres.benchmark URI \
+        --concurrency 1,8,32 --pool-size 5,20 --steps 0,1000000,5000000 \
+        --output results.jsonl --baseline previous.jsonl
+
+Tables are seeded with synthetic dialogs of 10 steps up to the number of
+`--steps`, seeded and benchmark rows are never removed. Results are
+appended to `--output` as JSON lines, one per measurement. `--baseline`
+compares them with a previous run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import typing
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from time import monotonic, perf_counter
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+from ...dto import Answer, Messengers, Respondent
+from ...helpers import percentile
+from ...question import Question
+
+QUIZ_NAME = "limpopo-benchmark"
+QUESTIONS = [
+    Question(topic="Benchmark question {}".format(index), choices=["1", "2", "3"])
+    for index in range(10)
+]
+ANSWERS = ["1", "2", "3"]
+SEED_CHUNK = 10000  # dialogs seeded in one transaction
+
+_count_steps_query = text("SELECT count(*) FROM dialogue_steps")
+
+_dialog_ids_query = text("SELECT min(id), max(id) FROM dialogs")
+
+# Every 20th seeded dialog is left open
+_seed_query = text(
+    """
+    WITH seeded_respondents AS (
+        INSERT INTO respondents (id, messenger)
+        SELECT 'bench-seed-' || g, CAST('telegram' AS messengers)
+        FROM generate_series(:start, :stop) as g
+        ON CONFLICT DO NOTHING
+    ), seeded_dialogs AS (
+        INSERT INTO dialogs (
+            respondent_id, respondent_messenger, finished_at, completed
+        )
+        SELECT
+            'bench-seed-' || g,
+            CAST('telegram' AS messengers),
+            CASE WHEN g % 20 = 0 THEN NULL ELSE now() END,
+            g % 20 <> 0
+        FROM generate_series(:start, :stop) as g
+        RETURNING id
+    )
+    INSERT INTO dialogue_steps (dialog_id, question_id, answer)
+    SELECT d.id, q.id, CAST(1 + floor(random() * 3) AS INTEGER)::text
+    FROM seeded_dialogs as d
+    CROSS JOIN (SELECT unnest(CAST(:question_ids AS BIGINT[])) AS id) as q;
+"""
+)
+
+
+def _dialog(respondent_id: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=None,
+        service=SimpleNamespace(quiz_name=QUIZ_NAME),
+        respondent=Respondent(id=respondent_id, messenger=Messengers.telegram),
+        answer=Answer(),
+    )
+
+
+@dataclass
+class _WorkerState:
+    respondent_id: str
+    random: random.Random
+    # Range of dialog ids to read messages from
+    dialog_ids: typing.Tuple[int, int]
+    dialog: typing.Any = None
+
+
+async def _open_dialog(storage, state: _WorkerState):
+    state.dialog = _dialog(state.respondent_id)
+    state.dialog.id = await storage.create_dialog(state.dialog)
+
+
+async def _open_paused_dialog(storage, state: _WorkerState):
+    await _open_dialog(storage, state)
+    await storage.pause(state.dialog)
+
+
+async def _create_dialog(storage, state: _WorkerState):
+    await storage.create_dialog(state.dialog)
+
+
+async def _save_question_and_answer(storage, state: _WorkerState):
+    state.dialog.answer.set(state.random.choice(ANSWERS))
+    await storage.save_question_and_answer(state.dialog, state.random.choice(QUESTIONS))
+
+
+async def _get_last_dialog_id(storage, state: _WorkerState):
+    await storage.get_last_dialog_id(state.respondent_id, Messengers.telegram)
+
+
+async def _get_messages_from_dialog(storage, state: _WorkerState):
+    await storage.get_messages_from_dialog(state.random.randint(*state.dialog_ids))
+
+
+async def _close_dialog(storage, state: _WorkerState):
+    await storage.close_dialog(state.dialog, True)
+
+
+async def _pause(storage, state: _WorkerState):
+    await storage.pause(state.dialog)
+
+
+async def _cancel_pause(storage, state: _WorkerState):
+    await storage.cancel_pause(state.dialog.id)
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Timed call
+    run: typing.Callable
+    # Untimed call before every run, e.g. to open the dialog closed by the run
+    prepare: typing.Optional[typing.Callable] = None
+
+
+BENCHMARKS = {
+    benchmark.name: benchmark
+    for benchmark in (
+        Benchmark("create_dialog", _create_dialog),
+        Benchmark("save_question_and_answer", _save_question_and_answer),
+        Benchmark("get_last_dialog_id", _get_last_dialog_id),
+        Benchmark("get_messages_from_dialog", _get_messages_from_dialog),
+        Benchmark("close_dialog", _close_dialog, prepare=_open_dialog),
+        Benchmark("pause", _pause, prepare=_open_dialog),
+        Benchmark("cancel_pause", _cancel_pause, prepare=_open_paused_dialog),
+    )
+}
+
+
+@dataclass
+class Measurement:
+    iterations: int = 0
+    errors: int = 0
+    latencies: typing.List[float] = field(default_factory=list)
+
+
+async def _run_worker(
+    storage,
+    benchmark: Benchmark,
+    state: _WorkerState,
+    deadline: float,
+    measurement: typing.Optional[Measurement],
+):
+    while monotonic() < deadline:
+        try:
+            if benchmark.prepare is not None:
+                await benchmark.prepare(storage, state)
+
+            started_at = perf_counter()
+            await benchmark.run(storage, state)
+            latency = perf_counter() - started_at
+        except storage.io_exceptions as exc:
+            logging.warning("{} failed: {!r}".format(benchmark.name, exc))
+
+            if measurement is not None:
+                measurement.errors += 1
+            continue
+
+        if measurement is not None:
+            measurement.iterations += 1
+            measurement.latencies.append(latency)
+
+
+async def run_benchmark(
+    storage,
+    benchmark: Benchmark,
+    concurrency: int,
+    duration: float,
+    warm_up: float,
+    run_id: str,
+) -> dict:
+    """
+    Runs the benchmark by `concurrency` workers, after `warm_up` seconds of
+    unmeasured runs, returns throughput and latencies in milliseconds.
+    """
+    async with storage._engine.connect() as conn:
+        first_id, last_id = (await conn.execute(_dialog_ids_query)).fetchone()
+
+    states = []
+    for index in range(concurrency):
+        state = _WorkerState(
+            respondent_id="bench-{}-{}-{}".format(run_id, benchmark.name, index),
+            random=random.Random(index),
+            dialog_ids=(first_id or 1, last_id or 1),
+        )
+        # Workers of every benchmark have an open dialog
+        await _open_dialog(storage, state)
+        states.append(state)
+
+    if warm_up > 0:
+        deadline = monotonic() + warm_up
+        await asyncio.gather(
+            *(_run_worker(storage, benchmark, s, deadline, None) for s in states)
+        )
+
+    measurement = Measurement()
+    started_at = monotonic()
+    deadline = started_at + duration
+    await asyncio.gather(
+        *(_run_worker(storage, benchmark, s, deadline, measurement) for s in states)
+    )
+    elapsed = monotonic() - started_at
+
+    # Rows buffered by the write-behind mode are part of the measured work
+    await storage.flush()
+
+    latencies = sorted(measurement.latencies)
+    result = {
+        "iterations": measurement.iterations,
+        "errors": measurement.errors,
+        "duration": elapsed,
+        "ops_per_sec": measurement.iterations / elapsed,
+        "latency_ms": None,
+    }
+
+    if latencies:
+        result["latency_ms"] = {
+            "mean": sum(latencies) / len(latencies) * 1000,
+            "p50": percentile(latencies, 50) * 1000,
+            "p90": percentile(latencies, 90) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000,
+        }
+
+    return result
+
+
+async def seed_steps(storage, steps: int) -> int:
+    """Seeds dialogs of 10 steps until the table has `steps` rows at least."""
+    await storage.create_partitions()
+
+    for question in QUESTIONS:
+        await storage.save_question(question)
+
+    async with storage._engine.connect() as conn:
+        existing = (await conn.execute(_count_steps_query)).scalar()
+
+    missing_dialogs = -(-(steps - existing) // len(QUESTIONS))
+    start = existing + 1
+
+    while missing_dialogs > 0:
+        chunk = min(SEED_CHUNK, missing_dialogs)
+
+        async with storage._engine.begin() as conn:
+            await conn.execute(
+                _seed_query,
+                {
+                    "start": start,
+                    "stop": start + chunk - 1,
+                    "question_ids": [question.id for question in QUESTIONS],
+                },
+            )
+
+        start += chunk
+        missing_dialogs -= chunk
+
+    async with storage._engine.begin() as conn:
+        await conn.execute(text("ANALYZE"))
+        total = (await conn.execute(_count_steps_query)).scalar()
+
+    logging.info("dialogue_steps has {} rows".format(total))
+
+    return total
+
+
+def _version() -> typing.Optional[str]:
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        return None
+
+    try:
+        return version("limpopo")
+    except PackageNotFoundError:
+        return None
+
+
+async def run_suite(
+    uri: str,
+    benchmarks: typing.List[str],
+    concurrency_levels: typing.List[int],
+    pool_sizes: typing.List[int],
+    table_sizes: typing.List[int],
+    duration: float,
+    warm_up: float,
+    write_behind: bool,
+) -> typing.AsyncIterator[dict]:
+    from .storage import PostgreSettings, PostgreStorage
+
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    meta = {"run_id": run_id, "limpopo": _version(), "write_behind": write_behind}
+
+    # Tables only grow, so sizes are swept in ascending order
+    for steps in sorted(table_sizes):
+        seeder = PostgreStorage(uri, settings=PostgreSettings(pool_size=1))
+        table_steps = await seed_steps(seeder, steps)
+
+        async with seeder._engine.connect() as conn:
+            meta["postgres"] = (
+                await conn.execute(text("SHOW server_version"))
+            ).scalar()
+
+        await seeder.dispose()
+
+        for pool_size in pool_sizes:
+            storage = PostgreStorage(
+                uri,
+                settings=PostgreSettings(
+                    pool_size=pool_size, max_overflow=0, write_behind=write_behind
+                ),
+            )
+            await storage.warm_up()
+
+            try:
+                for name in benchmarks:
+                    for concurrency in concurrency_levels:
+                        result = await run_benchmark(
+                            storage,
+                            BENCHMARKS[name],
+                            concurrency,
+                            duration,
+                            warm_up,
+                            run_id,
+                        )
+
+                        yield dict(
+                            meta,
+                            benchmark=name,
+                            concurrency=concurrency,
+                            pool_size=pool_size,
+                            table_steps=table_steps,
+                            recorded_at=datetime.now(timezone.utc).isoformat(),
+                            **result
+                        )
+            finally:
+                await storage.dispose()
+
+
+def _key(record: dict) -> tuple:
+    return (
+        record["benchmark"],
+        record["concurrency"],
+        record["pool_size"],
+        record["table_steps"],
+        record["write_behind"],
+    )
+
+
+def load_results(path: str) -> typing.Dict[tuple, dict]:
+    """Returns the last record of every measurement in the JSON lines file."""
+    results = {}
+
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                results[_key(record)] = record
+
+    return results
+
+
+def format_result(record: dict, baseline: typing.Optional[dict] = None) -> str:
+    latency = record["latency_ms"] or {}
+    line = "{:<26} c={:<4} pool={:<4} steps={:<10} {:>10.1f} op/s".format(
+        record["benchmark"],
+        record["concurrency"],
+        record["pool_size"],
+        record["table_steps"],
+        record["ops_per_sec"],
+    )
+    line += "  p50 {:>8.2f} ms  p99 {:>8.2f} ms".format(
+        latency.get("p50", 0), latency.get("p99", 0)
+    )
+
+    if baseline and baseline["ops_per_sec"] and baseline["latency_ms"]:
+        line += "  ops {:+.1f}%  p99 {:+.1f}%".format(
+            (record["ops_per_sec"] / baseline["ops_per_sec"] - 1) * 100,
+            (latency.get("p99", 0) / baseline["latency_ms"]["p99"] - 1) * 100,
+        )
+
+    return line
+
+
+def _int_list(value: str) -> typing.List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m limpopo.storages.postgres.benchmark",
+        description="Benchmarks PostgreStorage methods",
+    )
+    parser.add_argument("uri", help="postgresql+asyncpg:// URI of a scratch database")
+    parser.add_argument(
+        "--benchmarks",
+        default=",".join(BENCHMARKS),
+        help="comma separated methods, all by default",
+    )
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 8, 32])
+    parser.add_argument("--pool-size", type=_int_list, default=[5])
+    parser.add_argument(
+        "--steps", type=_int_list, default=[0], help="rows of dialogue_steps"
+    )
+    parser.add_argument("--duration", type=float, default=5, help="seconds")
+    parser.add_argument("--warm-up", type=float, default=1, help="seconds")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--output", help="JSON lines file to append results to")
+    parser.add_argument("--baseline", help="JSON lines file of a previous run")
+
+    args = parser.parse_args()
+    benchmarks = args.benchmarks.split(",")
+
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+
+    logging.basicConfig(level=logging.INFO)
+
+    baseline = load_results(args.baseline) if args.baseline else {}
+    output = open(args.output, "a") if args.output else None
+
+    async def run():
+        async for record in run_suite(
+            args.uri,
+            benchmarks,
+            args.concurrency,
+            args.pool_size,
+            args.steps,
+            args.duration,
+            args.warm_up,
+            args.write_behind,
+        ):
+            print(format_result(record, baseline.get(_key(record))))
+            sys.stdout.flush()
+
+            if output is not None:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run())
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
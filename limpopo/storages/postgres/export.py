@@ -0,0 +1,272 @@
+"""
+Export of survey results with one row per dialog and one column per
+question. Results are streamed from the storage and written incrementally,
+so memory use doesn't depend on the size of the export. The questions and
+results are read from the same snapshot of the database:
+
+    python -m limpopo.storages.postgres.export URI results.csv
+    python -m limpopo.storages.postgres.export URI results.parquet \
+        --since 2021-01-01 --until 2021-02-01 --status completed
+
+Parquet requires `pyarrow`, which is installed by the `parquet` extra.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import typing
+from datetime import datetime
+
+DIALOG_COLUMNS = (
+    "dialog_id",
+    "respondent_id",
+    "messenger",
+    "username",
+    "first_name",
+    "last_name",
+    "extra_data",
+    "created_at",
+    "finished_at",
+    "completed",
+    "cancelled",
+)
+
+
+def question_columns(questions: typing.Dict[int, str]) -> typing.Dict[int, str]:
+    """
+    Returns a column name by question id: the question text, suffixed with
+    the id if it is taken by a dialog column.
+    """
+    columns = {}
+
+    for question_id, text in questions.items():
+        if text in DIALOG_COLUMNS:
+            text = "{} ({})".format(text, question_id)
+
+        columns[question_id] = text
+
+    return columns
+
+
+async def iter_dialog_rows(
+    storage, columns: typing.Dict[int, str], **filters
+) -> typing.AsyncIterator[dict]:
+    """
+    Pivots steps streamed by `storage.iter_results` into dicts with the
+    dialog columns and an answer by the column of its question, see
+    `question_columns`. The last answer to a question wins.
+    """
+    current = None
+
+    async for row in storage.iter_results(**filters):
+        if current is None or current["dialog_id"] != row.dialog_id:
+            if current is not None:
+                yield current
+
+            current = {
+                "dialog_id": row.dialog_id,
+                "respondent_id": row.respondent_id,
+                "messenger": row.messenger.name,
+                "username": row.username,
+                "first_name": row.first_name,
+                "last_name": row.last_name,
+                "extra_data": row.extra_data,
+                "created_at": row.created_at,
+                "finished_at": row.finished_at,
+                "completed": row.completed,
+                "cancelled": row.cancelled,
+            }
+
+        if row.question_id is not None:
+            current[columns[row.question_id]] = row.answer
+
+    if current is not None:
+        yield current
+
+
+def _to_text(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False)
+
+    return value
+
+
+class CSVWriter:
+    def __init__(self, file, columns: typing.List[str]):
+        self._writer = csv.DictWriter(file, fieldnames=columns, restval="")
+        self._writer.writeheader()
+
+    def write(self, row: dict):
+        self._writer.writerow({key: _to_text(value) for key, value in row.items()})
+
+    def close(self):
+        pass
+
+
+class JSONLWriter:
+    def __init__(self, file, columns: typing.List[str]):
+        self._file = file
+
+    def write(self, row: dict):
+        self._file.write(json.dumps(row, default=_to_text, ensure_ascii=False))
+        self._file.write("\n")
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Writes rows in row groups of `row_group_size` rows."""
+
+    def __init__(self, file, columns: typing.List[str], row_group_size: int = 10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError(
+                "Parquet export requires pyarrow, install limpopo[parquet]"
+            )
+
+        self._pyarrow = pyarrow
+        self._columns = columns
+        self._row_group_size = row_group_size
+        self._rows = []
+
+        types = {
+            "dialog_id": pyarrow.int64(),
+            "created_at": pyarrow.timestamp("us", tz="UTC"),
+            "finished_at": pyarrow.timestamp("us", tz="UTC"),
+            "completed": pyarrow.bool_(),
+            "cancelled": pyarrow.bool_(),
+        }
+        self._schema = pyarrow.schema(
+            [(column, types.get(column, pyarrow.string())) for column in columns]
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(file, self._schema)
+
+    def write(self, row: dict):
+        self._rows.append(row)
+
+        if len(self._rows) >= self._row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+
+        arrays = []
+        for field in self._schema:
+            values = [row.get(field.name) for row in self._rows]
+
+            if field.type == self._pyarrow.string():
+                values = [_to_text(value) for value in values]
+
+            arrays.append(self._pyarrow.array(values, type=field.type))
+
+        self._writer.write_table(
+            self._pyarrow.Table.from_arrays(arrays, schema=self._schema)
+        )
+        self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+WRITERS = {
+    "csv": CSVWriter,
+    "jsonl": JSONLWriter,
+    "parquet": ParquetWriter,
+}
+
+
+async def export(
+    storage,
+    file,
+    fmt: str,
+    since: typing.Optional[datetime] = None,
+    until: typing.Optional[datetime] = None,
+    status: typing.Optional[str] = None,
+) -> int:
+    """
+    Writes results to the file opened in text mode for csv and jsonl or in
+    binary mode for parquet, returns the number of exported dialogs.
+    """
+    exported = 0
+
+    # A question saved after the catalog is read would have no column
+    async with storage.snapshot() as conn:
+        columns = question_columns(dict(await storage.get_questions(conn=conn)))
+        writer = WRITERS[fmt](file, list(DIALOG_COLUMNS) + list(columns.values()))
+
+        try:
+            async for row in iter_dialog_rows(
+                storage, columns, since=since, until=until, status=status, conn=conn
+            ):
+                writer.write(row)
+                exported += 1
+        finally:
+            writer.close()
+
+    return exported
+
+
+def main():
+    from .storage import RESULT_STATUSES, PostgreSettings, PostgreStorage
+
+    parser = argparse.ArgumentParser(
+        prog="python -m limpopo.storages.postgres.export",
+        description="Exports survey results with one row per dialog",
+    )
+    parser.add_argument("uri", help="postgresql+asyncpg:// URI of the storage")
+    parser.add_argument("output", help="path of the file to write")
+    parser.add_argument(
+        "--format",
+        choices=sorted(WRITERS),
+        help="output format, taken from the output extension by default",
+    )
+    parser.add_argument(
+        "--since", type=datetime.fromisoformat, help="dialogs created since"
+    )
+    parser.add_argument(
+        "--until", type=datetime.fromisoformat, help="dialogs created before"
+    )
+    parser.add_argument("--status", choices=RESULT_STATUSES)
+
+    args = parser.parse_args()
+    fmt = args.format or os.path.splitext(args.output)[1].lstrip(".")
+
+    if fmt not in WRITERS:
+        parser.error("can't guess the format of {}, use --format".format(args.output))
+
+    logging.basicConfig(level=logging.INFO)
+
+    storage = PostgreStorage(args.uri, settings=PostgreSettings(pool_size=1))
+
+    if fmt == "parquet":
+        file = open(args.output, "wb")
+    else:
+        file = open(args.output, "w", newline="", encoding="utf-8")
+
+    with file:
+        loop = asyncio.get_event_loop()
+        exported = loop.run_until_complete(
+            export(
+                storage,
+                file,
+                fmt,
+                since=args.since,
+                until=args.until,
+                status=args.status,
+            )
+        )
+
+    logging.info("{} dialogs exported to {}".format(exported, args.output))
+
+
+if __name__ == "__main__":
+    main()
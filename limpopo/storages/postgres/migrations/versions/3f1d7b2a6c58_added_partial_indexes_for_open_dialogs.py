@@ -0,0 +1,51 @@
+"""Added partial indexes for open dialogs and active pauses
+
+Revision ID: 3f1d7b2a6c58
+Revises: e84b0d6c9f13
+Create Date: 2026-10-17 15:02:44.718203
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3f1d7b2a6c58"
+down_revision = "e84b0d6c9f13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Indexes are built concurrently to not lock big tables, which requires
+    # running outside of the migration transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "idx_dialogs_open_respondent",
+            "dialogs",
+            ["respondent_id", "respondent_messenger", "id"],
+            unique=False,
+            postgresql_where=sa.text("finished_at IS NULL"),
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "idx_dialogue_pauses_active",
+            "dialogue_pauses",
+            ["dialog_id"],
+            unique=False,
+            postgresql_where=sa.text("active"),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "idx_dialogue_pauses_active",
+            table_name="dialogue_pauses",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "idx_dialogs_open_respondent",
+            table_name="dialogs",
+            postgresql_concurrently=True,
+        )
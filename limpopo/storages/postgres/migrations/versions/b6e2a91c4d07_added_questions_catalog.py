@@ -0,0 +1,51 @@
+"""Added questions catalog
+
+Revision ID: b6e2a91c4d07
+Revises: 3f1d7b2a6c58
+Create Date: 2026-10-17 16:40:12.530981
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b6e2a91c4d07'
+down_revision = '3f1d7b2a6c58'
+branch_labels = None
+depends_on = None
+
+# Same value as `limpopo.helpers.calculate_question_id`
+QUESTION_ID = "('x' || substr(md5(question), 1, 16))::bit(64)::bigint"
+
+
+def upgrade():
+    op.create_table('questions',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('text', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.add_column('dialogue_steps', sa.Column('question_id', sa.BigInteger(), nullable=True))
+
+    op.execute(
+        "INSERT INTO questions (id, text) "
+        "SELECT DISTINCT {}, question FROM dialogue_steps "
+        "ON CONFLICT DO NOTHING".format(QUESTION_ID)
+    )
+    op.execute("UPDATE dialogue_steps SET question_id = {}".format(QUESTION_ID))
+
+    op.alter_column('dialogue_steps', 'question_id', nullable=False)
+    op.create_foreign_key('dialogue_steps_question_id_fkey', 'dialogue_steps', 'questions', ['question_id'], ['id'])
+    op.drop_column('dialogue_steps', 'question')
+
+
+def downgrade():
+    op.add_column('dialogue_steps', sa.Column('question', sa.VARCHAR(), autoincrement=False, nullable=True))
+    op.execute(
+        "UPDATE dialogue_steps SET question = questions.text "
+        "FROM questions WHERE questions.id = dialogue_steps.question_id"
+    )
+    op.alter_column('dialogue_steps', 'question', nullable=False)
+    op.drop_constraint('dialogue_steps_question_id_fkey', 'dialogue_steps', type_='foreignkey')
+    op.drop_column('dialogue_steps', 'question_id')
+    op.drop_table('questions')
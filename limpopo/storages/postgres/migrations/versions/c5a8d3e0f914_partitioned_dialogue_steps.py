@@ -0,0 +1,106 @@
+"""Partitioned dialogue_steps by created_at
+
+Revision ID: c5a8d3e0f914
+Revises: b6e2a91c4d07
+Create Date: 2026-10-17 18:12:31.046257
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c5a8d3e0f914"
+down_revision = "b6e2a91c4d07"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows aren't copied: the old table is attached as the partition
+    # of everything up to the next month, the CHECK constraint lets Postgres
+    # skip the scan on attaching
+    boundary = (
+        op.get_bind()
+        .execute(sa.text("SELECT date_trunc('month', now()) + interval '1 month'"))
+        .scalar()
+    )
+
+    op.rename_table("dialogue_steps", "dialogue_steps_legacy")
+    op.execute("ALTER INDEX dialogue_steps_pkey RENAME TO dialogue_steps_legacy_pkey")
+    op.execute(
+        "ALTER INDEX idx_dialogue_steps_fk_dialog RENAME TO idx_dialogue_steps_legacy_fk_dialog"
+    )
+    op.execute(
+        "UPDATE dialogue_steps_legacy SET created_at = 'epoch' WHERE created_at IS NULL"
+    )
+    op.execute(
+        "ALTER TABLE dialogue_steps_legacy ADD CONSTRAINT dialogue_steps_legacy_bound "
+        "CHECK (created_at IS NOT NULL AND created_at < '{}') NOT VALID".format(
+            boundary.isoformat()
+        )
+    )
+    op.execute(
+        "ALTER TABLE dialogue_steps_legacy VALIDATE CONSTRAINT dialogue_steps_legacy_bound"
+    )
+    op.alter_column("dialogue_steps_legacy", "created_at", nullable=False)
+
+    op.execute(
+        """
+        CREATE TABLE dialogue_steps (
+            id INTEGER NOT NULL DEFAULT nextval('dialogue_steps_id_seq'),
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            dialog_id INTEGER NOT NULL,
+            question_id BIGINT NOT NULL,
+            answer VARCHAR NOT NULL,
+            PRIMARY KEY (id, created_at),
+            FOREIGN KEY(dialog_id) REFERENCES dialogs (id),
+            FOREIGN KEY(question_id) REFERENCES questions (id)
+        ) PARTITION BY RANGE (created_at)
+    """
+    )
+    op.execute("ALTER SEQUENCE dialogue_steps_id_seq OWNED BY dialogue_steps.id")
+    op.create_index(
+        "idx_dialogue_steps_fk_dialog", "dialogue_steps", ["dialog_id"], unique=False
+    )
+
+    op.execute(
+        "ALTER TABLE dialogue_steps ATTACH PARTITION dialogue_steps_legacy "
+        "FOR VALUES FROM (MINVALUE) TO ('{}')".format(boundary.isoformat())
+    )
+    op.drop_constraint(
+        "dialogue_steps_legacy_bound", "dialogue_steps_legacy", type_="check"
+    )
+    # Rows out of the created partitions land here, it is expected to be empty
+    op.execute(
+        "CREATE TABLE dialogue_steps_default PARTITION OF dialogue_steps DEFAULT"
+    )
+    # Further partitions are created by PostgreStorage on start
+
+
+def downgrade():
+    op.execute(
+        """
+        CREATE TABLE dialogue_steps_flat (
+            id INTEGER NOT NULL DEFAULT nextval('dialogue_steps_id_seq'),
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            dialog_id INTEGER NOT NULL,
+            question_id BIGINT NOT NULL,
+            answer VARCHAR NOT NULL,
+            CONSTRAINT dialogue_steps_flat_pkey PRIMARY KEY (id),
+            FOREIGN KEY(dialog_id) REFERENCES dialogs (id),
+            FOREIGN KEY(question_id) REFERENCES questions (id)
+        )
+    """
+    )
+    op.execute(
+        "INSERT INTO dialogue_steps_flat "
+        "SELECT id, created_at, dialog_id, question_id, answer FROM dialogue_steps"
+    )
+    op.execute("ALTER SEQUENCE dialogue_steps_id_seq OWNED BY dialogue_steps_flat.id")
+    op.drop_table("dialogue_steps")
+
+    op.rename_table("dialogue_steps_flat", "dialogue_steps")
+    op.execute("ALTER INDEX dialogue_steps_flat_pkey RENAME TO dialogue_steps_pkey")
+    op.create_index(
+        "idx_dialogue_steps_fk_dialog", "dialogue_steps", ["dialog_id"], unique=False
+    )
@@ -0,0 +1,232 @@
+"""
+Monthly range partitions of tables partitioned by `created_at`.
+
+Future partitions are created by `PostgreStorage.warm_up` on start, run
+`create` daily (e.g. by cron) for services running for months. `retain`
+detaches or drops partitions older than the given number of days:
+
+    python -m limpopo.storages.postgres.partitions URI create --months-ahead 3
+    python -m limpopo.storages.postgres.partitions URI retain --older-than 365
+"""
+import argparse
+import asyncio
+import logging
+import typing
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+PARTITIONED_TABLES = ("dialogue_steps",)
+
+_partitions_query = text(
+    """
+    SELECT
+        p.name,
+        p.bound = 'DEFAULT' AS is_default,
+        CAST(
+            (regexp_match(p.bound, 'FROM [(]''([^'']+)''[)]'))[1]
+            AS TIMESTAMP WITH TIME ZONE
+        ) AS lower,
+        CAST(
+            (regexp_match(p.bound, 'TO [(]''([^'']+)''[)]'))[1]
+            AS TIMESTAMP WITH TIME ZONE
+        ) AS upper
+    FROM (
+        SELECT
+            c.relname AS name,
+            pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits as i
+        JOIN pg_class as c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:table AS regclass)
+    ) as p
+    ORDER BY p.name;
+"""
+)
+
+# Held until the end of the transaction, so concurrent starts of shard workers
+# create every partition once
+_lock_query = text("SELECT pg_advisory_xact_lock(hashtext(:name))")
+
+
+def add_months(day: date, months: int) -> date:
+    """Returns the first day of the month `months` after the month of `day`."""
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return "{}_p{:%Y_%m}".format(table, month)
+
+
+async def list_partitions(conn, table: str) -> list:
+    """
+    Returns partitions of the table as rows with `name`, `is_default` and
+    `lower`, `upper` bounds, a bound is None for MINVALUE and MAXVALUE.
+    """
+    result = await conn.execute(_partitions_query, {"table": table})
+    return result.fetchall()
+
+
+async def create_partitions(
+    conn, table: str, months_ahead: int, today: typing.Optional[date] = None
+) -> typing.List[str]:
+    """
+    Creates partitions of the table for the current month and `months_ahead`
+    following ones, months covered by existing partitions are skipped. Rows
+    of the month already in the default partition are moved to the new one.
+    """
+    await conn.execute(_lock_query, {"name": "limpopo.partitions.{}".format(table)})
+
+    today = today or datetime.now(timezone.utc).date()
+    partitions = await list_partitions(conn, table)
+    default = next((p.name for p in partitions if p.is_default), None)
+    partitions = [p for p in partitions if not p.is_default]
+    created = []
+
+    for months in range(months_ahead + 1):
+        start = add_months(today, months)
+        end = add_months(start, 1)
+        lower = datetime(start.year, start.month, 1, tzinfo=timezone.utc)
+        upper = datetime(end.year, end.month, 1, tzinfo=timezone.utc)
+
+        overlaps = any(
+            (p.lower is None or p.lower < upper)
+            and (p.upper is None or p.upper > lower)
+            for p in partitions
+        )
+        if overlaps:
+            continue
+
+        name = partition_name(table, start)
+        bounds = "FOR VALUES FROM ('{}') TO ('{}')".format(
+            lower.isoformat(), upper.isoformat()
+        )
+
+        if default and await _has_rows(conn, default, lower, upper):
+            await _move_default_rows(conn, table, default, name, bounds, lower, upper)
+        else:
+            await conn.execute(
+                text("CREATE TABLE {} PARTITION OF {} {}".format(name, table, bounds))
+            )
+
+        created.append(name)
+
+    return created
+
+
+async def _has_rows(conn, partition: str, lower: datetime, upper: datetime) -> bool:
+    result = await conn.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM {} "
+            "WHERE created_at >= :lower AND created_at < :upper)".format(partition)
+        ),
+        {"lower": lower, "upper": upper},
+    )
+    return result.scalar()
+
+
+async def _move_default_rows(
+    conn,
+    table: str,
+    default: str,
+    name: str,
+    bounds: str,
+    lower: datetime,
+    upper: datetime,
+):
+    # A partition can't be created while the default partition has its rows,
+    # they are moved to a standalone table, which is attached then
+    logging.warning(
+        "Default partition of {} has rows of {}, move them".format(table, name)
+    )
+
+    await conn.execute(
+        text(
+            "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(
+                name, table
+            )
+        )
+    )
+    await conn.execute(
+        text(
+            "WITH moved AS ("
+            "DELETE FROM {} WHERE created_at >= :lower AND created_at < :upper "
+            "RETURNING *"
+            ") INSERT INTO {} SELECT * FROM moved".format(default, name)
+        ),
+        {"lower": lower, "upper": upper},
+    )
+    await conn.execute(
+        text("ALTER TABLE {} ATTACH PARTITION {} {}".format(table, name, bounds))
+    )
+
+
+async def apply_retention(
+    conn, table: str, older_than: timedelta, drop: bool = False
+) -> typing.List[str]:
+    """
+    Detaches partitions of the table, which contain only rows older than
+    `older_than`, or drops them if `drop` is set.
+    """
+    cutoff = datetime.now(timezone.utc) - older_than
+    removed = []
+
+    for partition in await list_partitions(conn, table):
+        if partition.is_default or partition.upper is None:
+            continue
+
+        if partition.upper > cutoff:
+            continue
+
+        if drop:
+            statement = "DROP TABLE {}".format(partition.name)
+        else:
+            statement = "ALTER TABLE {} DETACH PARTITION {}".format(
+                table, partition.name
+            )
+
+        await conn.execute(text(statement))
+        removed.append(partition.name)
+
+    return removed
+
+
+def main():
+    from .storage import PostgreSettings, PostgreStorage
+
+    parser = argparse.ArgumentParser(
+        prog="python -m limpopo.storages.postgres.partitions",
+        description="Maintains partitions of limpopo tables",
+    )
+    parser.add_argument("uri", help="postgresql+asyncpg:// URI of the storage")
+    subparsers = parser.add_subparsers(dest="command")
+
+    create = subparsers.add_parser("create", help="create future partitions")
+    create.add_argument("--months-ahead", type=int, default=None)
+
+    retain = subparsers.add_parser("retain", help="remove old partitions")
+    retain.add_argument("--older-than", type=int, required=True, help="days")
+    retain.add_argument(
+        "--drop", action="store_true", help="drop partitions instead of detaching"
+    )
+
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.error("command is required")
+
+    logging.basicConfig(level=logging.INFO)
+
+    storage = PostgreStorage(args.uri, settings=PostgreSettings(pool_size=1))
+
+    if args.command == "create":
+        coro = storage.create_partitions(args.months_ahead)
+    else:
+        coro = storage.apply_retention(timedelta(days=args.older_than), args.drop)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(coro)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,526 @@
-from sqlalchemy import select, text
-from sqlalchemy.dialects.postgresql import dialect, insert
+import asyncio
+import logging
+import typing
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import JSON, Integer, select, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.sql import func
 
+from ...dto import (
+    Answer,
+    BroadcastProgress,
+    Messengers,
+    QuizCounts,
+    Respondent,
+    RestoreBundle,
+)
+from ...exceptions import SettingsError
 from ..archetype import ArchetypeStorage
-from . import tables
+from . import partitions, tables
 
+RESULT_STATUSES = ("completed", "cancelled", "unfinished")
 
-class PostgreStorage(ArchetypeStorage):
-    io_exceptions = (ConnectionRefusedError, SQLAlchemyError)
+_insert_dialogue_step = insert(tables.dialogue_steps)
+_insert_question = insert(tables.questions).on_conflict_do_nothing()
+# A function is saved once per dialog, a repeated call, e.g. by a retry after
+# a lost commit, is a no-op
+_insert_called_function = insert(tables.called_functions).on_conflict_do_nothing()
+
+_insert_answer_counter = insert(tables.answer_counters)
+_upsert_answer_counter = _insert_answer_counter.on_conflict_do_update(
+    index_elements=[
+        tables.answer_counters.c.question_id,
+        tables.answer_counters.c.answer,
+    ],
+    set_={
+        "count": tables.answer_counters.c.count + _insert_answer_counter.excluded.count
+    },
+)
+
+
+def _sum_answer_counters(rows: typing.List[dict]) -> typing.List[dict]:
+    # A multi-row upsert can't touch a row twice, sorted rows are locked in the
+    # same order by concurrent flushes
+    counts = {}
+    for row in rows:
+        key = (row["question_id"], row["answer"])
+        counts[key] = counts.get(key, 0) + row["count"]
+
+    return [
+        {"question_id": question_id, "answer": answer, "count": count}
+        for (question_id, answer), count in sorted(counts.items())
+    ]
+
+
+def _increment_quiz_counter(quiz: str, messenger, field: str):
+    stmt = insert(tables.quiz_counters).values(
+        {"quiz": quiz, "messenger": messenger, field: 1}
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[tables.quiz_counters.c.quiz, tables.quiz_counters.c.messenger],
+        set_={field: tables.quiz_counters.c[field] + 1},
+    )
+
+
+# Bound parameters keep the statement text constant, so it is prepared once
+# per connection. Both lookups are served by the partial indexes on open
+# dialogs and active pauses
+_last_dialog_query = text(
+    """
+    SELECT
+        MAX(d.id) AS id
+    FROM dialogs as d
+    LEFT OUTER JOIN dialogue_pauses as dp ON dp.dialog_id = d.id AND dp.active=True
+    WHERE
+        d.respondent_id = :id
+        AND d.respondent_messenger = :messenger
+        AND d.finished_at is Null
+        AND dp.active IS NOT DISTINCT FROM CAST(:on_pause AS BOOLEAN);
+"""
+).columns(id=Integer)
+
+# Last open dialog of respondent together with everything required to restore
+# it, so restoring a dialog costs a single round trip
+_restore_bundle_query = text(
+    """
+    WITH last_dialog AS (
+        SELECT
+            d.id,
+            d.created_at
+        FROM dialogs as d
+        LEFT OUTER JOIN dialogue_pauses as dp ON dp.dialog_id = d.id AND dp.active=True
+        WHERE
+            d.respondent_id = :id
+            AND d.respondent_messenger = :messenger
+            AND d.finished_at is Null
+            AND dp.active IS NOT DISTINCT FROM CAST(:on_pause AS BOOLEAN)
+        ORDER BY d.id DESC
+        LIMIT 1
+    )
+    SELECT
+        ld.id,
+        (
+            SELECT
+                COALESCE(
+                    json_agg(
+                        json_build_array(ds.question_id, ds.answer)
+                        ORDER BY ds.created_at, ds.id
+                    ),
+                    '[]'
+                )
+            FROM dialogue_steps as ds
+            -- Steps are never older than their dialog, partitions are pruned
+            WHERE ds.dialog_id = ld.id AND ds.created_at >= ld.created_at
+        ) AS messages,
+        (
+            SELECT
+                COALESCE(json_agg(cf.hash ORDER BY cf.created_at), '[]')
+            FROM called_functions as cf
+            WHERE cf.dialog_id = ld.id
+        ) AS called_functions
+    FROM last_dialog as ld;
+"""
+).columns(id=Integer, messages=JSON, called_functions=JSON)
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces single-row inserts coming from all live dialogs into
+    multi-row inserts, which are flushed in one transaction when the buffer
+    reaches `batch_size` rows or `batch_delay` seconds after the first
+    pending row, whichever comes first.
 
-    def __init__(self, uri):
-        self._engine = create_async_engine(uri)
+    Every `put` returns a future that is resolved only after the rows'
+    transaction has been committed. Rows put at once are committed or fail
+    together. Flushes are serialized, so rows of a dialog are written in the
+    order they were put.
+    """
+
+    def __init__(self, engine, batch_size: int, batch_delay: float, reducers=None):
+        self._engine = engine
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        # stmt -> function merging rows of the statement before a flush
+        self._reducers = reducers or {}
+
+        # (rows, future), rows are tuples of (stmt, values)
+        self._pending = []
+        self._pending_rows = 0
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def put(self, *rows: typing.Tuple[typing.Any, dict]) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((rows, future))
+        self._pending_rows += len(rows)
+
+        if self._pending_rows >= self._batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._batch_delay, self._start_flush)
+
+        return future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            batch, self._pending = self._pending, []
+            self._pending_rows = 0
+
+            if not batch:
+                return
+
+            try:
+                await self._write(batch)
+            except Exception as exc:
+                logging.error(
+                    "Can't flush {} buffered puts at once: {!r}".format(len(batch), exc)
+                )
+                await self._write_one_by_one(batch)
+            else:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def _write(self, batch):
+        grouped = {}
+        for rows, _ in batch:
+            for stmt, values in rows:
+                grouped.setdefault(stmt, []).append(values)
 
-    async def save_question_and_answer(self, dialog, question):
         async with self._engine.begin() as conn:
-            await conn.execute(
-                tables.dialogue_steps.insert().values(
-                    {
-                        "dialog_id": dialog.id,
-                        "question": question.plain_text,
-                        "answer": dialog.answer.text,
-                    }
+            for stmt, values in grouped.items():
+                if stmt in self._reducers:
+                    values = self._reducers[stmt](values)
+
+                await conn.execute(stmt.values(values))
+
+    async def _write_one_by_one(self, batch):
+        # A bad put fails only its own future instead of every put of the batch,
+        # which would be put again by retries of the other dialogs
+        errors = {}
+
+        try:
+            async with self._engine.begin() as conn:
+                for rows, future in batch:
+                    try:
+                        async with conn.begin_nested():
+                            for stmt, values in rows:
+                                await conn.execute(stmt.values(values))
+                    except Exception as exc:
+                        errors[future] = exc
+        except Exception as exc:
+            logging.error("Can't flush {} buffered puts: {!r}".format(len(batch), exc))
+            errors = {future: exc for _, future in batch}
+
+        if errors:
+            logging.error("Can't write {} buffered puts".format(len(errors)))
+
+        for _, future in batch:
+            if future.done():
+                continue
+
+            if future in errors:
+                future.set_exception(errors[future])
+            else:
+                future.set_result(None)
+
+
+class _Snapshot:
+    def __init__(self, engine):
+        self._engine = engine
+        self._conn = None
+        self._transaction = None
+
+    async def __aenter__(self):
+        self._conn = await self._engine.connect()
+        await self._conn.execution_options(
+            isolation_level="REPEATABLE READ", postgresql_readonly=True
+        )
+        self._transaction = await self._conn.begin()
+        return self._conn
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await self._transaction.rollback()
+        finally:
+            await self._conn.close()
+
+
+@dataclass
+class PostgreSettings:
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    # Connections older than `pool_recycle` seconds are reopened, -1 disables it
+    pool_recycle: int = -1
+    pool_pre_ping: bool = False
+    # Prepared statements cached by every connection, 0 disables the cache
+    statement_cache_size: int = 100
+    # Open `pool_size` connections and prepare hot statements on start
+    warm_up: bool = True
+    # Monthly partitions created in advance, see `partitions`
+    partitions_ahead: int = 2
+    # Maintain answer and quiz counters along with steps and dialogs
+    counters: bool = False
+    # Buffer inserts of steps and function calls, see `WriteBehindBuffer`
+    write_behind: bool = False
+    # Rows flushed at once by the buffer, and seconds a row waits for others
+    batch_size: int = 500
+    batch_delay: float = 0.005
+
+    def __post_init__(self):
+        if not isinstance(self.batch_size, int) or self.batch_size < 1:
+            raise SettingsError(
+                "PostgreSettings field `batch_size` must be a positive int"
+            )
+
+        if not isinstance(self.batch_delay, (int, float)) or self.batch_delay < 0:
+            raise SettingsError(
+                "PostgreSettings field `batch_delay` must be a non-negative number"
+            )
+
+        for field in (
+            "pool_size",
+            "max_overflow",
+            "statement_cache_size",
+            "partitions_ahead",
+        ):
+            value = getattr(self, field)
+            if not isinstance(value, int) or value < 0:
+                raise SettingsError(
+                    "PostgreSettings field `{}` must be a non-negative int".format(
+                        field
+                    )
                 )
+
+        if not isinstance(self.pool_timeout, (int, float)):
+            raise SettingsError(
+                "PostgreSettings field `pool_timeout` must be of the int or float type"
+            )
+
+        if not isinstance(self.pool_recycle, int):
+            raise SettingsError(
+                "PostgreSettings field `pool_recycle` must be of the int type"
             )
 
-    async def save_function_call(self, dialog, funcs_hash: int):
+        for field in ("pool_pre_ping", "warm_up", "counters", "write_behind"):
+            if not isinstance(getattr(self, field), bool):
+                raise SettingsError(
+                    "PostgreSettings field `{}` must be of the bool type".format(field)
+                )
+
+
+class PostgreStorage(ArchetypeStorage):
+    io_exceptions = (ConnectionRefusedError, SQLAlchemyError)
+
+    def __init__(
+        self,
+        uri,
+        settings: typing.Optional[PostgreSettings] = None,
+    ):
+        self.settings = settings or PostgreSettings()
+        self._engine = create_async_engine(
+            uri,
+            pool_size=self.settings.pool_size,
+            max_overflow=self.settings.max_overflow,
+            pool_timeout=self.settings.pool_timeout,
+            pool_recycle=self.settings.pool_recycle,
+            pool_pre_ping=self.settings.pool_pre_ping,
+            connect_args={
+                "prepared_statement_cache_size": self.settings.statement_cache_size
+            },
+        )
+        self._buffer = None
+        # Ids of questions known to be in the catalog
+        self._saved_questions = set()
+
+        if self.settings.write_behind:
+            self._buffer = WriteBehindBuffer(
+                self._engine,
+                self.settings.batch_size,
+                self.settings.batch_delay,
+                reducers={_upsert_answer_counter: _sum_answer_counters},
+            )
+
+    async def flush(self):
+        if self._buffer is not None:
+            await self._buffer.flush()
+
+    async def dispose(self):
+        """Flushes buffered rows and closes connections of the pool."""
+        await self.flush()
+        await self._engine.dispose()
+
+    async def _execute(self, stmt, params=None, conn=None):
+        if conn:
+            return await conn.execute(stmt, params)
+
         async with self._engine.begin() as conn:
-            await conn.execute(
-                tables.called_functions.insert().values(
-                    {"hash": funcs_hash, "dialog_id": dialog.id}
+            return await conn.execute(stmt, params)
+
+    async def create_partitions(self, months_ahead: typing.Optional[int] = None):
+        if months_ahead is None:
+            months_ahead = self.settings.partitions_ahead
+
+        async with self._engine.begin() as conn:
+            for table in partitions.PARTITIONED_TABLES:
+                created = await partitions.create_partitions(conn, table, months_ahead)
+
+                for name in created:
+                    logging.info("Partition {} created".format(name))
+
+    async def apply_retention(self, older_than: timedelta, drop: bool = False):
+        async with self._engine.begin() as conn:
+            for table in partitions.PARTITIONED_TABLES:
+                removed = await partitions.apply_retention(
+                    conn, table, older_than, drop=drop
+                )
+
+                action = "dropped" if drop else "detached"
+
+                for name in removed:
+                    logging.info("Partition {} {}".format(name, action))
+
+    async def warm_up(self):
+        """
+        Creates future partitions, then opens `pool_size` connections and
+        prepares the hot statements on every one of them, so the first
+        requests after start don't pay for connection setup and statement
+        parsing.
+        """
+        try:
+            await self.create_partitions()
+        except self.io_exceptions as exc:
+            logging.warning("Can't create partitions: {!r}".format(exc))
+
+        if not self.settings.warm_up or not self.settings.pool_size:
+            return
+
+        try:
+            await asyncio.gather(
+                *(
+                    self._warm_up_connection(index)
+                    for index in range(self.settings.pool_size)
                 )
             )
+        except self.io_exceptions as exc:
+            logging.warning("Can't warm up the storage: {!r}".format(exc))
+            return
+
+        logging.info("Storage warmed up {} connections".format(self.settings.pool_size))
+
+    async def _warm_up_connection(self, index: int):
+        # Hot statements are run for a dummy dialog, which is rolled back. Every
+        # connection writes its own rows, otherwise they wait for each other's
+        # row locks
+        name = "limpopo-warm-up-{}".format(index)
+        dialog = SimpleNamespace(
+            id=None,
+            service=SimpleNamespace(quiz_name=name),
+            respondent=Respondent(id=name, messenger=Messengers.telegram),
+            answer=Answer(),
+        )
+        question = SimpleNamespace(id=-index, plain_text="")
+
+        async with self._engine.connect() as conn:
+            transaction = await conn.begin()
+
+            try:
+                dialog.id = await self.create_dialog(dialog, conn=conn)
+                await self.save_question_and_answer(dialog, question, conn=conn)
+                await self.save_function_call(dialog, 0, conn=conn)
+                await self.restore_bundle(
+                    dialog.respondent.id, dialog.respondent.messenger, conn=conn
+                )
+                await self.get_last_dialog_id(
+                    dialog.respondent.id,
+                    dialog.respondent.messenger,
+                    on_pause=True,
+                    conn=conn,
+                )
+
+                for is_complete in (True, False):
+                    await self.close_dialog(dialog, is_complete, conn=conn)
+            finally:
+                await transaction.rollback()
+
+    async def save_question(self, question, conn=None):
+        """Adds the question to the catalog, once per question and process."""
+        if question.id in self._saved_questions:
+            return
+
+        await self._execute(
+            _insert_question.values(id=question.id, text=question.plain_text),
+            conn=conn,
+        )
+
+        # A question saved by a foreign transaction may be rolled back
+        if not conn:
+            self._saved_questions.add(question.id)
+
+    async def save_question_and_answer(self, dialog, question, conn=None):
+        await self.save_question(question, conn=conn)
+
+        values = {
+            "dialog_id": dialog.id,
+            "question_id": question.id,
+            "answer": dialog.answer.text,
+        }
+
+        counter = {
+            "question_id": question.id,
+            "answer": dialog.answer.text,
+            "count": 1,
+        }
+
+        if self._buffer is not None and not conn:
+            rows = [(_insert_dialogue_step, values)]
+
+            # The step and its counter are committed together, so a retry
+            # doesn't insert the step twice
+            if self.settings.counters:
+                rows.append((_upsert_answer_counter, counter))
+
+            await self._buffer.put(*rows)
+            return
+
+        if not conn:
+            async with self._engine.begin() as conn:
+                return await self.save_question_and_answer(dialog, question, conn=conn)
+
+        await conn.execute(tables.dialogue_steps.insert().values(values))
+
+        if self.settings.counters:
+            await conn.execute(_upsert_answer_counter.values(counter))
+
+    async def save_function_call(self, dialog, funcs_hash: int, conn=None):
+        values = {"hash": funcs_hash, "dialog_id": dialog.id}
+
+        if self._buffer is not None and not conn:
+            await self._buffer.put((_insert_called_function, values))
+            return
+
+        await self._execute(_insert_called_function.values(values), conn=conn)
 
     async def create_respondent_if_not_exists(self, respondent, conn=None):
         values = {
@@ -60,66 +548,85 @@ class PostgreStorage(ArchetypeStorage):
             async with self._engine.begin() as conn:
                 await conn.execute(do_update_stmt)
 
-    async def create_dialog(self, dialog) -> int:
-        async with self._engine.begin() as conn:
-            await self.create_respondent_if_not_exists(dialog.respondent, conn=conn)
+    async def create_dialog(self, dialog, conn=None) -> int:
+        if not conn:
+            async with self._engine.begin() as conn:
+                return await self.create_dialog(dialog, conn=conn)
 
-            result = await conn.execute(
-                tables.dialogs.insert().values(
-                    {
-                        "respondent_id": dialog.respondent.id,
-                        "respondent_messenger": dialog.respondent.messenger,
-                    }
+        await self.create_respondent_if_not_exists(dialog.respondent, conn=conn)
+
+        result = await conn.execute(
+            tables.dialogs.insert().values(
+                {
+                    "respondent_id": dialog.respondent.id,
+                    "respondent_messenger": dialog.respondent.messenger,
+                }
+            )
+        )
+
+        if self.settings.counters:
+            await conn.execute(
+                _increment_quiz_counter(
+                    dialog.service.quiz_name, dialog.respondent.messenger, "started"
                 )
             )
 
-            return result.inserted_primary_key[0]
+        return result.inserted_primary_key[0]
 
     async def get_last_dialog_id(
-        self, respondent_id, respondent_messenger, on_pause=None
+        self, respondent_id, respondent_messenger, on_pause=None, conn=None
     ):
+        result = await self._execute(
+            _last_dialog_query,
+            {
+                "id": respondent_id,
+                "messenger": respondent_messenger.name,
+                "on_pause": on_pause,
+            },
+            conn=conn,
+        )
+        data = result.fetchone()
 
-        async with self._engine.begin() as conn:
-            query = text(
-                """
-                SELECT
-                    MAX(d.id)
-                FROM dialogs as d
-                LEFT OUTER JOIN dialogue_pauses as dp ON dp.dialog_id = d.id AND dp.active=True
-                WHERE
-                    d.respondent_id = :id
-                    AND d.respondent_messenger = :messenger
-                    AND d.finished_at is Null
-                    AND dp.active is :on_pause;
-            """
-            )
-
-            stmt = query.bindparams(
-                **{
-                    "id": respondent_id,
-                    "messenger": respondent_messenger.name,
-                    "on_pause": on_pause,
-                }
-            )
+        if data:
+            return data.id
 
+    async def restore_bundle(
+        self, respondent_id, respondent_messenger, on_pause=None, conn=None
+    ) -> typing.Optional[RestoreBundle]:
+        result = await self._execute(
+            _restore_bundle_query,
+            {
+                "id": respondent_id,
+                "messenger": respondent_messenger.name,
+                "on_pause": on_pause,
+            },
+            conn=conn,
+        )
+        data = result.fetchone()
 
-            stmt_compiled = stmt.compile(
-                dialect=dialect(), compile_kwargs={"literal_binds": True}
-            )
-            result = await conn.execute(stmt_compiled)
-            data = result.fetchone()
+        if data is None or data.id is None:
+            return
 
-            if data:
-                return data[0]
+        return RestoreBundle(
+            dialog_id=data.id,
+            messages=[tuple(el) for el in data.messages],
+            called_functions=data.called_functions,
+        )
 
     async def get_messages_from_dialog(self, dialog_id: int):
         async with self._engine.begin() as conn:
             result = await conn.execute(
-                select(
-                    [tables.dialogue_steps.c.question, tables.dialogue_steps.c.answer]
+                select([tables.questions.c.text, tables.dialogue_steps.c.answer])
+                .select_from(
+                    tables.dialogue_steps.join(
+                        tables.questions,
+                        tables.questions.c.id == tables.dialogue_steps.c.question_id,
+                    )
                 )
                 .where(tables.dialogue_steps.c.dialog_id == dialog_id)
-                .order_by(tables.dialogue_steps.c.created_at)
+                .order_by(
+                    tables.dialogue_steps.c.created_at, tables.dialogue_steps.c.id
+                )
             )
 
             return result.fetchall()
@@ -127,16 +634,18 @@ class PostgreStorage(ArchetypeStorage):
     async def get_called_functions_from_dialog(self, dialog_id: int):
         async with self._engine.begin() as conn:
             result = await conn.execute(
-                select(
-                    tables.called_functions.c.hash
-                )
+                select(tables.called_functions.c.hash)
                 .where(tables.called_functions.c.dialog_id == dialog_id)
                 .order_by(tables.called_functions.c.created_at)
             )
 
             return [el[0] for el in result.fetchall()]
 
-    async def close_dialog(self, dialog, is_complete):
+    async def close_dialog(self, dialog, is_complete, conn=None):
+        if not conn:
+            async with self._engine.begin() as conn:
+                return await self.close_dialog(dialog, is_complete, conn=conn)
+
         values = {"finished_at": func.now()}
 
         if is_complete:
@@ -144,11 +653,57 @@ class PostgreStorage(ArchetypeStorage):
         else:
             values["cancelled"] = True
 
-        async with self._engine.begin() as conn:
+        result = await conn.execute(
+            tables.dialogs.update()
+            .values(values)
+            .where(tables.dialogs.c.id == dialog.id)
+            .where(tables.dialogs.c.finished_at.is_(None))
+        )
+
+        # A dialog is counted once, even if it is closed again
+        if self.settings.counters and result.rowcount:
             await conn.execute(
-                tables.dialogs.update()
-                .values(values)
-                .where(tables.dialogs.c.id == dialog.id)
+                _increment_quiz_counter(
+                    dialog.service.quiz_name,
+                    dialog.respondent.messenger,
+                    "completed" if is_complete else "cancelled",
+                )
+            )
+
+    async def get_answer_counts(self, question_id: int) -> typing.Dict[str, int]:
+        """Returns the number of every answer to the question."""
+        async with self._engine.begin() as conn:
+            result = await conn.execute(
+                select(
+                    [tables.answer_counters.c.answer, tables.answer_counters.c.count]
+                ).where(tables.answer_counters.c.question_id == question_id)
+            )
+
+            return {row.answer: row.count for row in result.fetchall()}
+
+    async def get_quiz_counts(self, quiz: str, messenger=None) -> QuizCounts:
+        """Returns dialog counts of the quiz in the messenger or all messengers."""
+        counters = tables.quiz_counters
+        query = select(
+            [
+                func.coalesce(func.sum(counters.c.started), 0).label("started"),
+                func.coalesce(func.sum(counters.c.completed), 0).label("completed"),
+                func.coalesce(func.sum(counters.c.cancelled), 0).label("cancelled"),
+            ]
+        ).where(counters.c.quiz == quiz)
+
+        if messenger is not None:
+            query = query.where(counters.c.messenger == messenger)
+
+        async with self._engine.begin() as conn:
+            result = await conn.execute(query)
+            data = result.fetchone()
+
+            # SUM of bigint is numeric
+            return QuizCounts(
+                started=int(data.started),
+                completed=int(data.completed),
+                cancelled=int(data.cancelled),
             )
 
     async def pause(self, dialog):
@@ -166,6 +721,291 @@ class PostgreStorage(ArchetypeStorage):
 
             return True
 
+    async def get_uploaded_file(self, key: str, messenger) -> typing.Optional[str]:
+        async with self._engine.begin() as conn:
+            result = await conn.execute(
+                select([tables.uploaded_files.c.file_id])
+                .where(tables.uploaded_files.c.key == key)
+                .where(tables.uploaded_files.c.messenger == messenger)
+            )
+            data = result.fetchone()
+
+            if data:
+                return data[0]
+
+    async def save_uploaded_file(self, key: str, messenger, file_id: str):
+        insert_stmt = insert(tables.uploaded_files).values(
+            key=key, messenger=messenger, file_id=file_id
+        )
+        do_update_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=[
+                tables.uploaded_files.c.key,
+                tables.uploaded_files.c.messenger,
+            ],
+            set_={"file_id": file_id},
+        )
+
+        async with self._engine.begin() as conn:
+            await conn.execute(do_update_stmt)
+
+    async def iter_respondents(
+        self, messenger, after_id=None, segment=None, page_size: int = 1000
+    ) -> typing.AsyncIterator[Respondent]:
+        """
+        Yields respondents of the messenger ordered by id, read in pages of
+        `page_size` by short transactions, so a long broadcast doesn't hold
+        a snapshot. `segment` selects respondents, whose `extra_data` contains
+        it.
+        """
+        while 1:
+            query = (
+                select([tables.respondents])
+                .where(tables.respondents.c.messenger == messenger)
+                .order_by(tables.respondents.c.id)
+                .limit(page_size)
+            )
+
+            if after_id is not None:
+                query = query.where(tables.respondents.c.id > after_id)
+
+            if segment:
+                query = query.where(tables.respondents.c.extra_data.contains(segment))
+
+            rows = (await self._execute(query)).fetchall()
+
+            for row in rows:
+                yield Respondent(
+                    id=row.id,
+                    messenger=row.messenger,
+                    username=row.username,
+                    first_name=row.first_name,
+                    last_name=row.last_name,
+                    extra_data=row.extra_data,
+                )
+
+            if len(rows) < page_size:
+                return
+
+            after_id = rows[-1].id
+
+    async def get_questions(self, conn=None) -> typing.List[typing.Tuple[int, str]]:
+        """Returns (id, text) of catalog questions in order of appearance."""
+        result = await self._execute(
+            select([tables.questions.c.id, tables.questions.c.text]).order_by(
+                tables.questions.c.created_at, tables.questions.c.id
+            ),
+            conn=conn,
+        )
+
+        return [tuple(row) for row in result.fetchall()]
+
+    async def iter_results(
+        self,
+        since: typing.Optional[datetime] = None,
+        until: typing.Optional[datetime] = None,
+        status: typing.Optional[str] = None,
+        conn=None,
+    ):
+        """
+        Streams steps of dialogs created in [since, until) through a
+        server-side cursor, joined with the dialog and respondent fields.
+        Rows are ordered by dialog, a dialog without steps is a single row
+        with `question_id` None. `status` is one of RESULT_STATUSES.
+
+        Pass `conn` in a transaction to read the results in its snapshot.
+        """
+        dialogs = tables.dialogs
+        steps = tables.dialogue_steps
+        respondents = tables.respondents
+
+        steps_condition = (steps.c.dialog_id == dialogs.c.id) & (
+            steps.c.created_at >= dialogs.c.created_at
+        )
+
+        if since is not None:
+            # Lets Postgres skip older partitions of steps
+            steps_condition &= steps.c.created_at >= since
+
+        query = (
+            select(
+                [
+                    dialogs.c.id.label("dialog_id"),
+                    dialogs.c.created_at,
+                    dialogs.c.finished_at,
+                    dialogs.c.completed,
+                    dialogs.c.cancelled,
+                    respondents.c.id.label("respondent_id"),
+                    respondents.c.messenger,
+                    respondents.c.username,
+                    respondents.c.first_name,
+                    respondents.c.last_name,
+                    respondents.c.extra_data,
+                    steps.c.question_id,
+                    steps.c.answer,
+                ]
+            )
+            .select_from(
+                dialogs.join(
+                    respondents,
+                    (respondents.c.id == dialogs.c.respondent_id)
+                    & (respondents.c.messenger == dialogs.c.respondent_messenger),
+                ).outerjoin(steps, steps_condition)
+            )
+            .order_by(dialogs.c.id, steps.c.created_at, steps.c.id)
+        )
+
+        if since is not None:
+            query = query.where(dialogs.c.created_at >= since)
+
+        if until is not None:
+            query = query.where(dialogs.c.created_at < until)
+
+        if status == "completed":
+            query = query.where(dialogs.c.completed.is_(True))
+        elif status == "cancelled":
+            query = query.where(dialogs.c.cancelled.is_(True))
+        elif status == "unfinished":
+            query = query.where(dialogs.c.finished_at.is_(None))
+        elif status is not None:
+            raise ValueError(
+                "Status must be one of {}, received: {}".format(RESULT_STATUSES, status)
+            )
+
+        if conn:
+            async for row in await conn.stream(query):
+                yield row
+            return
+
+        async with self._engine.connect() as conn:
+            result = await conn.stream(query)
+
+            async for row in result:
+                yield row
+
+    def snapshot(self):
+        """
+        Returns a connection context manager with a read only REPEATABLE READ
+        transaction, reads passed the connection see the same snapshot.
+        """
+        return _Snapshot(self._engine)
+
+    async def iter_step_batches(
+        self,
+        after_id: typing.Optional[int] = None,
+        created_before: typing.Optional[datetime] = None,
+        batch_size: int = 10000,
+    ):
+        """
+        Streams (id, dialog_id, question_id, answer, created_at) of steps
+        ordered by id in lists of up to `batch_size` rows.
+        """
+        steps = tables.dialogue_steps
+        query = select(
+            [
+                steps.c.id,
+                steps.c.dialog_id,
+                steps.c.question_id,
+                steps.c.answer,
+                steps.c.created_at,
+            ]
+        ).order_by(steps.c.id)
+
+        if after_id is not None:
+            query = query.where(steps.c.id > after_id)
+
+        if created_before is not None:
+            query = query.where(steps.c.created_at < created_before)
+
+        async with self._engine.connect() as conn:
+            result = await conn.stream(query)
+
+            async for batch in result.partitions(batch_size):
+                yield batch
+
+    async def iter_dialog_batches(
+        self,
+        from_id: typing.Optional[int] = None,
+        finished_since: typing.Optional[datetime] = None,
+        batch_size: int = 10000,
+    ):
+        """
+        Streams (id, created_at, finished_at, completed, cancelled) of
+        dialogs ordered by id in lists of up to `batch_size` rows. With
+        `finished_since` older dialogs finished since then are included.
+        """
+        dialogs = tables.dialogs
+        query = select(
+            [
+                dialogs.c.id,
+                dialogs.c.created_at,
+                dialogs.c.finished_at,
+                dialogs.c.completed,
+                dialogs.c.cancelled,
+            ]
+        ).order_by(dialogs.c.id)
+
+        if from_id is not None:
+            condition = dialogs.c.id >= from_id
+
+            if finished_since is not None:
+                condition |= dialogs.c.finished_at >= finished_since
+
+            query = query.where(condition)
+
+        async with self._engine.connect() as conn:
+            result = await conn.stream(query)
+
+            async for batch in result.partitions(batch_size):
+                yield batch
+
+    async def get_broadcast_progress(
+        self, name: str, messenger
+    ) -> typing.Optional[BroadcastProgress]:
+        async with self._engine.begin() as conn:
+            result = await conn.execute(
+                select(
+                    [
+                        tables.broadcasts.c.cursor,
+                        tables.broadcasts.c.invited,
+                        tables.broadcasts.c.failed,
+                        tables.broadcasts.c.finished_at,
+                    ]
+                )
+                .where(tables.broadcasts.c.name == name)
+                .where(tables.broadcasts.c.messenger == messenger)
+            )
+            data = result.fetchone()
+
+            if data:
+                return BroadcastProgress(
+                    cursor=data.cursor,
+                    invited=data.invited,
+                    finished=data.finished_at is not None,
+                    failed=data.failed,
+                )
+
+    async def save_broadcast_progress(
+        self, name: str, messenger, progress: BroadcastProgress
+    ):
+        values = {
+            "cursor": progress.cursor,
+            "invited": progress.invited,
+            "failed": progress.failed,
+            "updated_at": func.now(),
+            "finished_at": func.now() if progress.finished else None,
+        }
+
+        insert_stmt = insert(tables.broadcasts).values(
+            name=name, messenger=messenger, **values
+        )
+        do_update_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=[tables.broadcasts.c.name, tables.broadcasts.c.messenger],
+            set_=values,
+        )
+
+        async with self._engine.begin() as conn:
+            await conn.execute(do_update_stmt)
+
     async def cancel_pause(self, dialog_id) -> bool:
         async with self._engine.begin() as conn:
             values = {"finished_at": func.now(), "active": None}
@@ -70,17 +70,87 @@ called_functions = Table(
     Column("created_at", DateTime(timezone=True), server_default=func.now()),
 )
 
+# Texts of questions, the id is `calculate_question_id` of the text
+questions = Table(
+    "questions",
+    metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column("text", String, nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+# Partitioned by month of `created_at`, see `partitions`
 dialogue_steps = Table(
     "dialogue_steps",
     metadata,
-    Column("id", Integer, primary_key=True),
-    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column(
+        "created_at",
+        DateTime(timezone=True),
+        server_default=func.now(),
+        primary_key=True,
+    ),
     Column("dialog_id", Integer, ForeignKey(dialogs.c.id), nullable=False),
-    Column("question", String, nullable=False),
+    Column("question_id", BigInteger, ForeignKey(questions.c.id), nullable=False),
     Column("answer", String, nullable=False),
+    postgresql_partition_by="RANGE (created_at)",
+)
+
+uploaded_files = Table(
+    "uploaded_files",
+    metadata,
+    Column("key", String, primary_key=True),
+    Column("messenger", Enum(Messengers), primary_key=True),
+    Column("file_id", String, nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+broadcasts = Table(
+    "broadcasts",
+    metadata,
+    Column("name", String, primary_key=True),
+    Column("messenger", Enum(Messengers), primary_key=True),
+    Column("cursor", String, nullable=True),
+    Column("invited", Integer, server_default="0", nullable=False),
+    Column("failed", JSONB, server_default="[]", nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),
+    Column("updated_at", DateTime(timezone=True), server_default=func.now()),
+    Column("finished_at", DateTime(timezone=True), nullable=True),
+)
+
+# Optional counters maintained along with steps and dialogs
+answer_counters = Table(
+    "answer_counters",
+    metadata,
+    Column("question_id", BigInteger, ForeignKey(questions.c.id), primary_key=True),
+    Column("answer", String, primary_key=True),
+    Column("count", BigInteger, server_default="0", nullable=False),
+)
+
+quiz_counters = Table(
+    "quiz_counters",
+    metadata,
+    Column("quiz", String, primary_key=True),
+    Column("messenger", Enum(Messengers), primary_key=True),
+    Column("started", BigInteger, server_default="0", nullable=False),
+    Column("completed", BigInteger, server_default="0", nullable=False),
+    Column("cancelled", BigInteger, server_default="0", nullable=False),
 )
 
 Index(
     "idx_dialog_fk_respondent", dialogs.c.respondent_id, dialogs.c.respondent_messenger
 )
 Index("idx_dialogue_steps_fk_dialog", dialogue_steps.c.dialog_id)
+# Partial indexes keep the lookup of the last open dialog an index-only probe
+Index(
+    "idx_dialogs_open_respondent",
+    dialogs.c.respondent_id,
+    dialogs.c.respondent_messenger,
+    dialogs.c.id,
+    postgresql_where=dialogs.c.finished_at.is_(None),
+)
+Index(
+    "idx_dialogue_pauses_active",
+    dialogue_pauses.c.dialog_id,
+    postgresql_where=dialogue_pauses.c.active,
+)
@@ -0,0 +1,137 @@
+"""
+Schema of `SQLiteStorage`, equivalent to `storages/postgres/tables.py`.
+
+Messengers are stored by name, timestamps as UTC text of `NOW`, booleans as
+0 / 1 and `extra_data` as JSON text. Steps aren't partitioned.
+"""
+
+NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS respondents (
+        created_at TEXT DEFAULT ({now}),
+        id TEXT NOT NULL,
+        messenger TEXT NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        extra_data TEXT,
+        PRIMARY KEY (id, messenger)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dialogs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TEXT DEFAULT ({now}),
+        finished_at TEXT,
+        cancelled INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        respondent_id TEXT NOT NULL,
+        respondent_messenger TEXT NOT NULL,
+        FOREIGN KEY (respondent_id, respondent_messenger)
+            REFERENCES respondents (id, messenger)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dialogue_pauses (
+        id INTEGER PRIMARY KEY,
+        dialog_id INTEGER NOT NULL REFERENCES dialogs (id),
+        created_at TEXT DEFAULT ({now}),
+        finished_at TEXT,
+        active INTEGER DEFAULT 1,
+        CONSTRAINT one_pause_active UNIQUE (dialog_id, active)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS called_functions (
+        hash INTEGER NOT NULL,
+        dialog_id INTEGER NOT NULL REFERENCES dialogs (id),
+        created_at TEXT DEFAULT ({now}),
+        PRIMARY KEY (hash, dialog_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL,
+        created_at TEXT DEFAULT ({now})
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dialogue_steps (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TEXT NOT NULL DEFAULT ({now}),
+        dialog_id INTEGER NOT NULL REFERENCES dialogs (id),
+        question_id INTEGER NOT NULL REFERENCES questions (id),
+        answer TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS uploaded_files (
+        key TEXT NOT NULL,
+        messenger TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        created_at TEXT DEFAULT ({now}),
+        PRIMARY KEY (key, messenger)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        name TEXT NOT NULL,
+        messenger TEXT NOT NULL,
+        cursor TEXT,
+        invited INTEGER NOT NULL DEFAULT 0,
+        failed TEXT NOT NULL DEFAULT '[]',
+        created_at TEXT DEFAULT ({now}),
+        updated_at TEXT DEFAULT ({now}),
+        finished_at TEXT,
+        PRIMARY KEY (name, messenger)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS answer_counters (
+        question_id INTEGER NOT NULL REFERENCES questions (id),
+        answer TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (question_id, answer)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS quiz_counters (
+        quiz TEXT NOT NULL,
+        messenger TEXT NOT NULL,
+        started INTEGER NOT NULL DEFAULT 0,
+        completed INTEGER NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (quiz, messenger)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_dialog_fk_respondent
+        ON dialogs (respondent_id, respondent_messenger)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_dialogue_steps_fk_dialog
+        ON dialogue_steps (dialog_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_dialogs_open_respondent
+        ON dialogs (respondent_id, respondent_messenger, id)
+        WHERE finished_at IS NULL
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_dialogue_pauses_active
+        ON dialogue_pauses (dialog_id)
+        WHERE active
+    """,
+]
+
+
+def create_schema(conn):
+    """Creates missing tables and indexes on the sqlite3 connection."""
+    with conn:
+        for statement in STATEMENTS:
+            conn.execute(statement.format(now=NOW))
@@ -0,0 +1,831 @@
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from ...dto import BroadcastProgress, Messengers, QuizCounts, Respondent, RestoreBundle
+from ...exceptions import SettingsError
+from ...helpers import json_contains
+from ..archetype import ArchetypeStorage
+from ..memory import DialogRow, ResultRow, StepRow
+from ..postgres.storage import RESULT_STATUSES
+from .schema import NOW, TIMESTAMP_FORMAT, create_schema
+
+_last_dialog_query = """
+    SELECT
+        MAX(d.id) AS id
+    FROM dialogs as d
+    LEFT OUTER JOIN dialogue_pauses as dp ON dp.dialog_id = d.id AND dp.active
+    WHERE
+        d.respondent_id = ?
+        AND d.respondent_messenger = ?
+        AND d.finished_at IS NULL
+        AND dp.active IS ?
+"""
+
+_upsert_respondent = """
+    INSERT INTO respondents
+        (id, messenger, username, first_name, last_name, extra_data)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id, messenger) DO UPDATE SET
+        username = COALESCE(excluded.username, username),
+        first_name = COALESCE(excluded.first_name, first_name),
+        last_name = COALESCE(excluded.last_name, last_name),
+        extra_data = COALESCE(excluded.extra_data, extra_data)
+"""
+
+_upsert_answer_counter = """
+    INSERT INTO answer_counters (question_id, answer, count) VALUES (?, ?, 1)
+    ON CONFLICT (question_id, answer) DO UPDATE SET count = count + 1
+"""
+
+_increment_quiz_counter = """
+    INSERT INTO quiz_counters (quiz, messenger, {field}) VALUES (?, ?, 1)
+    ON CONFLICT (quiz, messenger) DO UPDATE SET {field} = {field} + 1
+"""
+
+
+def _to_datetime(value: typing.Optional[str]) -> typing.Optional[datetime]:
+    if value is None:
+        return None
+
+    return datetime.strptime(value, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def _to_text(value: datetime) -> str:
+    # Naive datetimes are local time, like `timestamptz` parameters in Postgres
+    return value.astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)[:-3]
+
+
+def _to_bool(value) -> typing.Optional[bool]:
+    return None if value is None else bool(value)
+
+
+def _respondent(row) -> Respondent:
+    return Respondent(
+        id=row["id"],
+        messenger=Messengers[row["messenger"]],
+        username=row["username"],
+        first_name=row["first_name"],
+        last_name=row["last_name"],
+        extra_data=json.loads(row["extra_data"]) if row["extra_data"] else None,
+    )
+
+
+@dataclass
+class SQLiteSettings:
+    # Writes committed by the writer thread in one transaction at most
+    batch_size: int = 500
+    # Seconds the writer waits for more writes before a commit, writes which
+    # arrive during a commit are batched anyway
+    batch_delay: float = 0
+    # Threads serving reads, each one with its own connection
+    readers: int = 4
+    # Seconds a connection waits for a lock held by another process
+    busy_timeout: float = 5
+    # NORMAL is durable in WAL mode except for the last commits on power loss
+    synchronous: str = "NORMAL"
+    # Maintain answer and quiz counters along with steps and dialogs
+    counters: bool = False
+
+    def __post_init__(self):
+        for field in ("batch_size", "readers"):
+            value = getattr(self, field)
+            if not isinstance(value, int) or value < 1:
+                raise SettingsError(
+                    "SQLiteSettings field `{}` must be a positive int".format(field)
+                )
+
+        for field in ("batch_delay", "busy_timeout"):
+            value = getattr(self, field)
+            if not isinstance(value, (int, float)) or value < 0:
+                raise SettingsError(
+                    "SQLiteSettings field `{}` must be a non-negative number".format(
+                        field
+                    )
+                )
+
+        if self.synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise SettingsError(
+                "SQLiteSettings field `synchronous` must be one of "
+                "OFF, NORMAL, FULL, EXTRA"
+            )
+
+        if not isinstance(self.counters, bool):
+            raise SettingsError(
+                "SQLiteSettings field `counters` must be of the bool type"
+            )
+
+
+def _connect(path: str, settings: SQLiteSettings, query_only: bool = False):
+    # Transactions are started explicitly
+    conn = sqlite3.connect(
+        path,
+        timeout=settings.busy_timeout,
+        isolation_level=None,
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous={}".format(settings.synchronous))
+    conn.execute("PRAGMA foreign_keys=ON")
+
+    if query_only:
+        conn.execute("PRAGMA query_only=ON")
+
+    return conn
+
+
+def _resolve(future: asyncio.Future, ok: bool, value):
+    if future.done():
+        return
+
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+class _Writer(threading.Thread):
+    """
+    Owns the only writing connection. Writes queued by `submit` are run in
+    one transaction, up to `batch_size` of them, every write in a savepoint,
+    so a failed write doesn't roll back the others. Futures are resolved
+    after the commit.
+    """
+
+    def __init__(self, path: str, settings: SQLiteSettings):
+        super().__init__(name="limpopo-sqlite-writer", daemon=True)
+        self._path = path
+        self._settings = settings
+        self._queue = queue.Queue()
+
+    def submit(self, write: typing.Callable) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.put((write, loop, future))
+        return future
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def _collect(self, first) -> typing.Tuple[list, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self._settings.batch_delay
+
+        while len(batch) < self._settings.batch_size:
+            timeout = deadline - time.monotonic()
+
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is None:
+                return batch, True
+
+            batch.append(item)
+
+        return batch, False
+
+    def run(self):
+        conn = _connect(self._path, self._settings)
+        stopped = False
+
+        try:
+            while not stopped:
+                first = self._queue.get()
+
+                if first is None:
+                    break
+
+                batch, stopped = self._collect(first)
+                self._write(conn, batch)
+        finally:
+            conn.close()
+
+    def _write(self, conn, batch: list):
+        results = []
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+
+            for write, _, _ in batch:
+                conn.execute("SAVEPOINT write")
+
+                try:
+                    results.append((True, write(conn)))
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO write")
+                    results.append((False, exc))
+
+                conn.execute("RELEASE write")
+
+            conn.execute("COMMIT")
+        except sqlite3.Error as exc:
+            logging.error("Can't commit {} writes: {!r}".format(len(batch), exc))
+
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+
+            results = [(False, exc)] * len(batch)
+
+        for (_, loop, future), (ok, value) in zip(batch, results):
+            try:
+                loop.call_soon_threadsafe(_resolve, future, ok, value)
+            except RuntimeError:
+                # The loop of the caller is closed
+                pass
+
+
+class SQLiteStorage(ArchetypeStorage):
+    """
+    Stores dialogs in an SQLite database file in WAL mode: writes are
+    batched into transactions by a single writer thread, reads are served
+    concurrently by a pool of reader threads. `path` must be a file, every
+    connection to `:memory:` opens a separate database.
+    """
+
+    io_exceptions = (sqlite3.Error,)
+
+    def __init__(self, path: str, settings: typing.Optional[SQLiteSettings] = None):
+        self.path = path
+        self.settings = settings or SQLiteSettings()
+
+        conn = _connect(path, self.settings)
+        try:
+            create_schema(conn)
+        finally:
+            conn.close()
+
+        self._writer = _Writer(path, self.settings)
+        self._writer.start()
+
+        self._readers = ThreadPoolExecutor(
+            max_workers=self.settings.readers, thread_name_prefix="limpopo-sqlite"
+        )
+        self._local = threading.local()
+
+    def close(self):
+        """Commits pending writes and closes connections."""
+        self._writer.stop()
+        self._readers.shutdown(wait=True)
+
+    async def flush(self):
+        # Writes are committed in order, so a no-op write waits for the
+        # previous ones
+        await self._write(lambda conn: None)
+
+    def _write(self, write: typing.Callable) -> asyncio.Future:
+        return self._writer.submit(write)
+
+    def _run_read(self, read: typing.Callable):
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = self._local.conn = _connect(
+                self.path, self.settings, query_only=True
+            )
+
+        # A read transaction sees one snapshot of the database
+        conn.execute("BEGIN")
+        try:
+            return read(conn)
+        finally:
+            conn.execute("COMMIT")
+
+    async def _read(self, read: typing.Callable):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, read)
+
+    def _count_quiz(self, conn, dialog, field: str):
+        conn.execute(
+            _increment_quiz_counter.format(field=field),
+            (dialog.service.quiz_name, dialog.respondent.messenger.name),
+        )
+
+    async def save_question_and_answer(self, dialog, question):
+        dialog_id = dialog.id
+        answer = dialog.answer.text
+
+        def write(conn):
+            conn.execute(
+                "INSERT OR IGNORE INTO questions (id, text) VALUES (?, ?)",
+                (question.id, question.plain_text),
+            )
+            conn.execute(
+                "INSERT INTO dialogue_steps (dialog_id, question_id, answer) "
+                "VALUES (?, ?, ?)",
+                (dialog_id, question.id, answer),
+            )
+
+            if self.settings.counters:
+                conn.execute(_upsert_answer_counter, (question.id, answer))
+
+        await self._write(write)
+
+    async def save_function_call(self, dialog, funcs_hash: int):
+        dialog_id = dialog.id
+
+        def write(conn):
+            conn.execute(
+                "INSERT OR IGNORE INTO called_functions (hash, dialog_id) "
+                "VALUES (?, ?)",
+                (funcs_hash, dialog_id),
+            )
+
+        await self._write(write)
+
+    async def create_dialog(self, dialog) -> int:
+        respondent = dialog.respondent
+        extra_data = (
+            json.dumps(respondent.extra_data)
+            if respondent.extra_data is not None
+            else None
+        )
+
+        def write(conn):
+            conn.execute(
+                _upsert_respondent,
+                (
+                    respondent.id,
+                    respondent.messenger.name,
+                    respondent.username,
+                    respondent.first_name,
+                    respondent.last_name,
+                    extra_data,
+                ),
+            )
+            cursor = conn.execute(
+                "INSERT INTO dialogs (respondent_id, respondent_messenger) "
+                "VALUES (?, ?)",
+                (respondent.id, respondent.messenger.name),
+            )
+
+            if self.settings.counters:
+                self._count_quiz(conn, dialog, "started")
+
+            return cursor.lastrowid
+
+        return await self._write(write)
+
+    @staticmethod
+    def _get_last_dialog_id(conn, respondent_id, respondent_messenger, on_pause):
+        row = conn.execute(
+            _last_dialog_query,
+            (
+                respondent_id,
+                respondent_messenger.name,
+                None if on_pause is None else int(on_pause),
+            ),
+        ).fetchone()
+
+        return row["id"]
+
+    async def get_last_dialog_id(
+        self, respondent_id, respondent_messenger, on_pause=None
+    ):
+        return await self._read(
+            lambda conn: self._get_last_dialog_id(
+                conn, respondent_id, respondent_messenger, on_pause
+            )
+        )
+
+    async def restore_bundle(
+        self, respondent_id, respondent_messenger, on_pause=None
+    ) -> typing.Optional[RestoreBundle]:
+        def read(conn):
+            dialog_id = self._get_last_dialog_id(
+                conn, respondent_id, respondent_messenger, on_pause
+            )
+
+            if dialog_id is None:
+                return
+
+            messages = conn.execute(
+                "SELECT question_id, answer FROM dialogue_steps "
+                "WHERE dialog_id = ? ORDER BY created_at, id",
+                (dialog_id,),
+            ).fetchall()
+            called_functions = conn.execute(
+                "SELECT hash FROM called_functions "
+                "WHERE dialog_id = ? ORDER BY created_at",
+                (dialog_id,),
+            ).fetchall()
+
+            return RestoreBundle(
+                dialog_id=dialog_id,
+                messages=[(row[0], row[1]) for row in messages],
+                called_functions=[row[0] for row in called_functions],
+            )
+
+        return await self._read(read)
+
+    async def get_messages_from_dialog(self, dialog_id: int):
+        def read(conn):
+            rows = conn.execute(
+                "SELECT q.text, ds.answer FROM dialogue_steps as ds "
+                "JOIN questions as q ON q.id = ds.question_id "
+                "WHERE ds.dialog_id = ? ORDER BY ds.created_at, ds.id",
+                (dialog_id,),
+            ).fetchall()
+
+            return [(row[0], row[1]) for row in rows]
+
+        return await self._read(read)
+
+    async def get_called_functions_from_dialog(self, dialog_id: int):
+        def read(conn):
+            rows = conn.execute(
+                "SELECT hash FROM called_functions "
+                "WHERE dialog_id = ? ORDER BY created_at",
+                (dialog_id,),
+            ).fetchall()
+
+            return [row[0] for row in rows]
+
+        return await self._read(read)
+
+    async def close_dialog(self, dialog, is_complete):
+        dialog_id = dialog.id
+        field = "completed" if is_complete else "cancelled"
+
+        def write(conn):
+            cursor = conn.execute(
+                "UPDATE dialogs SET finished_at = {}, {} = 1 "
+                "WHERE id = ? AND finished_at IS NULL".format(NOW, field),
+                (dialog_id,),
+            )
+
+            # A dialog is counted once, even if it is closed again
+            if self.settings.counters and cursor.rowcount:
+                self._count_quiz(conn, dialog, field)
+
+        await self._write(write)
+
+    async def get_answer_counts(self, question_id: int) -> typing.Dict[str, int]:
+        def read(conn):
+            rows = conn.execute(
+                "SELECT answer, count FROM answer_counters WHERE question_id = ?",
+                (question_id,),
+            ).fetchall()
+
+            return {row["answer"]: row["count"] for row in rows}
+
+        return await self._read(read)
+
+    async def get_quiz_counts(self, quiz: str, messenger=None) -> QuizCounts:
+        query = (
+            "SELECT COALESCE(SUM(started), 0), COALESCE(SUM(completed), 0), "
+            "COALESCE(SUM(cancelled), 0) FROM quiz_counters WHERE quiz = ?"
+        )
+        params = [quiz]
+
+        if messenger is not None:
+            query += " AND messenger = ?"
+            params.append(messenger.name)
+
+        def read(conn):
+            return QuizCounts(*conn.execute(query, params).fetchone())
+
+        return await self._read(read)
+
+    async def pause(self, dialog) -> bool:
+        dialog_id = dialog.id
+
+        def write(conn):
+            try:
+                conn.execute(
+                    "INSERT INTO dialogue_pauses (dialog_id) VALUES (?)", (dialog_id,)
+                )
+            except sqlite3.IntegrityError:
+                # The dialog is already paused
+                return False
+
+            return True
+
+        return await self._write(write)
+
+    async def cancel_pause(self, dialog_id) -> bool:
+        def write(conn):
+            cursor = conn.execute(
+                "UPDATE dialogue_pauses SET finished_at = {}, active = NULL "
+                "WHERE dialog_id = ? AND active".format(NOW),
+                (dialog_id,),
+            )
+
+            return bool(cursor.rowcount)
+
+        return await self._write(write)
+
+    async def get_uploaded_file(self, key: str, messenger) -> typing.Optional[str]:
+        def read(conn):
+            row = conn.execute(
+                "SELECT file_id FROM uploaded_files WHERE key = ? AND messenger = ?",
+                (key, messenger.name),
+            ).fetchone()
+
+            if row:
+                return row[0]
+
+        return await self._read(read)
+
+    async def save_uploaded_file(self, key: str, messenger, file_id: str):
+        def write(conn):
+            conn.execute(
+                "INSERT INTO uploaded_files (key, messenger, file_id) "
+                "VALUES (?, ?, ?) "
+                "ON CONFLICT (key, messenger) DO UPDATE SET file_id = excluded.file_id",
+                (key, messenger.name, file_id),
+            )
+
+        await self._write(write)
+
+    async def iter_respondents(
+        self, messenger, after_id=None, segment=None, page_size: int = 1000
+    ) -> typing.AsyncIterator[Respondent]:
+        """
+        Yields respondents of the messenger ordered by id, read in pages of
+        `page_size`. `segment` selects respondents, whose `extra_data`
+        contains it.
+        """
+        while 1:
+            query = "SELECT * FROM respondents WHERE messenger = ?"
+            params = [messenger.name]
+
+            if after_id is not None:
+                query += " AND id > ?"
+                params.append(after_id)
+
+            query += " ORDER BY id LIMIT ?"
+            params.append(page_size)
+
+            rows = await self._read(lambda conn: conn.execute(query, params).fetchall())
+
+            for row in rows:
+                respondent = _respondent(row)
+
+                if not segment or json_contains(respondent.extra_data, segment):
+                    yield respondent
+
+            if len(rows) < page_size:
+                return
+
+            after_id = rows[-1]["id"]
+
+    async def get_questions(self) -> typing.List[typing.Tuple[int, str]]:
+        def read(conn):
+            rows = conn.execute(
+                "SELECT id, text FROM questions ORDER BY created_at, id"
+            ).fetchall()
+
+            return [(row[0], row[1]) for row in rows]
+
+        return await self._read(read)
+
+    async def iter_results(
+        self,
+        since: typing.Optional[datetime] = None,
+        until: typing.Optional[datetime] = None,
+        status: typing.Optional[str] = None,
+        page_size: int = 1000,
+    ):
+        """
+        Yields steps of dialogs created in [since, until) joined with the
+        dialog and respondent fields, the same rows as
+        `PostgreStorage.iter_results`. Dialogs are read in pages of
+        `page_size`.
+        """
+        conditions = ["d.id > ?"]
+        params = []
+
+        if since is not None:
+            conditions.append("d.created_at >= ?")
+            params.append(_to_text(since))
+
+        if until is not None:
+            conditions.append("d.created_at < ?")
+            params.append(_to_text(until))
+
+        if status == "completed":
+            conditions.append("d.completed")
+        elif status == "cancelled":
+            conditions.append("d.cancelled")
+        elif status == "unfinished":
+            conditions.append("d.finished_at IS NULL")
+        elif status is not None:
+            raise ValueError(
+                "Status must be one of {}, received: {}".format(RESULT_STATUSES, status)
+            )
+
+        query = """
+            SELECT
+                d.id AS dialog_id,
+                d.created_at,
+                d.finished_at,
+                d.completed,
+                d.cancelled,
+                r.id AS respondent_id,
+                r.messenger,
+                r.username,
+                r.first_name,
+                r.last_name,
+                r.extra_data,
+                ds.question_id,
+                ds.answer
+            FROM (
+                SELECT * FROM dialogs as d
+                WHERE {}
+                ORDER BY d.id
+                LIMIT ?
+            ) as d
+            JOIN respondents as r
+                ON r.id = d.respondent_id AND r.messenger = d.respondent_messenger
+            LEFT OUTER JOIN dialogue_steps as ds ON ds.dialog_id = d.id
+            ORDER BY d.id, ds.created_at, ds.id
+        """.format(
+            " AND ".join(conditions)
+        )
+        last_id = 0
+
+        while 1:
+            rows = await self._read(
+                lambda conn: conn.execute(
+                    query, [last_id] + params + [page_size]
+                ).fetchall()
+            )
+
+            if not rows:
+                return
+
+            for row in rows:
+                yield ResultRow(
+                    dialog_id=row["dialog_id"],
+                    created_at=_to_datetime(row["created_at"]),
+                    finished_at=_to_datetime(row["finished_at"]),
+                    completed=_to_bool(row["completed"]),
+                    cancelled=_to_bool(row["cancelled"]),
+                    respondent_id=row["respondent_id"],
+                    messenger=Messengers[row["messenger"]],
+                    username=row["username"],
+                    first_name=row["first_name"],
+                    last_name=row["last_name"],
+                    extra_data=(
+                        json.loads(row["extra_data"]) if row["extra_data"] else None
+                    ),
+                    question_id=row["question_id"],
+                    answer=row["answer"],
+                )
+
+            last_id = rows[-1]["dialog_id"]
+
+    async def iter_step_batches(
+        self,
+        after_id: typing.Optional[int] = None,
+        created_before: typing.Optional[datetime] = None,
+        batch_size: int = 10000,
+    ):
+        query = (
+            "SELECT id, dialog_id, question_id, answer, created_at "
+            "FROM dialogue_steps WHERE id > ?"
+        )
+        params = []
+
+        if created_before is not None:
+            query += " AND created_at < ?"
+            params.append(_to_text(created_before))
+
+        query += " ORDER BY id LIMIT ?"
+        last_id = after_id or 0
+
+        while 1:
+            rows = await self._read(
+                lambda conn: conn.execute(
+                    query, [last_id] + params + [batch_size]
+                ).fetchall()
+            )
+
+            if not rows:
+                return
+
+            yield [
+                StepRow(
+                    row["id"],
+                    row["dialog_id"],
+                    row["question_id"],
+                    row["answer"],
+                    _to_datetime(row["created_at"]),
+                )
+                for row in rows
+            ]
+
+            last_id = rows[-1]["id"]
+
+    async def iter_dialog_batches(
+        self,
+        from_id: typing.Optional[int] = None,
+        finished_since: typing.Optional[datetime] = None,
+        batch_size: int = 10000,
+    ):
+        query = (
+            "SELECT id, created_at, finished_at, completed, cancelled "
+            "FROM dialogs WHERE id > ?"
+        )
+        params = []
+
+        if from_id is not None:
+            query += " AND (id >= ?"
+            params.append(from_id)
+
+            if finished_since is not None:
+                query += " OR finished_at >= ?"
+                params.append(_to_text(finished_since))
+
+            query += ")"
+
+        query += " ORDER BY id LIMIT ?"
+        last_id = 0
+
+        while 1:
+            rows = await self._read(
+                lambda conn: conn.execute(
+                    query, [last_id] + params + [batch_size]
+                ).fetchall()
+            )
+
+            if not rows:
+                return
+
+            yield [
+                DialogRow(
+                    row["id"],
+                    _to_datetime(row["created_at"]),
+                    _to_datetime(row["finished_at"]),
+                    _to_bool(row["completed"]),
+                    _to_bool(row["cancelled"]),
+                )
+                for row in rows
+            ]
+
+            last_id = rows[-1]["id"]
+
+    async def get_broadcast_progress(
+        self, name: str, messenger
+    ) -> typing.Optional[BroadcastProgress]:
+        def read(conn):
+            row = conn.execute(
+                "SELECT cursor, invited, failed, finished_at FROM broadcasts "
+                "WHERE name = ? AND messenger = ?",
+                (name, messenger.name),
+            ).fetchone()
+
+            if row:
+                return BroadcastProgress(
+                    cursor=row["cursor"],
+                    invited=row["invited"],
+                    finished=row["finished_at"] is not None,
+                    failed=json.loads(row["failed"]),
+                )
+
+        return await self._read(read)
+
+    async def save_broadcast_progress(
+        self, name: str, messenger, progress: BroadcastProgress
+    ):
+        def write(conn):
+            conn.execute(
+                """
+                INSERT INTO broadcasts
+                    (name, messenger, cursor, invited, failed, updated_at, finished_at)
+                VALUES (?, ?, ?, ?, ?, {now}, CASE WHEN ? THEN {now} END)
+                ON CONFLICT (name, messenger) DO UPDATE SET
+                    cursor = excluded.cursor,
+                    invited = excluded.invited,
+                    failed = excluded.failed,
+                    updated_at = excluded.updated_at,
+                    finished_at = excluded.finished_at
+                """.format(
+                    now=NOW
+                ),
+                (
+                    name,
+                    messenger.name,
+                    progress.cursor,
+                    progress.invited,
+                    json.dumps(progress.failed),
+                    progress.finished,
+                ),
+            )
+
+        await self._write(write)
@@ -1,10 +1,58 @@
+import asyncio
 import os
 import socket
-import time
 import typing
 from urllib.parse import urlparse
 
 from .exceptions import VideoParameterWrongType
+from .helpers import TTLCache
+
+RESOLVE_ATTEMPTS = 3
+RESOLVE_CACHE_TTL = 300  # 300 sec. results of hostname resolution are reused
+
+# (hostname, port) -> whether it was resolved, shared by all videos
+_resolved_hosts = TTLCache(maxsize=1024, ttl=RESOLVE_CACHE_TTL)
+_resolving = {}
+
+
+async def _resolve(hostname, port) -> bool:
+    loop = asyncio.get_event_loop()
+    resolved = False
+
+    for attempt in range(RESOLVE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(1)
+
+        try:
+            await loop.getaddrinfo(hostname, port, family=socket.AF_INET)
+            resolved = True
+            break
+        except socket.error:
+            pass
+
+    _resolved_hosts.set((hostname, port), resolved)
+
+    return resolved
+
+
+async def resolve_host(hostname, port=None) -> bool:
+    """
+    Checks that the hostname resolves. Results are cached, concurrent
+    checks of the same host share one lookup.
+    """
+    key = (hostname, port)
+
+    resolved = _resolved_hosts.get(key)
+    if resolved is not None:
+        return resolved
+
+    task = _resolving.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_resolve(hostname, port))
+        task.add_done_callback(lambda _: _resolving.pop(key, None))
+        _resolving[key] = task
+
+    return await asyncio.shield(task)
 
 
 class Video:
@@ -39,25 +87,19 @@ class Video:
                     "Field `url`: #{} doesn't have hostname".format(type(url))
                 )
 
-            if not self._resolve_url(parse_result):
-                raise VideoParameterWrongType(
-                    "Field `url`: #{} doesn't resolve".format(type(url))
-                )
-
         self.path_to_file = path_to_file
         self.url = url
         self.width = width
         self.height = height
 
-    @staticmethod
-    def _resolve_url(parse_result) -> bool:
-        for _ in range(3):
-            try:
-                socket.getaddrinfo(
-                    parse_result.hostname, parse_result.port, socket.AF_INET
-                )
-                return True
-            except socket.error:
-                time.sleep(1)
+    async def validate_url(self):
+        """
+        Checks that the hostname of `url` resolves, the check is deferred
+        from __init__ to not block the event loop.
+        """
+        parse_result = urlparse(self.url)
 
-        return False
+        if not await resolve_host(parse_result.hostname, parse_result.port):
+            raise VideoParameterWrongType(
+                "Field `url`: #{} doesn't resolve".format(self.url)
+            )
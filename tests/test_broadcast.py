@@ -0,0 +1,107 @@
+import asyncio
+
+from limpopo.dto import Messengers, Respondent
+from limpopo.question import Question
+from limpopo.services.broadcast import Broadcaster
+from limpopo.services.loopback import LoopbackService
+from limpopo.storages import InMemoryStorage
+
+question = Question(topic="Ready?", choices=["Yes", "No"])
+
+
+async def quiz(dialog):
+    await dialog.ask(question)
+
+
+class FlakyStorage(InMemoryStorage):
+    def __init__(self, failing):
+        super().__init__()
+        self.failing = set(failing)
+
+    async def create_dialog(self, dialog, conn=None) -> int:
+        if dialog.respondent.id in self.failing:
+            self.failing.discard(dialog.respondent.id)
+            raise ConnectionRefusedError()
+
+        return await super().create_dialog(dialog)
+
+
+async def stop(service):
+    # Quiz tasks of the last invitations are started
+    await asyncio.sleep(0.01)
+
+    for respondent_id in list(service.dialogs):
+        service.dehydrate_dialog(respondent_id)
+
+    # Quiz tasks handle the cancellation
+    await asyncio.sleep(0.01)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def add_respondents(storage, *ids):
+    for respondent_id in ids:
+        await storage.create_respondent_if_not_exists(
+            Respondent(id=respondent_id, messenger=Messengers.telegram)
+        )
+
+
+def test_broadcast_skips_respondents_with_open_dialogs():
+    async def main():
+        storage = InMemoryStorage()
+        service = LoopbackService(quiz, storage)
+        await add_respondents(storage, "1", "2", "3", "4")
+
+        # A dehydrated dialog and a paused one are kept only by the storage
+        for respondent_id in ("2", "3"):
+            await service.handle_start(respondent_id)
+        await asyncio.sleep(0.01)
+        await service.handle_pause("3")
+        service.restart()
+
+        progress = await Broadcaster(service, "invite").run()
+        dialogs = set(service.dialogs)
+        await stop(service)
+
+        return progress, dialogs
+
+    progress, dialogs = run(main())
+
+    assert progress.invited == 2
+    assert progress.finished
+    assert progress.cursor == "4"
+    assert dialogs == {"1", "4"}
+
+
+def test_broadcast_retries_failed_invitations():
+    async def main():
+        storage = FlakyStorage(failing=["2"])
+        service = LoopbackService(quiz, storage)
+        await add_respondents(storage, "1", "2", "3")
+
+        first = await Broadcaster(service, "invite").run()
+        first_dialogs = set(service.dialogs)
+
+        second = await Broadcaster(service, "invite").run()
+        dialogs = set(service.dialogs)
+        await stop(service)
+
+        return first, first_dialogs, second, dialogs
+
+    first, first_dialogs, second, dialogs = run(main())
+
+    assert first.finished
+    assert first.invited == 2
+    assert first.failed == ["2"]
+    assert first_dialogs == {"1", "3"}
+
+    assert second.invited == 3
+    assert second.failed == []
+    assert dialogs == {"1", "2", "3"}
@@ -0,0 +1,106 @@
+import pytest
+
+from limpopo import helpers
+from limpopo.helpers import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(helpers, "monotonic", lambda: now[0])
+    return now
+
+
+def test_ttl_cache_get_and_set(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert "a" in cache
+    assert cache.get("b") is None
+    assert cache.get("b", 2) == 2
+    assert "b" not in cache
+
+
+def test_ttl_cache_keeps_none_values(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", None)
+
+    assert "a" in cache
+    assert cache.get("a", 1) is None
+
+
+def test_ttl_cache_expires_entries(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+
+    clock[0] += 4.9
+    assert cache.get("a") == 1
+
+    clock[0] += 0.1
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_set_renews_ttl(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+
+    clock[0] += 4
+    cache.set("a", 2)
+
+    clock[0] += 4
+    assert cache.get("a") == 2
+
+
+def test_ttl_cache_evicts_oldest_entries(clock):
+    cache = TTLCache(maxsize=2, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("a", 3)
+    cache.set("c", 4)
+
+    assert len(cache) == 2
+    assert "b" not in cache
+    assert cache.get("a") == 3
+    assert cache.get("c") == 4
+
+
+def test_ttl_cache_drops_expired_entries_on_set(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    clock[0] += 5
+    cache.set("c", 3)
+
+    assert len(cache) == 1
+
+
+def test_ttl_cache_with_zero_maxsize_is_disabled(clock):
+    cache = TTLCache(maxsize=0, ttl=5)
+    cache.set("a", 1)
+
+    assert "a" not in cache
+    assert len(cache) == 0
+
+
+def test_ttl_cache_pop(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    assert cache.pop("a") == 1
+    assert "a" not in cache
+    assert cache.pop("a", 3) == 3
+
+    clock[0] += 5
+    assert cache.pop("b") is None
+
+
+def test_ttl_cache_clear(clock):
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    cache.clear()
+
+    assert len(cache) == 0
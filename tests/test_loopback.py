@@ -0,0 +1,48 @@
+import asyncio
+
+from limpopo.question import Question
+from limpopo.services.loopback import Closed, LoopbackService
+from limpopo.storages import InMemoryStorage
+
+question = Question(topic="Ready?", choices=["Yes", "No"])
+
+
+async def quiz(dialog):
+    await dialog.ask(question)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_restart_before_quiz_start_keeps_dialog_in_storage():
+    async def main():
+        service = LoopbackService(quiz, InMemoryStorage())
+        inbox = service.connect("1")
+
+        await service.handle_start("1")
+        # The quiz task isn't started yet
+        service.restart()
+        await asyncio.sleep(0.01)
+        lost = inbox.qsize()
+
+        # The question is repeated as the respondent starts again
+        await service.handle_start("1")
+        delivery = await asyncio.wait_for(inbox.get(), 1)
+
+        await service.handle_message("1", "Yes")
+        closed = await asyncio.wait_for(inbox.get(), 1)
+
+        return lost, delivery, closed
+
+    lost, delivery, closed = run(main())
+
+    assert lost == 0
+    assert delivery.is_question
+    assert delivery.text == question.topic
+    assert closed == Closed(is_complete=True)
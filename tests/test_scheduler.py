@@ -0,0 +1,121 @@
+import asyncio
+
+from limpopo.services.scheduler import OutboundScheduler, Priority, TokenBucket
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_token_bucket_starts_full():
+    bucket = TokenBucket(rate=1, capacity=3)
+
+    for _ in range(3):
+        assert bucket.delay(0) == 0
+        bucket.take(0)
+
+    assert bucket.delay(0) == 1
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(rate=2, capacity=2)
+    bucket.take(0)
+    bucket.take(0)
+
+    assert bucket.delay(0.25) == 0.25
+    assert bucket.delay(0.5) == 0
+
+    bucket.take(0.5)
+    assert bucket.delay(100) == 0
+    assert bucket.tokens == 2
+
+
+def test_scheduler_sends_within_burst_without_waiting():
+    async def main():
+        scheduler = OutboundScheduler(rate=100, burst=5, chat_rate=100, chat_burst=5)
+        return [await scheduler.acquire(1) for _ in range(5)]
+
+    assert run(main()) == [0] * 5
+
+
+def test_scheduler_limits_chat_rate():
+    async def main():
+        scheduler = OutboundScheduler(rate=1000, burst=1000, chat_rate=20, chat_burst=1)
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+
+        await asyncio.gather(*(scheduler.acquire(1) for _ in range(4)))
+
+        return loop.time() - started_at
+
+    # Three messages wait for a token each 0.05 sec.
+    assert run(main()) >= 0.14
+
+
+def test_scheduler_releases_interactive_messages_first():
+    async def main():
+        scheduler = OutboundScheduler(rate=50, burst=1, chat_rate=1000, chat_burst=1000)
+        order = []
+
+        async def send(name, priority):
+            await scheduler.acquire(name, priority)
+            order.append(name)
+
+        await scheduler.acquire("first")
+        await asyncio.gather(
+            send("bulk-1", Priority.bulk),
+            send("bulk-2", Priority.bulk),
+            send("interactive", Priority.interactive),
+        )
+
+        return order
+
+    assert run(main()) == ["interactive", "bulk-1", "bulk-2"]
+
+
+def test_scheduler_does_not_hold_up_other_chats():
+    async def main():
+        scheduler = OutboundScheduler(rate=1000, burst=1000, chat_rate=1, chat_burst=1)
+        order = []
+
+        async def send(chat_id):
+            await scheduler.acquire(chat_id)
+            order.append(chat_id)
+
+        await scheduler.acquire("busy")
+        busy = asyncio.ensure_future(send("busy"))
+        await asyncio.sleep(0)
+
+        await asyncio.wait_for(send("other"), 0.5)
+        assert scheduler.queue_size == 1
+
+        busy.cancel()
+        return order
+
+    assert run(main()) == ["other"]
+
+
+def test_scheduler_keeps_order_of_messages_to_a_chat():
+    async def main():
+        scheduler = OutboundScheduler(rate=1000, burst=1000, chat_rate=50, chat_burst=1)
+        order = []
+
+        async def send(index, priority):
+            await scheduler.acquire("chat", priority)
+            order.append(index)
+
+        await scheduler.acquire("chat")
+        await asyncio.gather(
+            send(1, Priority.interactive),
+            send(2, Priority.interactive),
+            send(3, Priority.interactive),
+        )
+
+        return order, scheduler.queue_size
+
+    assert run(main()) == ([1, 2, 3], 0)
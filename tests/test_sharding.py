@@ -0,0 +1,83 @@
+import asyncio
+import multiprocessing
+
+import pytest
+
+from limpopo.exceptions import ParameterError
+from limpopo.services import ShardedRunner, TelegramService, ViberService
+from limpopo.services.sharding import ShardChannel, receive_updates, shard_of
+
+
+def create_service():
+    pass
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_shard_of_is_stable():
+    shards = [shard_of("respondent-{}".format(index), 4) for index in range(100)]
+
+    assert shards == [
+        shard_of("respondent-{}".format(index), 4) for index in range(100)
+    ]
+    assert set(shards) == {0, 1, 2, 3}
+    assert shard_of(42, 4) == shard_of("42", 4)
+
+
+def test_sharded_runner_accepts_viber_service():
+    runner = ShardedRunner(ViberService, create_service, workers=2)
+
+    assert runner.workers == 2
+
+
+def test_sharded_runner_rejects_services_without_run_shard():
+    with pytest.raises(ParameterError):
+        ShardedRunner(TelegramService, create_service, workers=2)
+
+
+def test_receive_updates_handles_respondents_concurrently_and_in_order():
+    updates_receiver, updates_sender = multiprocessing.Pipe(duplex=False)
+    acks_receiver, acks_sender = multiprocessing.Pipe(duplex=False)
+    channel = ShardChannel(updates_receiver, acks_sender)
+
+    async def main():
+        handled = []
+        slow_started = asyncio.Event()
+        slow_done = asyncio.Event()
+
+        async def handle_update(update):
+            if update == b"slow":
+                slow_started.set()
+                await slow_done.wait()
+            elif update == b"fail":
+                raise RuntimeError()
+
+            handled.append(update)
+
+        updates_sender.send((0, "1", b"slow"))
+        updates_sender.send((1, "1", b"after slow"))
+        updates_sender.send((2, "2", b"fail"))
+        updates_sender.send((3, "2", b"fast"))
+
+        receiving = asyncio.ensure_future(receive_updates(channel, handle_update))
+        await slow_started.wait()
+        await asyncio.sleep(0.05)
+
+        # The slow update holds up only the updates of its respondent
+        assert handled == [b"fast"]
+
+        slow_done.set()
+        updates_sender.close()
+        await asyncio.wait_for(receiving, 1)
+
+        return handled
+
+    assert run(main()) == [b"fast", b"slow", b"after slow"]
+    assert [acks_receiver.recv() for _ in range(4)] == [2, 3, 0, 1]
@@ -0,0 +1,171 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from limpopo.dto import Answer, Messengers, Respondent
+from limpopo.question import Question
+from limpopo.storages import InMemoryStorage, SQLiteSettings, SQLiteStorage
+
+QUIZ_NAME = "test"
+
+question = Question(topic="Ready?", choices=["Yes", "No"])
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        yield InMemoryStorage()
+        return
+
+    storage = SQLiteStorage(str(tmp_path / "limpopo.db"), SQLiteSettings(counters=True))
+    yield storage
+    storage.close()
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def open_dialog(storage, respondent_id="1"):
+    dialog = SimpleNamespace(
+        id=None,
+        service=SimpleNamespace(quiz_name=QUIZ_NAME),
+        respondent=Respondent(id=respondent_id, messenger=Messengers.telegram),
+        answer=Answer(),
+    )
+    dialog.id = await storage.create_dialog(dialog)
+    return dialog
+
+
+def test_storage_restores_last_open_dialog(storage):
+    async def main():
+        dialog = await open_dialog(storage)
+        dialog.answer.set("Yes")
+        await storage.save_question_and_answer(dialog, question)
+        await storage.save_function_call(dialog, 42)
+        await storage.flush()
+
+        last_id = await storage.get_last_dialog_id("1", Messengers.telegram)
+        bundle = await storage.restore_bundle("1", Messengers.telegram)
+        messages = await storage.get_messages_from_dialog(dialog.id)
+
+        return dialog.id, last_id, bundle, messages
+
+    dialog_id, last_id, bundle, messages = run(main())
+
+    assert last_id == dialog_id
+    assert bundle.dialog_id == dialog_id
+    assert list(bundle.messages) == [(question.id, "Yes")]
+    assert list(bundle.called_functions) == [42]
+    assert messages == [(question.plain_text, "Yes")]
+
+
+def test_storage_has_no_dialogs_of_unknown_respondent(storage):
+    async def main():
+        await open_dialog(storage, "1")
+
+        return (
+            await storage.get_last_dialog_id("2", Messengers.telegram),
+            await storage.restore_bundle("2", Messengers.telegram),
+            await storage.get_last_dialog_id("1", Messengers.viber),
+        )
+
+    assert run(main()) == (None, None, None)
+
+
+def test_storage_pause_hides_dialog_until_cancelled(storage):
+    async def main():
+        dialog = await open_dialog(storage)
+
+        assert await storage.pause(dialog) is True
+        # A dialog has one active pause at most
+        assert await storage.pause(dialog) is False
+
+        assert await storage.get_last_dialog_id("1", Messengers.telegram) is None
+        paused_id = await storage.get_last_dialog_id(
+            "1", Messengers.telegram, on_pause=True
+        )
+        bundle = await storage.restore_bundle("1", Messengers.telegram, on_pause=True)
+
+        assert await storage.cancel_pause(dialog.id) is True
+        assert await storage.cancel_pause(dialog.id) is False
+
+        open_id = await storage.get_last_dialog_id("1", Messengers.telegram)
+        no_paused_id = await storage.get_last_dialog_id(
+            "1", Messengers.telegram, on_pause=True
+        )
+
+        return dialog.id, paused_id, bundle.dialog_id, open_id, no_paused_id
+
+    dialog_id, paused_id, bundle_id, open_id, no_paused_id = run(main())
+
+    assert paused_id == bundle_id == open_id == dialog_id
+    assert no_paused_id is None
+
+
+def test_storage_cancel_pause_of_unknown_dialog(storage):
+    assert run(storage.cancel_pause(100500)) is False
+
+
+def test_storage_restores_newest_of_open_dialogs(storage):
+    async def main():
+        paused = await open_dialog(storage)
+        await storage.pause(paused)
+        opened = await open_dialog(storage)
+
+        return (
+            paused.id,
+            opened.id,
+            await storage.get_last_dialog_id("1", Messengers.telegram),
+            await storage.get_last_dialog_id("1", Messengers.telegram, on_pause=True),
+        )
+
+    paused_id, opened_id, last_id, last_paused_id = run(main())
+
+    assert last_id == opened_id
+    assert last_paused_id == paused_id
+
+
+def test_storage_close_dialog_counts_once(storage):
+    async def main():
+        completed = await open_dialog(storage, "1")
+        cancelled = await open_dialog(storage, "2")
+        await open_dialog(storage, "3")
+
+        await storage.close_dialog(completed, True)
+        await storage.close_dialog(completed, True)
+        await storage.close_dialog(cancelled, False)
+        await storage.flush()
+
+        return (
+            await storage.get_last_dialog_id("1", Messengers.telegram),
+            await storage.get_last_dialog_id("2", Messengers.telegram),
+            await storage.get_quiz_counts(QUIZ_NAME),
+            await storage.get_quiz_counts(QUIZ_NAME, Messengers.viber),
+        )
+
+    completed_id, cancelled_id, counts, viber_counts = run(main())
+
+    assert completed_id is None
+    assert cancelled_id is None
+    assert (counts.started, counts.completed, counts.cancelled) == (3, 1, 1)
+    assert (viber_counts.started, viber_counts.completed) == (0, 0)
+
+
+def test_storage_counts_answers(storage):
+    async def main():
+        for respondent_id, answer in (("1", "Yes"), ("2", "No"), ("3", "Yes")):
+            dialog = await open_dialog(storage, respondent_id)
+            dialog.answer.set(answer)
+            await storage.save_question_and_answer(dialog, question)
+
+        await storage.flush()
+        return await storage.get_answer_counts(question.id)
+
+    assert run(main()) == {"Yes": 2, "No": 1}
@@ -0,0 +1,111 @@
+import asyncio
+
+from limpopo.services.timer_wheel import TimerWheel
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_timer_wheel_calls_callbacks_after_timeout():
+    async def main():
+        wheel = TimerWheel(resolution=0.01)
+        fired = []
+
+        wheel.add("a", 0.05, lambda: fired.append("a"))
+        wheel.add("b", 0.01, lambda: fired.append("b"))
+        assert len(wheel) == 2
+        assert "a" in wheel
+
+        await asyncio.sleep(0.03)
+        assert fired == ["b"]
+
+        await asyncio.sleep(0.05)
+        return fired, len(wheel)
+
+    assert run(main()) == (["b", "a"], 0)
+
+
+def test_timer_wheel_discard():
+    async def main():
+        wheel = TimerWheel(resolution=0.01)
+        fired = []
+
+        wheel.add("a", 0.02, lambda: fired.append("a"))
+        wheel.discard("a")
+        wheel.discard("missing")
+
+        await asyncio.sleep(0.05)
+        return fired, "a" in wheel
+
+    assert run(main()) == ([], False)
+
+
+def test_timer_wheel_add_moves_deadline():
+    async def main():
+        wheel = TimerWheel(resolution=0.01)
+        fired = []
+
+        wheel.add("a", 0.02, lambda: fired.append("first"))
+        wheel.add("a", 0.08, lambda: fired.append("second"))
+
+        await asyncio.sleep(0.05)
+        assert fired == []
+
+        await asyncio.sleep(0.06)
+        return fired
+
+    assert run(main()) == ["second"]
+
+
+def test_timer_wheel_expires_scheduled_tick_when_called_early():
+    async def main():
+        wheel = TimerWheel(resolution=10)
+        fired = []
+
+        wheel.add("a", 5, lambda: fired.append("a"))
+
+        # As if the loop called the timer before the deadline
+        wheel._timer.cancel()
+        wheel._expire()
+
+        return fired, len(wheel), wheel._timer
+
+    assert run(main()) == (["a"], 0, None)
+
+
+def test_timer_wheel_survives_failing_callback():
+    async def main():
+        wheel = TimerWheel(resolution=0.01)
+        fired = []
+
+        def fail():
+            raise RuntimeError()
+
+        wheel.add("a", 0.01, fail)
+        wheel.add("b", 0.01, lambda: fired.append("b"))
+        wheel.add("c", 0.04, lambda: fired.append("c"))
+
+        await asyncio.sleep(0.08)
+        return fired
+
+    assert run(main()) == ["b", "c"]
+
+
+def test_timer_wheel_clear():
+    async def main():
+        wheel = TimerWheel(resolution=0.01)
+        fired = []
+
+        wheel.add("a", 0.01, lambda: fired.append("a"))
+        wheel.clear()
+
+        await asyncio.sleep(0.03)
+        return fired, len(wheel)
+
+    assert run(main()) == ([], 0)
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from limpopo.storages.postgres.storage import WriteBehindBuffer
+
+
+class Statement:
+    def __init__(self, name, fail_on=None):
+        self.name = name
+        self.fail_on = fail_on
+
+    def values(self, values):
+        return self, values
+
+
+class Transaction:
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.written = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        if exc_type is None:
+            self.rows.extend(self.written)
+
+
+class Savepoint(Transaction):
+    def __init__(self, conn):
+        super().__init__(conn.written)
+        self.conn = conn
+
+    async def __aenter__(self):
+        self.conn.savepoint = self
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.conn.savepoint = None
+        await super().__aexit__(*exc_info)
+
+
+class Connection(Transaction):
+    savepoint = None
+
+    def begin_nested(self):
+        return Savepoint(self)
+
+    async def execute(self, query):
+        stmt, values = query
+        values = values if isinstance(values, list) else [values]
+
+        if stmt.fail_on is not None and stmt.fail_on in values:
+            raise ValueError(stmt.fail_on)
+
+        written = self.savepoint.written if self.savepoint else self.written
+        written.extend((stmt.name, row) for row in values)
+
+
+class Engine:
+    def __init__(self):
+        self.committed = []
+
+    def begin(self):
+        return Connection(self.committed)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_write_behind_buffer_writes_rows_in_one_batch():
+    async def main():
+        engine = Engine()
+        buffer = WriteBehindBuffer(engine, batch_size=100, batch_delay=0.01)
+        steps, counters = Statement("steps"), Statement("counters")
+
+        await asyncio.gather(
+            buffer.put((steps, 1), (counters, 1)),
+            buffer.put((steps, 2)),
+        )
+
+        return engine.committed
+
+    assert run(main()) == [("steps", 1), ("steps", 2), ("counters", 1)]
+
+
+def test_write_behind_buffer_fails_rows_put_together():
+    async def main():
+        engine = Engine()
+        buffer = WriteBehindBuffer(engine, batch_size=100, batch_delay=0.01)
+        steps, counters = Statement("steps"), Statement("counters", fail_on=2)
+
+        first = buffer.put((steps, 1), (counters, 1))
+        second = buffer.put((steps, 2), (counters, 2))
+        await buffer.flush()
+
+        with pytest.raises(ValueError):
+            await second
+
+        await first
+        return engine.committed
+
+    # The step of the failed put isn't committed without its counter
+    assert run(main()) == [("steps", 1), ("counters", 1)]